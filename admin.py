@@ -6,22 +6,26 @@ Admin tool for UM-GemiFish user management
 import os
 import json
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta
 
-def list_users():
-    """List all users."""
-    data_dir = 'data'
-    if not os.path.exists(data_dir):
-        print("No users found. Data directory doesn't exist.")
-        return
-    
-    users = []
-    for filename in os.listdir(data_dir):
-        if filename.startswith('user_') and filename.endswith('.json'):
-            filepath = os.path.join(data_dir, filename)
-            with open(filepath, 'r') as f:
-                user_data = json.load(f)
-            users.append(user_data)
+from media_store import MediaStore
+from export import EXPORT_STATE_PATH, export, load_watermark, save_watermark
+from storage import (COMPACT_KEEP_MESSAGES, COMPACT_OLDER_THAN_DAYS, MessageLog, SqliteStorage, JsonFileStorage,
+                     atomic_write_json, copy_users, get_storage, split_legacy_record, user_lock)
+
+def parse_since(value):
+    """Turn '30d', '12h' or an ISO date/time into an ISO timestamp."""
+    units = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+    if value[:-1].isdigit() and value[-1] in units:
+        return (datetime.now() - timedelta(**{units[value[-1]]: int(value[:-1])})).isoformat()
+    return datetime.fromisoformat(value).isoformat()
+
+def list_users(triage=None, location=None, inactive_since=None, page=1, page_size=50):
+    """List users from the summary index, one page at a time."""
+    triage_completed = None if triage is None else triage == 'complete'
+    since = parse_since(inactive_since) if inactive_since else None
+    offset = (page - 1) * page_size
+    users, total = get_storage().list_users(triage_completed, location, since, offset, page_size)
     
     if not users:
         print("No users found.")
@@ -32,40 +36,44 @@ def list_users():
     
     for user in users:
         phone = user['phone_number'].replace('whatsapp:', '')
-        name = user['profile']['name'] or 'N/A'
-        age = user['profile']['age'] or 'N/A'
-        location = user['profile']['location'] or 'N/A'
+        name = user['name'] or 'N/A'
+        age = user['age'] or 'N/A'
+        location = user['location'] or 'N/A'
         triage = "✅" if user['triage_completed'] else "❌"
-        msg_count = len(user['messages'])
+        msg_count = user['message_count']
         
         print(f"{phone:<20} {name:<15} {age:<5} {location:<15} {triage:<8} {msg_count:<8}")
+    
+    pages = (total + page_size - 1) // page_size
+    print(f"\nShowing {offset + 1}-{offset + len(users)} of {total} user(s), page {page} of {pages}.")
 
-def view_user(phone):
+def view_user(phone, last=None):
     """View detailed user information."""
     if not phone.startswith('whatsapp:'):
         phone = f'whatsapp:+{phone}'
     
-    clean_number = phone.replace('+', '').replace(':', '')
-    filepath = os.path.join('data', f'user_{clean_number}.json')
+    storage = get_storage()
+    user_data = storage.load(phone)
     
-    if not os.path.exists(filepath):
+    if user_data is None:
         print(f"User not found: {phone}")
         return
     
-    with open(filepath, 'r') as f:
-        user_data = json.load(f)
-    
     print(f"\n=== User Details ===")
     print(f"Phone: {user_data['phone_number']}")
     print(f"Name: {user_data['profile']['name']}")
     print(f"Age: {user_data['profile']['age']}")
     print(f"Location: {user_data['profile']['location']}")
-    print(f"Fishing Type: {user_data['profile']['fishing_type']}")
+    print(f"Health Concern: {user_data['profile'].get('health_concern', '')}")
     print(f"Created: {user_data['created_at']}")
     print(f"Triage Complete: {'Yes' if user_data['triage_completed'] else 'No'}")
     
-    print(f"\n=== Message History ({len(user_data['messages'])} messages) ===")
-    for i, msg in enumerate(user_data['messages'], 1):
+    messages = storage.read_messages(phone, last)
+    msg_count = user_data.get('message_count', len(messages))
+    
+    print(f"\n=== Message History ({msg_count} messages) ===")
+    first_index = msg_count - len(messages) + 1
+    for i, msg in enumerate(messages, first_index):
         print(f"{i}. [{msg['timestamp']}] {msg['type'].upper()}: {msg['content']}")
         if msg['type'] == 'image' and msg.get('saved_filename'):
             print(f"   File: {msg['saved_filename']}")
@@ -75,24 +83,18 @@ def delete_user(phone):
     if not phone.startswith('whatsapp:'):
         phone = f'whatsapp:+{phone}'
     
-    clean_number = phone.replace('+', '').replace(':', '')
-    filepath = os.path.join('data', f'user_{clean_number}.json')
-    
-    if not os.path.exists(filepath):
+    storage = get_storage()
+    if not storage.exists(phone):
         print(f"User not found: {phone}")
         return
     
-    # Also delete their uploads directory
-    clean_phone = phone.replace('whatsapp:', '').replace('+', '')
-    uploads_dir = os.path.join('uploads', clean_phone)
-    
     confirm = input(f"Are you sure you want to delete user {phone}? (y/N): ")
     if confirm.lower() == 'y':
-        os.remove(filepath)
-        if os.path.exists(uploads_dir):
-            import shutil
-            shutil.rmtree(uploads_dir)
-        print(f"User {phone} deleted successfully.")
+        with user_lock(phone):
+            storage.delete(phone)
+        # Also delete their uploads, and any media no other user shares
+        freed = MediaStore().remove_user(phone)
+        print(f"User {phone} deleted successfully ({freed} bytes of media freed).")
     else:
         print("Deletion cancelled.")
 
@@ -101,35 +103,128 @@ def reset_triage(phone):
     if not phone.startswith('whatsapp:'):
         phone = f'whatsapp:+{phone}'
     
-    clean_number = phone.replace('+', '').replace(':', '')
-    filepath = os.path.join('data', f'user_{clean_number}.json')
+    storage = get_storage()
+    with user_lock(phone):
+        user_data = storage.load_for_update(phone)
+        
+        if user_data is None:
+            print(f"User not found: {phone}")
+            return
+        
+        user_data['triage_completed'] = False
+        user_data['current_triage_step'] = 0
+        user_data['profile'] = {'name': '', 'age': '', 'location': '', 'health_concern': ''}
+        
+        storage.save(phone, user_data)
     
-    if not os.path.exists(filepath):
-        print(f"User not found: {phone}")
+    print(f"Triage reset for user {phone}")
+
+def migrate_messages():
+    """Move embedded message histories into per-user message logs."""
+    data_dir = 'data'
+    if not os.path.exists(data_dir):
+        print("No users found. Data directory doesn't exist.")
         return
     
-    with open(filepath, 'r') as f:
-        user_data = json.load(f)
+    message_log = MessageLog(data_dir)
+    migrated = 0
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.startswith('user_') and filename.endswith('.json'):
+            filepath = os.path.join(data_dir, filename)
+            with user_lock(filename[len('user_'):-len('.json')]):
+                with open(filepath, 'r') as f:
+                    user_data = json.load(f)
+                
+                # The log is written before the record, so a rerun after a crash is safe
+                if not split_legacy_record(user_data, message_log):
+                    continue
+                atomic_write_json(filepath, user_data)
+            migrated += 1
+            print(f"Migrated {user_data['phone_number']} ({user_data['message_count']} messages)")
     
-    user_data['triage_completed'] = False
-    user_data['current_triage_step'] = 0
-    user_data['profile'] = {'name': '', 'age': '', 'location': '', 'fishing_type': ''}
+    print(f"{migrated} user(s) migrated.")
+
+def import_sqlite(db_path):
+    """Copy every user in data/ into a SQLite database."""
+    source = JsonFileStorage()
+    target = SqliteStorage(db_path) if db_path else SqliteStorage()
+    copied = copy_users(source, target)
+    print(f"{copied} user(s) imported into {target.path}.")
+
+def rebuild_index(workers=None, full=False):
+    """Refresh the summary index used by 'list'."""
+    storage = get_storage()
+    if not hasattr(storage, 'rebuild_index'):
+        print("The sqlite backend lists users from its own indexed table; nothing to rebuild.")
+        return
+    report = storage.rebuild_index(workers, full)
+    print(f"Scanned {report['scanned']} user file(s): {report['updated']} index row(s) refreshed, "
+          f"{report['removed']} removed.")
+
+def export_data(output_dir, fmt, compression, since=None, incremental=False, state_path=EXPORT_STATE_PATH,
+                workers=None):
+    """Export users and messages for analytics."""
+    if since:
+        since = parse_since(since)
+    elif incremental:
+        since = load_watermark(state_path)
     
-    with open(filepath, 'w') as f:
-        json.dump(user_data, f, indent=2)
+    result = export(get_storage(), output_dir, fmt, compression, since, workers)
+    print(f"Exported {result['users']} user(s) and {result['messages']} message(s)"
+          f"{f' newer than {since}' if since else ''}:")
+    for path in result['paths'].values():
+        print(f"  {path}")
     
-    print(f"Triage reset for user {phone}")
+    if incremental:
+        save_watermark(state_path, result['watermark'])
+        print(f"Next incremental export starts after {result['watermark']}.")
+
+def compact_messages(keep_last=COMPACT_KEEP_MESSAGES, older_than=None):
+    """Move old messages of every user into compressed archive segments."""
+    storage = get_storage()
+    cutoff = parse_since(older_than) if older_than else None
+    users, _ = storage.list_users()
+    compacted = 0
+    archived = 0
+    for summary in users:
+        # Users who never had more than keep_last messages have nothing to archive by count
+        if cutoff is None and (summary.get('message_count') or 0) <= keep_last:
+            continue
+        count = storage.compact_messages(summary['phone_number'], keep_last, cutoff)
+        if count:
+            compacted += 1
+            archived += count
+            print(f"Archived {count} message(s) of {summary['phone_number']}")
+    
+    print(f"{archived} message(s) from {compacted} user(s) archived.")
+
+def dedup_media():
+    """Move existing uploads into the content-addressed media store."""
+    store = MediaStore()
+    report = store.deduplicate()
+    removed, freed = store.collect_garbage()
+    print(f"Scanned {report['files']} file(s): {report['already_linked']} already stored, "
+          f"{report['duplicates']} duplicate(s) linked to existing blobs.")
+    print(f"Reclaimed {report['bytes_reclaimed'] + freed} bytes "
+          f"({removed} unreferenced blob(s) removed).")
 
 def main():
     parser = argparse.ArgumentParser(description='UM-GemiFish Admin Tool')
     subparsers = parser.add_subparsers(dest='command', help='Available commands')
     
     # List users
-    subparsers.add_parser('list', help='List all users')
+    list_parser = subparsers.add_parser('list', help='List users')
+    list_parser.add_argument('--triage', choices=['complete', 'pending'], help='Only users with this triage state')
+    list_parser.add_argument('--location', help='Only users in this location (case-insensitive)')
+    list_parser.add_argument('--inactive-since', metavar='WHEN',
+                             help="Only users with no message since WHEN: an ISO date/time or e.g. '30d', '12h'")
+    list_parser.add_argument('--page', type=int, default=1, help='Page to show (default 1)')
+    list_parser.add_argument('--page-size', type=int, default=50, help='Users per page (default 50)')
     
     # View user
     view_parser = subparsers.add_parser('view', help='View user details')
     view_parser.add_argument('phone', help='Phone number (with or without whatsapp: prefix)')
+    view_parser.add_argument('--last', type=int, help='Only show the last N messages')
     
     # Delete user
     delete_parser = subparsers.add_parser('delete', help='Delete a user')
@@ -139,16 +234,65 @@ def main():
     reset_parser = subparsers.add_parser('reset-triage', help='Reset user triage process')
     reset_parser.add_argument('phone', help='Phone number (with or without whatsapp: prefix)')
     
+    # Migrate message histories
+    subparsers.add_parser('migrate-messages', help='Move message histories into append-only logs')
+    
+    # Import into SQLite
+    import_parser = subparsers.add_parser('import-sqlite', help='Copy users from data/ into a SQLite database')
+    import_parser.add_argument('--db', help='SQLite database path (defaults to USER_STORAGE_PATH)')
+    
+    # Rebuild the summary index
+    index_parser = subparsers.add_parser('rebuild-index', help='Refresh the user summary index from data/')
+    index_parser.add_argument('--workers', type=int, help='Processes reading user files (default: CPU count)')
+    index_parser.add_argument('--full', action='store_true', help='Re-read every file, not just changed ones')
+    
+    # Export for analytics
+    export_parser = subparsers.add_parser('export', help='Export users and messages as JSONL or CSV')
+    export_parser.add_argument('output_dir', help='Directory to write users.* and messages.* into')
+    export_parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    export_parser.add_argument('--compress', choices=['none', 'gzip', 'bz2', 'xz'], default='none')
+    export_parser.add_argument('--since', metavar='WHEN',
+                               help="Only messages after WHEN: an ISO date/time or e.g. '1d'")
+    export_parser.add_argument('--incremental', action='store_true',
+                               help='Continue from the watermark of the last incremental export and save a new one')
+    export_parser.add_argument('--state', default=EXPORT_STATE_PATH,
+                               help=f'Where --incremental keeps its watermark (default {EXPORT_STATE_PATH})')
+    export_parser.add_argument('--workers', type=int, help='Processes parsing user files (default: CPU count)')
+    
+    # Compact message histories
+    default_older_than = f'{COMPACT_OLDER_THAN_DAYS}d' if COMPACT_OLDER_THAN_DAYS else None
+    compact_parser = subparsers.add_parser('compact', help='Archive old messages into compressed segments')
+    compact_parser.add_argument('--keep', type=int, default=COMPACT_KEEP_MESSAGES,
+                                help=f'Messages to keep live per user (default {COMPACT_KEEP_MESSAGES})')
+    compact_parser.add_argument('--older-than', metavar='WHEN', default=default_older_than,
+                                help="Also archive messages from before WHEN: an ISO date/time or e.g. '90d'")
+    
+    # Deduplicate uploads
+    subparsers.add_parser('dedup-media', help='Move uploads into the deduplicating media store')
+    
     args = parser.parse_args()
     
     if args.command == 'list':
-        list_users()
+        list_users(args.triage, args.location, args.inactive_since, args.page, args.page_size)
     elif args.command == 'view':
-        view_user(args.phone)
+        view_user(args.phone, args.last)
     elif args.command == 'delete':
         delete_user(args.phone)
     elif args.command == 'reset-triage':
         reset_triage(args.phone)
+    elif args.command == 'migrate-messages':
+        migrate_messages()
+    elif args.command == 'import-sqlite':
+        import_sqlite(args.db)
+    elif args.command == 'rebuild-index':
+        rebuild_index(args.workers, args.full)
+    elif args.command == 'export':
+        export_data(args.output_dir, args.format, args.compress, args.since, args.incremental, args.state,
+                    args.workers)
+    elif args.command == 'compact':
+        compact_messages(args.keep, args.older_than)
+    elif args.command == 'dedup-media':
+        dedup_media()
     else:
         parser.print_help()
 
@@ -1,23 +1,61 @@
 import os
-import json
 import requests
 import asyncio
 import time
-from datetime import datetime
+import functools
+import importlib
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
+from flask import Flask, Response, request
 from requests.auth import HTTPBasicAuth
-from multi_tool_agent.agent import root_agent
+from multi_tool_agent.agent import AgentTurn, agent_turn, get_root_agent
+from storage import clean_phone_number, get_storage, user_lock
+from history import fold_message
+from outbound import send_whatsapp_message
+from event_loop import agent_loop
+from media import MediaDownloader, MediaTooLarge
+from media_store import MediaStore, safe_filename_stem
+from image_pipeline import ImagePreprocessor
+from timezones import get_index
+from weather import get_weather_service
+from response_cache import RESPONSE_CACHE, ResponseCache, is_cacheable
+from scheduler import SUPERSEDED, Debouncer, SchedulerBusy, ShardedScheduler
+from idempotency import DONE, IN_FLIGHT, IdempotencyStore
+from metrics import metrics, timed_stage
+from structured_logging import dropped_records, get_logger, request_context, setup_logging, stage_timings
 
 load_dotenv()
 
+# JSON logs written from a background thread
+setup_logging()
+logger = get_logger('app')
+
 app = Flask(__name__)
 
 # Get Twilio credentials from environment
 TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 
+# Acknowledge webhooks immediately and send agent replies via the REST API
+ASYNC_REPLIES = os.getenv('ASYNC_REPLIES', '').lower() in ('1', 'true', 'yes')
+
+# Import ADK and build the agent when a gunicorn worker starts rather than on its first message
+WARM_UP = os.getenv('WARM_UP', 'true').lower() in ('1', 'true', 'yes')
+
+# Merge text messages a user sends within this many seconds of each other into one agent turn (0 disables)
+BURST_WINDOW_SECONDS = float(os.getenv('BURST_WINDOW_SECONDS', '0'))
+# Answer a burst once its first message has waited this long, even if more keep arriving
+BURST_MAX_SECONDS = float(os.getenv('BURST_MAX_SECONDS', '10'))
+# Most messages merged into one turn
+BURST_MAX_MESSAGES = 20
+
+# Number of parsed user records kept in memory between requests
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '256'))
+
 # Health service triage questions
 TRIAGE_QUESTIONS = [
     "Hi! Welcome to our health service. What's your name?",
@@ -29,24 +67,156 @@ TRIAGE_QUESTIONS = [
 # Response messages
 WELCOME_MESSAGE = "Thank you {name}! Your profile is complete. You can now send me images or ask health-related questions."
 COMPLETION_MESSAGE = "Thank you for providing your information. How can I help you today?"
+BUSY_MESSAGE = "I'm getting a lot of messages right now. Please try again in a minute."
+
+class RecordCache:
+    """Bounded LRU of parsed user records, invalidated by the storage version."""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return the cached record if it was cached at the given version."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if version is None or entry[0] != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, user_data):
+        """Cache a record that was just read or written at the given version."""
+        if self.maxsize <= 0 or version is None:
+            return
+        with self._lock:
+            self._entries[key] = (version, user_data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """Drop a record from the cache."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def in_unit_of_work(method):
+    """Run a UserManager mutator in its own unit of work unless one is already open."""
+    @functools.wraps(method)
+    def wrapper(self, phone_number, *args, **kwargs):
+        if self._current_unit(phone_number) is not None:
+            return method(self, phone_number, *args, **kwargs)
+        with self.unit_of_work(phone_number):
+            return method(self, phone_number, *args, **kwargs)
+    return wrapper
+
 
 class UserManager:
     def __init__(self):
         self.data_dir = 'data'
         self.uploads_dir = 'uploads'
+        self.storage = get_storage()
+        self.cache = RecordCache()
+        self._local = threading.local()
         # Ensure directories exist
         os.makedirs(self.data_dir, exist_ok=True)
         os.makedirs(self.uploads_dir, exist_ok=True)
         
-    def get_user_file_path(self, phone_number):
-        """Get the file path for a user's JSON data."""
-        clean_number = phone_number.replace('+', '').replace(':', '').replace('whatsapp', '')
-        return os.path.join(self.data_dir, f'user_{clean_number}.json')
+    @contextmanager
+    def unit_of_work(self, phone_number):
+        """Load the user's record at most once and flush it at most once.
+
+        Inside the block every load_user/save_user for phone_number works on
+        the same in-memory record; changes are written when the block exits
+        (or earlier via commit()). Nothing is written if nothing changed.
+        """
+        # Hold the user's lock until the unit ends so other workers can't interleave
+        lock = user_lock(phone_number)
+        lock.acquire()
+        self._local.unit = {
+            'phone_number': phone_number,
+            'loaded': False,
+            'user_data': None,
+            'dirty': False,
+            'lock': lock,
+            'previous': getattr(self._local, 'unit', None)
+        }
+        try:
+            yield
+        except BaseException:
+            # The cached record may hold half-applied changes
+            self.cache.discard(clean_phone_number(phone_number))
+            self.rollback()
+            raise
+        self.commit()
+
+    def commit(self):
+        """Flush the current unit of work, if any, and end it."""
+        unit = getattr(self._local, 'unit', None)
+        if unit is None:
+            return
+        self._local.unit = unit['previous']
+        try:
+            if unit['dirty'] and unit['user_data'] is not None:
+                self._write_user(unit['phone_number'], unit['user_data'])
+        finally:
+            unit['lock'].release()
+
+    def rollback(self):
+        """End the current unit of work, if any, without writing."""
+        unit = getattr(self._local, 'unit', None)
+        if unit is None:
+            return
+        self._local.unit = unit['previous']
+        unit['lock'].release()
+
+    def _current_unit(self, phone_number):
+        """Return the active unit of work for phone_number, if there is one."""
+        unit = getattr(self._local, 'unit', None)
+        if unit is not None and unit['phone_number'] == phone_number:
+            return unit
+        return None
+
+    def _read_user(self, phone_number, for_update=False):
+        """Read a user's record through the cache.
+
+        With for_update, the caller holds the user's lock and the record is
+        upgraded in storage if it still has a legacy layout.
+        """
+        key = clean_phone_number(phone_number)
+        version = self.storage.version(phone_number)
+        user_data = self.cache.get(key, version)
+        if user_data is not None and not (for_update and 'messages' in user_data):
+            return user_data
+        
+        with timed_stage('user_load'):
+            if for_update:
+                user_data = self.storage.load_for_update(phone_number)
+                version = self.storage.version(phone_number)
+            else:
+                user_data = self.storage.load(phone_number)
+        if user_data is not None:
+            self.cache.put(key, version, user_data)
+        return user_data
+
+    def _write_user(self, phone_number, user_data):
+        """Write a user's record to storage and refresh the cache."""
+        with timed_stage('user_save'):
+            self.storage.save(phone_number, user_data)
+        self.cache.put(clean_phone_number(phone_number), self.storage.version(phone_number), user_data)
     
     def user_exists(self, phone_number):
         """Check if user profile exists."""
-        return os.path.exists(self.get_user_file_path(phone_number))
+        if self._current_unit(phone_number) is not None:
+            return self.load_user(phone_number) is not None
+        return self.storage.exists(phone_number)
     
+    @in_unit_of_work
     def create_user(self, phone_number):
         """Create a new user profile."""
         user_data = {
@@ -60,32 +230,38 @@ class UserManager:
             },
             'triage_completed': False,
             'current_triage_step': 0,
-            'messages': [],
+            'message_count': 0,
+            'last_message_at': None,
             'adk_conversation_id': f"conv_{phone_number}_{int(time.time())}"
         }
         
-        file_path = self.get_user_file_path(phone_number)
-        with open(file_path, 'w') as f:
-            json.dump(user_data, f, indent=2)
-        
+        self.save_user(phone_number, user_data)
         return user_data
     
     def load_user(self, phone_number):
-        """Load user data from JSON file."""
-        file_path = self.get_user_file_path(phone_number)
-        if not os.path.exists(file_path):
-            return None
-            
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        """Load user data from storage."""
+        unit = self._current_unit(phone_number)
+        if unit is None:
+            return self._read_user(phone_number)
+        if not unit['loaded']:
+            unit['user_data'] = self._read_user(phone_number, for_update=True)
+            unit['loaded'] = True
+        return unit['user_data']
     
     def save_user(self, phone_number, user_data):
-        """Save user data to JSON file."""
-        file_path = self.get_user_file_path(phone_number)
-        with open(file_path, 'w') as f:
-            json.dump(user_data, f, indent=2)
+        """Save user data to storage."""
+        unit = self._current_unit(phone_number)
+        if unit is None:
+            with user_lock(phone_number):
+                self._write_user(phone_number, user_data)
+            return
+        unit['user_data'] = user_data
+        unit['loaded'] = True
+        unit['dirty'] = True
     
-    def add_message(self, phone_number, message_type, content, media_url=None, media_type=None, filename=None):
+    @in_unit_of_work
+    def add_message(self, phone_number, message_type, content, media_url=None, media_type=None, filename=None,
+                    media_sha256=None):
         """Add a message to user's message history."""
         user_data = self.load_user(phone_number)
         if not user_data:
@@ -99,10 +275,71 @@ class UserManager:
             'media_type': media_type,
             'saved_filename': filename
         }
+        if media_sha256:
+            message_entry['media_sha256'] = media_sha256
         
-        user_data['messages'].append(message_entry)
+        # The history lives in an append-only log; the record keeps counters,
+        # the most recent messages and a rolling summary of the rest
+        self.storage.append_message(phone_number, message_entry)
+        user_data['message_count'] = user_data.get('message_count', 0) + 1
+        user_data['last_message_at'] = message_entry['timestamp']
+        fold_message(user_data, message_entry)
         self.save_user(phone_number, user_data)
+        return message_entry
+    
+    def get_messages(self, phone_number, last=None):
+        """Get a user's message history, or only the last N messages."""
+        return self.storage.read_messages(phone_number, last)
+    
+    @in_unit_of_work
+    def attach_media(self, phone_number, message_entry, filename, media_sha256):
+        """Record where an image message's file was saved, once it has been downloaded."""
+        fields = {'saved_filename': filename, 'media_sha256': media_sha256}
+        message_entry.update(fields)
+        self.storage.update_message(phone_number, message_entry['timestamp'], fields)
+        
+        user_data = self.load_user(phone_number)
+        for entry in user_data.get('recent_messages', []):
+            if entry.get('timestamp') == message_entry['timestamp']:
+                entry['saved_filename'] = filename
+                self.save_user(phone_number, user_data)
+                break
     
+    @in_unit_of_work
+    def claim_burst(self, phone_number, message_entry):
+        """Claim the unanswered text messages up to message_entry for one agent turn.
+
+        Returns their contents, oldest first, or None if a later message
+        in the same burst will answer them. Works across worker processes,
+        since every message is in the shared log before it's claimed.
+        """
+        user_data = self.load_user(phone_number)
+        if not user_data:
+            return None
+        
+        timestamp = message_entry['timestamp']
+        claimed_through = user_data.get('burst_claimed_through') or ''
+        if claimed_through >= timestamp:
+            return None
+        
+        # Ignore anything too old to still be waiting, e.g. from before bursts were enabled
+        horizon = (datetime.fromisoformat(timestamp) - timedelta(seconds=2 * BURST_MAX_SECONDS)).isoformat()
+        pending = [
+            entry for entry in self.get_messages(phone_number, BURST_MAX_MESSAGES)
+            if entry.get('type') == 'text' and entry['timestamp'] > max(claimed_through, horizon)
+        ]
+        later = any(entry['timestamp'] > timestamp for entry in pending)
+        pending = [entry for entry in pending if entry['timestamp'] <= timestamp]
+        overdue = pending and pending[0]['timestamp'] <= (
+            datetime.now() - timedelta(seconds=BURST_MAX_SECONDS)).isoformat()
+        if later and not overdue:
+            return None
+        
+        user_data['burst_claimed_through'] = timestamp
+        self.save_user(phone_number, user_data)
+        return [entry['content'] for entry in pending] or [message_entry['content']]
+    
+    @in_unit_of_work
     def update_triage_response(self, phone_number, response):
         """Update user profile with triage response."""
         user_data = self.load_user(phone_number)
@@ -128,6 +365,7 @@ class UserManager:
         self.save_user(phone_number, user_data)
         return user_data
     
+    @in_unit_of_work
     def get_adk_conversation_id(self, phone_number):
         """Get or create ADK conversation ID for user."""
         user_data = self.load_user(phone_number)
@@ -143,37 +381,231 @@ class UserManager:
 # Initialize user manager
 user_manager = UserManager()
 
+# Shared, connection-pooled downloader for Twilio media
+media_downloader = MediaDownloader(auth=HTTPBasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
+
+# Deduplicating store that uploads are filed into
+media_store = MediaStore(user_manager.uploads_dir)
+
+# Downsizes photos in a process pool before they go to the agent
+image_preprocessor = ImagePreprocessor()
+
+# Replies to repeated questions, when RESPONSE_CACHE is enabled
+response_cache = ResponseCache() if RESPONSE_CACHE else None
+
+def response_cache_metrics():
+    """Export the response cache's statistics with the other metrics."""
+    stats = response_cache.stats()
+    return {
+        'response_cache_hits_total': stats['hits'],
+        'response_cache_misses_total': stats['misses'],
+        'response_cache_skipped_total': stats['skipped'],
+        'response_cache_saved_seconds_total': stats['saved_seconds'],
+        'response_cache_entries': stats['entries']
+    }
+
+if response_cache is not None:
+    metrics.add_collector(response_cache_metrics)
+
+# setup_logging() gives each forked worker a new handler, so look it up on every collection
+metrics.add_collector(lambda: {'log_records_dropped_total': dropped_records()})
+metrics.add_collector(lambda: get_weather_service().stats())
+
+# Built by get_agent_runner() on first use, since importing ADK takes a second or two
+agent_runner = None
+agent_runner_lock = threading.Lock()
+
+# TwiML already returned for each MessageSid, shared by all workers
+deliveries = IdempotencyStore()
+
+# Produces replies in order for each user, and in parallel across users
+reply_scheduler = ShardedScheduler()
+metrics.add_collector(reply_scheduler.stats)
+
+# Holds text messages for BURST_WINDOW_SECONDS before they reach the reply workers
+burst_debouncer = Debouncer()
+metrics.add_collector(burst_debouncer.stats)
+
+def get_agent_runner():
+    """The ADK runner for root_agent, created on first use.
+
+    Conversations behind adk_conversation_id are persisted in a session
+    store shared by all workers.
+    """
+    global agent_runner
+    if agent_runner is None:
+        with agent_runner_lock:
+            if agent_runner is None:
+                from google.adk.runners import Runner
+                from session_store import PersistentSessionService
+                session_service = PersistentSessionService()
+                metrics.add_collector(session_service.stats)
+                agent_runner = Runner(app_name='nutrimate', agent=get_root_agent(),
+                                      session_service=session_service, auto_create_session=True)
+    return agent_runner
+
+def warm_up():
+    """Do the slow first-use work now rather than in a worker's first requests.
+
+    Imports ADK and Twilio, builds the agent and its runner, and loads
+    the timezone index. gunicorn.conf.py calls this in every worker
+    once it has started, unless WARM_UP is turned off.
+    """
+    started = time.perf_counter()
+    get_agent_runner()
+    # Imported later by image attachments and TwiML replies
+    importlib.import_module('google.genai.types')
+    importlib.import_module('twilio.twiml.messaging_response')
+    get_index()
+    logger.info("Worker warmed up", extra={'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+
 def respond(message):
     """Create a TwiML response with the given message."""
+    from twilio.twiml.messaging_response import MessagingResponse
     response = MessagingResponse()
     response.message(message)
     return str(response)
 
+def acknowledge():
+    """Create an empty TwiML response; the reply is sent later via the REST API."""
+    from twilio.twiml.messaging_response import MessagingResponse
+    return str(MessagingResponse())
+
+def deliver_reply(sender, generate, *args):
+    """Produce a reply in the background and send it through Twilio."""
+    try:
+        reply_text = generate(*args)
+        if reply_text is None:
+            # Another message in the same burst sends the reply
+            return
+        send_whatsapp_message(sender, reply_text)
+        logger.info("Reply delivered", extra={'stages': stage_timings()})
+    except Exception:
+        logger.exception("Error delivering reply", extra={'stages': stage_timings()})
+
+def submit_reply(sender, generate, *args):
+    """Queue generate(*args) behind sender's earlier messages and send its result once it's done."""
+    return reply_scheduler.submit(sender, deliver_reply, sender, generate, *args)
+
+def schedule_reply(sender, generate, *args):
+    """Produce a reply in order with the sender's other messages and build the TwiML response."""
+    try:
+        if ASYNC_REPLIES:
+            submit_reply(sender, generate, *args)
+            return acknowledge()
+        reply_text = reply_scheduler.run(sender, generate, *args)
+    except SchedulerBusy:
+        logger.warning("Reply queue full")
+        return respond(BUSY_MESSAGE)
+    return acknowledge() if reply_text is None else respond(reply_text)
+
 def get_clean_phone_number(sender):
     """Extract clean phone number from sender field."""
     return sender.split(':')[1] if ':' in sender else sender
 
-async def process_with_adk_agent(phone_number, message):
-    """Process message with ADK agent."""
+async def chat_with_agent(conv_id, user_id, message, attachments):
+    """Run one agent turn in the user's persistent session and return the reply text."""
+    from google.genai import types
+    content = types.Content(role='user', parts=[types.Part(text=message), *attachments])
+    reply_parts = []
+    async for event in get_agent_runner().run_async(user_id=user_id, session_id=conv_id, new_message=content):
+        if event.is_final_response() and event.content and event.content.parts:
+            reply_parts.extend(part.text for part in event.content.parts if part.text)
+    return ''.join(reply_parts)
+
+async def record_exchange(conv_id, user_id, message, reply_text):
+    """Add a message answered without the agent, and its reply, to the user's session."""
+    from google.adk.events import Event
+    from google.genai import types
+    runner = get_agent_runner()
+    session = await runner.session_service.get_session(app_name=runner.app_name, user_id=user_id,
+                                                       session_id=conv_id)
+    if session is None:
+        session = await runner.session_service.create_session(app_name=runner.app_name, user_id=user_id,
+                                                              session_id=conv_id)
+    invocation_id = Event.new_id()
+    for author, role, text in (('user', 'user', message), (runner.agent.name, 'model', reply_text)):
+        await runner.session_service.append_event(session, Event(
+            invocation_id=invocation_id,
+            author=author,
+            content=types.Content(role=role, parts=[types.Part(text=text)])
+        ))
+
+async def has_conversation(conv_id, user_id):
+    """Whether the user's agent session already holds earlier turns."""
+    from google.adk.sessions.base_session_service import GetSessionConfig
+    runner = get_agent_runner()
+    session = await runner.session_service.get_session(app_name=runner.app_name, user_id=user_id,
+                                                       session_id=conv_id,
+                                                       config=GetSessionConfig(num_recent_events=1))
+    return bool(session and session.events)
+
+async def process_with_adk_agent(phone_number, message, images=None):
+    """Process message with ADK agent, optionally attaching prepared images."""
     try:
-        # Get conversation ID
-        conv_id = user_manager.get_adk_conversation_id(phone_number)
+        # Get conversation ID without blocking the shared event loop on storage
+        conv_id = await asyncio.to_thread(user_manager.get_adk_conversation_id, phone_number)
         if not conv_id:
             return "Sorry, I couldn't find your conversation. Please try again."
         
+        # One snapshot of the user's record shared by every tool call in the turn
+        with timed_stage('turn_load'):
+            turn = await asyncio.to_thread(AgentTurn, phone_number)
+        
+        # Answer repeated text questions from the response cache
+        cache_key = None
+        if response_cache is not None and not images and is_cacheable(message):
+            cache_key = response_cache.make_key(message, turn.user_data['profile'])
+            cached_reply = response_cache.get(cache_key)
+            if cached_reply is not None:
+                stats = response_cache.stats()
+                logger.info("Response cache hit", extra={
+                    'hit_ratio': round(stats['hit_ratio'], 3),
+                    'saved_seconds': round(stats['saved_seconds'], 1)
+                })
+                # Keep the agent's view of the conversation complete
+                await record_exchange(conv_id, clean_phone_number(phone_number), message, cached_reply)
+                return cached_reply
+            # A reply that may build on earlier turns isn't anyone else's answer
+            if await has_conversation(conv_id, clean_phone_number(phone_number)):
+                response_cache.skip()
+                cache_key = None
+        
+        # Attach images as inline parts alongside the text
+        from google.genai import types
+        attachments = [
+            types.Part.from_bytes(data=await asyncio.to_thread(image.read), mime_type=image.mime_type)
+            for image in images or []
+        ]
+        
         # Call the ADK agent
-        response = await root_agent.chat(
-            conv_id,
-            message,
-            tools_context={'phone_number': phone_number}
-        )
+        started = time.perf_counter()
+        try:
+            with agent_turn(turn), timed_stage('agent_call'):
+                reply_text = await chat_with_agent(
+                    conv_id,
+                    clean_phone_number(phone_number),
+                    message,
+                    attachments
+                )
+        finally:
+            # Save everything the tools changed in a single write
+            with timed_stage('turn_flush'):
+                written = await asyncio.to_thread(turn.flush)
+            if written:
+                logger.info("Saved agent field updates", extra={'fields': written})
+        
+        # Only cache answers that neither used nor changed the user's own data or conversation
+        if cache_key is not None:
+            if turn.reads or turn.writes:
+                response_cache.skip()
+            else:
+                response_cache.put(cache_key, reply_text, time.perf_counter() - started)
         
-        return response.content
+        return reply_text
         
-    except Exception as e:
-        print(f"ADK processing error: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("ADK processing error")
         return "I'm having trouble processing that right now. Can you try again?"
 
 @app.route('/message', methods=['POST'])
@@ -184,17 +616,69 @@ def reply():
     media_url = request.form.get('MediaUrl0')
     media_content_type = request.form.get('MediaContentType0')
     
-    print(f'{sender} sent: "{message}"')
-    print(f'Media URL: {media_url}')
-    print(f'Media Content Type: {media_content_type}')
+    message_sid = request.form.get('MessageSid')
+    request_id = message_sid or uuid.uuid4().hex
     
     # Get clean phone number
     phone_number = get_clean_phone_number(sender)
     
+    with request_context(request_id, phone_number):
+        logger.debug("Message received", extra={
+            'body': message,
+            'media_url': media_url,
+            'media_type': media_content_type
+        })
+        
+        started = time.perf_counter()
+        try:
+            with timed_stage('request'):
+                return handle_once(message_sid, sender, message, media_url, media_content_type, phone_number)
+        finally:
+            logger.info("Request handled", extra={
+                'kind': 'image' if media_url else 'text',
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+                'stages': stage_timings()
+            })
+
+def handle_once(message_sid, sender, message, media_url, media_content_type, phone_number):
+    """Handle a delivery, or answer a Twilio retry of it with the TwiML already returned."""
+    if message_sid:
+        outcome, response = deliveries.begin(message_sid)
+        if outcome == IN_FLIGHT:
+            # The first delivery is still being handled; wait for its answer rather than redo it
+            with timed_stage('duplicate_wait'):
+                response = deliveries.wait(message_sid)
+            if response is None:
+                outcome, response = deliveries.begin(message_sid)
+            else:
+                outcome = DONE
+        if outcome == DONE:
+            logger.info("Duplicate delivery answered from the idempotency store")
+            metrics.inc('duplicate_deliveries_total')
+            return response
+        if outcome == IN_FLIGHT:
+            logger.warning("Duplicate delivery still in flight")
+            return Response('', status=503, headers={'Retry-After': '1'})
+    
+    try:
+        # Load the user's record once and flush it once for the whole request
+        with user_manager.unit_of_work(sender):
+            response = handle_message(sender, message, media_url, media_content_type, phone_number)
+    except BaseException:
+        if message_sid:
+            deliveries.abandon(message_sid)
+        raise
+    if message_sid:
+        deliveries.complete(message_sid, response)
+    return response
+
+def handle_message(sender, message, media_url, media_content_type, phone_number):
+    """Route an incoming message through triage or to the ADK agent."""
     # Check if user exists
     if not user_manager.user_exists(sender):
         # Create new user and start triage
-        print(f"New user detected: {phone_number}")
+        logger.info("New user detected")
+        metrics.inc('messages_total', kind='new_user')
         user_manager.create_user(sender)
         return respond(TRIAGE_QUESTIONS[0])
     
@@ -203,11 +687,17 @@ def reply():
     
     # Handle triage process
     if not user_data['triage_completed']:
+        metrics.inc('messages_total', kind='triage')
         if message:  # Only process text responses during triage
-            user_data = user_manager.update_triage_response(sender, message)
-            
-            # Add triage response to message history
-            user_manager.add_message(sender, 'text', message)
+            with timed_stage('triage_step'):
+                user_data = user_manager.update_triage_response(sender, message)
+                
+                # Add triage response to message history
+                message_entry = user_manager.add_message(sender, 'text', message)
+                if user_data['triage_completed']:
+                    # Triage answers never join a burst sent to the agent
+                    user_data['burst_claimed_through'] = message_entry['timestamp']
+                    user_manager.save_user(sender, user_data)
             
             step = user_data['current_triage_step']
             if step < len(TRIAGE_QUESTIONS):
@@ -225,8 +715,10 @@ def reply():
     
     # Handle regular messages after triage is complete
     if media_url:
+        metrics.inc('messages_total', kind='image')
         return handle_image_message(sender, message, media_url, media_content_type, phone_number)
     elif message:
+        metrics.inc('messages_total', kind='text')
         return handle_text_message(sender, message, phone_number)
     else:
         return respond("Hello! Send me an image or describe your health concern.")
@@ -234,82 +726,178 @@ def reply():
 def handle_text_message(sender, message, phone_number):
     """Handle regular text messages with ADK agent."""
     # Add message to user history
-    user_manager.add_message(sender, 'text', message)
+    message_entry = user_manager.add_message(sender, 'text', message)
+    
+    # Flush the record before the agent runs, since its tools write to it too
+    user_manager.get_adk_conversation_id(sender)
+    user_manager.commit()
+    
+    if BURST_WINDOW_SECONDS > 0:
+        return schedule_burst_reply(sender, message, message_entry)
+    return schedule_reply(sender, generate_text_reply, sender, message, message_entry)
+
+def schedule_burst_reply(sender, message, message_entry):
+    """Hold a text message back for more of the same burst, then schedule its reply.
+
+    The message waits on a timer, not on a reply worker. A later message
+    from the same user takes its place straight away, and the last
+    message of the burst is answered for all of them.
+    """
+    if ASYNC_REPLIES:
+        submit = functools.partial(submit_reply, sender, generate_text_reply, sender, message, message_entry)
+    else:
+        submit = functools.partial(reply_scheduler.submit, sender, generate_text_reply, sender, message,
+                                   message_entry)
+    waiting = burst_debouncer.debounce(sender, BURST_WINDOW_SECONDS, BURST_MAX_SECONDS, submit)
+    if ASYNC_REPLIES:
+        waiting.add_done_callback(functools.partial(burst_scheduled, sender))
+        return acknowledge()
     
-    # Process with ADK agent
     try:
-        adk_response = asyncio.run(process_with_adk_agent(sender, message))
-        return respond(adk_response)
-    except Exception as e:
-        print(f"Error in handle_text_message: {e}")
-        return respond("I'm having trouble processing your message. Please try again.")
+        with timed_stage('burst_wait'):
+            outcome = waiting.result()
+        if outcome == SUPERSEDED:
+            metrics.inc('messages_coalesced_total')
+            return acknowledge()
+        reply_text = outcome.result()
+    except SchedulerBusy:
+        logger.warning("Reply queue full")
+        return respond(BUSY_MESSAGE)
+    return acknowledge() if reply_text is None else respond(reply_text)
+
+def burst_scheduled(sender, waiting):
+    """Finish scheduling a held-back message once its wait is over, with ASYNC_REPLIES."""
+    try:
+        if waiting.result() == SUPERSEDED:
+            metrics.inc('messages_coalesced_total')
+    except SchedulerBusy:
+        logger.warning("Reply queue full")
+        send_whatsapp_message(sender, BUSY_MESSAGE)
+    except Exception:
+        logger.exception("Error scheduling reply")
+
+def collect_burst(sender, message_entry):
+    """Merge a message with the unanswered ones before it in its burst.
+
+    Returns None if a later message, e.g. one received by another
+    worker process, will send the reply instead.
+    """
+    contents = user_manager.claim_burst(sender, message_entry)
+    if contents is None:
+        metrics.inc('messages_coalesced_total')
+        logger.debug("Message left to a later one in the same burst")
+        return None
+    if len(contents) > 1:
+        logger.info("Coalesced burst of messages", extra={'messages': len(contents)})
+    return '\n'.join(contents)
+
+def generate_text_reply(sender, message, message_entry=None):
+    """Get the ADK agent's reply to a text message, or None if it was merged into a later one."""
+    try:
+        if BURST_WINDOW_SECONDS > 0 and message_entry is not None:
+            message = collect_burst(sender, message_entry)
+            if message is None:
+                return None
+        return agent_loop.run(process_with_adk_agent(sender, message))
+    except Exception:
+        logger.exception("Error in handle_text_message")
+        return "I'm having trouble processing your message. Please try again."
+
+def image_filename(message, media_content_type):
+    """Name an image after its caption, or the time it arrived; None if the type isn't supported."""
+    if message:
+        filename_base = safe_filename_stem(message)
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename_base = f"health_image_{timestamp}"
+    
+    # Determine file extension based on Twilio's MediaContentType0
+    if media_content_type == 'image/jpeg':
+        return f'{filename_base}.jpg'
+    elif media_content_type == 'image/png':
+        return f'{filename_base}.png'
+    elif media_content_type == 'image/gif':
+        return f'{filename_base}.gif'
+    return None
 
 def handle_image_message(sender, message, media_url, media_content_type, phone_number):
-    """Handle image messages."""
+    """Record an image message, then download it and reply on the user's worker."""
+    filename = image_filename(message, media_content_type)
+    if filename is None:
+        return respond(f'The file type "{media_content_type}" is not supported. Please send JPEG, PNG, or GIF images.')
+    
+    # Saved before Twilio gets its response, since it won't deliver the message again
+    message_entry = user_manager.add_message(
+        sender,
+        'image',
+        message if message else 'Image received',
+        media_url=media_url,
+        media_type=media_content_type
+    )
+    
+    # Flush the record before the agent runs, since its tools write to it too
+    user_manager.get_adk_conversation_id(sender)
+    user_manager.commit()
+    return schedule_reply(sender, process_image_message, sender, message, message_entry, filename, phone_number)
+
+def process_image_message(sender, message, message_entry, filename, phone_number):
+    """Download and save a recorded image message, then build the reply text."""
+    filename_base = os.path.splitext(filename)[0]
     try:
-        # Download image with Twilio authentication
-        r = requests.get(media_url, auth=HTTPBasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
-        r.raise_for_status()
-        
-        # Use filename from message, or default with timestamp
-        if message:
-            filename_base = message
-        else:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename_base = f"health_image_{timestamp}"
+        # Stream the image with Twilio authentication, then file it by content hash
+        with timed_stage('media_download'):
+            download = media_downloader.download(message_entry['media_url'], media_store.tmp_dir)
+        with timed_stage('media_store'):
+            filename = media_store.store(phone_number, download, filename)
         
-        # Determine file extension based on Twilio's MediaContentType0
-        if media_content_type == 'image/jpeg':
-            filename = f'{filename_base}.jpg'
-        elif media_content_type == 'image/png':
-            filename = f'{filename_base}.png'
-        elif media_content_type == 'image/gif':
-            filename = f'{filename_base}.gif'
-        else:
-            return respond(f'The file type "{media_content_type}" is not supported. Please send JPEG, PNG, or GIF images.')
-        
-        # Create directory if it doesn't exist
-        user_dir = f'uploads/{phone_number}'
-        if not os.path.exists(user_dir):
-            os.makedirs(user_dir, exist_ok=True)
-        
-        # Save the image
-        full_filename = os.path.join(user_dir, filename)
-        with open(full_filename, 'wb') as f:
-            f.write(r.content)
-        
-        # Add image message to user history
-        user_manager.add_message(
-            sender, 
-            'image', 
-            message if message else 'Image received',
-            media_url=media_url,
-            media_type=media_content_type,
-            filename=filename
-        )
+        # Point the message in the user's history at the saved file
+        user_manager.attach_media(sender, message_entry, filename, download.sha256)
         
         # Get user data for personalized response
         user_data = user_manager.load_user(sender)
         name = user_data['profile']['name'] if user_data and user_data['profile']['name'] else 'there'
         
-        # If there's text with the image, process it with ADK agent
-        if message.strip():
-            try:
-                adk_response = asyncio.run(process_with_adk_agent(sender, f"Image saved: {message}"))
-                return respond(f"Thank you {name}! I've received your image. {adk_response}")
-            except Exception as e:
-                print(f"Error processing image with ADK: {e}")
-                return respond(f"Thank you {name}! I've received your image ({filename_base}). Can you describe what you're showing me?")
-        else:
-            return respond(f"Thank you {name}! I've received your image ({filename_base}). Can you describe what you're showing me?")
+        # Shrink the photo in the worker pool so the agent gets a compact copy
+        try:
+            with timed_stage('image_preprocess'):
+                prepared = image_preprocessor.prepare(media_store.blob_path(download.sha256))
+            logger.info("Preprocessed image", extra={
+                'original_bytes': prepared.original_bytes,
+                'derived_bytes': prepared.derived_bytes,
+                'bytes_saved': prepared.bytes_saved,
+                'seconds': round(prepared.seconds, 4),
+                'cached': prepared.cached
+            })
+        except Exception:
+            logger.exception("Error preprocessing image")
+            return f"Thank you {name}! I've received your image ({filename_base}). Can you describe what you're showing me?"
+        
+        # Send the image, and any text that came with it, to the ADK agent
+        agent_message = f"Image saved: {message}" if message.strip() else "Image saved"
+        try:
+            adk_response = agent_loop.run(process_with_adk_agent(sender, agent_message, images=[prepared]))
+            return f"Thank you {name}! I've received your image. {adk_response}"
+        except Exception:
+            logger.exception("Error processing image with ADK")
+            return f"Thank you {name}! I've received your image ({filename_base}). Can you describe what you're showing me?"
         
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error downloading image: {e}")
-        print(f"Response content: {r.text if 'r' in locals() else 'No response'}")
-        return respond('Sorry, there was an authentication error accessing your image.')
-    except Exception as e:
-        print(f"Error processing image: {e}")
-        return respond('Sorry, there was an error processing your image.')
+        logger.warning("HTTP error downloading image", extra={
+            'status': e.response.status_code if e.response is not None else None,
+            'response': e.response.text[:500] if e.response is not None else None
+        })
+        return 'Sorry, there was an authentication error accessing your image.'
+    except MediaTooLarge as e:
+        logger.warning("Image too large", extra={'error': str(e)})
+        return 'Sorry, that image is too large. Please send a smaller one.'
+    except Exception:
+        logger.exception("Error processing image")
+        return 'Sorry, there was an error processing your image.'
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Per-stage latency histograms and counters, merged across workers."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/', methods=['GET'])
 def index():
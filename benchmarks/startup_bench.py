@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Worker startup benchmark: import time and first-request latency.
+
+Starts a fresh Python process for every run, as a restarted worker
+would be, and times in it:
+
+- import_app: `import app`;
+- warm_up: app.warm_up(), as gunicorn.conf.py calls it in each worker
+  (with --warm-up only);
+- first_request: the first /message of a new user (a triage question);
+- first_agent_request: the first message that goes to the agent, once
+  the user has finished triage.
+
+The agent runs for real up to the model call, which is stubbed out, so
+first_agent_request includes importing ADK and building the agent and
+its runner unless the worker was warmed up. Reports the median and
+worst run of each; results can be saved with --save and checked
+against a saved run with --compare, like webhook_bench.py.
+
+Examples:
+    python benchmarks/startup_bench.py
+    python benchmarks/startup_bench.py --warm-up --runs 10
+    python benchmarks/startup_bench.py --save startup.json
+    python benchmarks/startup_bench.py --compare startup.json --max-regression 0.3
+    python benchmarks/startup_bench.py --top-imports 15
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHONE_NUMBER = 'whatsapp:+447700900123'
+TRIAGE_ANSWERS = ['Sam', '34', 'Leeds', 'More energy in the afternoons']
+
+TIMINGS = ('import_app', 'warm_up', 'first_request', 'first_agent_request')
+
+
+def child_environment():
+    env = dict(os.environ)
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.setdefault('TWILIO_ACCOUNT_SID', 'ACbenchmark')
+    env.setdefault('TWILIO_AUTH_TOKEN', 'benchmark')
+    env.setdefault('WEATHER_PROVIDER', 'stub')
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+
+def measure_worker(warm_up, output_path):
+    """Run inside a fresh process started by run_once(); writes the timings to output_path."""
+    timings = {}
+
+    started = time.perf_counter()
+    import app as webhook
+    timings['import_app'] = time.perf_counter() - started
+
+    # Build the real runner, but never call the model
+    build_runner = webhook.get_agent_runner
+
+    async def no_model(**kwargs):
+        return
+        yield
+
+    def get_agent_runner():
+        runner = build_runner()
+        runner.run_async = no_model
+        return runner
+    webhook.get_agent_runner = get_agent_runner
+
+    if warm_up:
+        started = time.perf_counter()
+        webhook.warm_up()
+        timings['warm_up'] = time.perf_counter() - started
+
+    client = webhook.app.test_client()
+
+    def post(body, sid):
+        started = time.perf_counter()
+        response = client.post('/message', data={'From': PHONE_NUMBER, 'Body': body, 'MessageSid': sid})
+        if response.status_code != 200:
+            raise RuntimeError(f"/message returned {response.status_code}")
+        return time.perf_counter() - started
+
+    timings['first_request'] = post('Hi', 'SMstartup0')
+    for index, answer in enumerate(TRIAGE_ANSWERS, start=1):
+        post(answer, f'SMstartup{index}')
+    timings['first_agent_request'] = post('What should I eat for breakfast?', 'SMstartupagent')
+
+    with open(output_path, 'w') as f:
+        json.dump(timings, f)
+
+
+def run_once(warm_up):
+    """Time one cold worker in a new process and working directory."""
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    output_path = os.path.join(workdir, 'timings.json')
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--child', output_path]
+        if warm_up:
+            command.append('--warm-up')
+        subprocess.run(command, cwd=workdir, env=child_environment(), check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(output_path) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def top_imports(count):
+    """The modules that take longest to import with `import app`, from -X importtime."""
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    try:
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=workdir,
+                                env=child_environment(), check=True, capture_output=True, text=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative) / 1e6, name.strip()))
+    # Only count top-level packages once, at their outermost import; app is the total and
+    # site is interpreter startup
+    seen = {'app', 'site'}
+    heaviest = []
+    for seconds, name in sorted(modules, reverse=True):
+        package = name.split('.')[0]
+        if package not in seen:
+            seen.add(package)
+            heaviest.append((seconds, name))
+    return heaviest[:count]
+
+
+def run(args):
+    runs = [run_once(args.warm_up) for _ in range(args.runs)]
+    report = {'warm_up': args.warm_up, 'runs': args.runs, 'timings': {}}
+    for name in TIMINGS:
+        values = sorted(timing[name] for timing in runs if name in timing)
+        if values:
+            report['timings'][name] = {'median': values[len(values) // 2], 'max': values[-1]}
+    return report
+
+
+def print_report(report):
+    mode = 'warmed up' if report['warm_up'] else 'cold'
+    print(f"{report['runs']} fresh workers, {mode}\n")
+    print(f"{'timing':<22}{'median ms':>12}{'max ms':>12}")
+    for name, stats in report['timings'].items():
+        print(f"{name:<22}{stats['median'] * 1000:>12.1f}{stats['max'] * 1000:>12.1f}")
+
+
+def compare(report, baseline_path, max_regression):
+    """Return the list of median timings that got worse than the baseline by more than max_regression."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, stats in report['timings'].items():
+        previous = baseline['timings'].get(name)
+        if previous and previous['median'] and stats['median'] > previous['median'] * (1 + max_regression):
+            regressions.append(f"{name}: {previous['median'] * 1000:.1f} ms -> {stats['median'] * 1000:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark worker import time and first-request latency')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh worker processes to time (default 5)')
+    parser.add_argument('--warm-up', action='store_true', help='Call app.warm_up() before the first request')
+    parser.add_argument('--top-imports', type=int, default=0, metavar='N',
+                        help='Also list the N slowest packages imported by `import app`')
+    parser.add_argument('--save', help='Write the results as JSON to this path')
+    parser.add_argument('--compare', help='Baseline JSON from an earlier --save to check against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed slowdown of any median against --compare (default 0.2 = 20%%)')
+    parser.add_argument('--child', metavar='OUTPUT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure_worker(args.warm_up, args.child)
+        return
+
+    report = run(args)
+    print_report(report)
+
+    if args.top_imports:
+        print("\nSlowest imports:")
+        for seconds, name in top_imports(args.top_imports):
+            print(f"  {name:<40} {seconds * 1000:>8.1f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.max_regression)
+        if regressions:
+            print(f"\nRegressions beyond {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.max_regression:.0%} against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Event loop latency while the agent's profile tools are running.
+
+Runs a heartbeat coroutine that wakes every --tick-ms and records how
+late each wake-up is, then issues rounds of concurrent tool calls, the
+way ADK runs the function calls of one model step, against a storage
+backend slowed down by --io-delay-ms per read. Each round is run twice:
+
+- blocking: the tools' storage reads done directly on the event loop,
+  as the synchronous tools used to;
+- async: the agent's async tools, which move storage I/O to threads.
+
+Reports heartbeat lag (p50/p99/max) and the wall time per round for
+both. With async tools the lag should stay around a tick whatever the
+I/O delay, and a round should take about one delay rather than one per
+call. Exits non-zero if the async p99 lag exceeds --max-lag-ms.
+
+Examples:
+    python benchmarks/tool_loop_latency.py
+    python benchmarks/tool_loop_latency.py --calls 8 --io-delay-ms 100 --rounds 10
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHONE_NUMBER = 'whatsapp:+447700900999'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def heartbeat(tick, lags, stop):
+    """Sleep for tick seconds at a time, recording how late each wake-up is."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append(time.perf_counter() - started - tick)
+
+
+def slow_down(storage, delay):
+    """Make every read of storage take at least delay seconds, like a slow disk."""
+    for name in ('load', 'read_messages'):
+        original = getattr(storage, name)
+
+        def slow(*args, _original=original, **kwargs):
+            time.sleep(delay)
+            return _original(*args, **kwargs)
+        setattr(storage, name, slow)
+
+
+async def blocking_round(agent, calls):
+    """What the synchronous tools did: storage reads on the loop itself."""
+    async def call():
+        turn = agent.AgentTurn(PHONE_NUMBER)
+        turn.storage.read_messages(PHONE_NUMBER, agent.CONTEXT_RECENT_MESSAGES)
+    await asyncio.gather(*(call() for _ in range(calls)))
+
+
+async def async_round(agent, calls):
+    """The async tools, with reads in worker threads."""
+    tools = (agent.read_all_json, agent.read_message_history, agent.read_json)
+    arguments = ((), (10,), ('name',))
+    await asyncio.gather(*(tools[i % len(tools)](*arguments[i % len(tools)]) for i in range(calls)))
+
+
+async def measure(run_round, agent, args):
+    lags = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(heartbeat(args.tick_ms / 1000, lags, stop))
+    durations = []
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        await run_round(agent, args.calls)
+        durations.append(time.perf_counter() - started)
+        await asyncio.sleep(args.tick_ms / 1000)
+    stop.set()
+    await ticker
+    lags.sort()
+    return {
+        'lag_p50': percentile(lags, 0.5),
+        'lag_p99': percentile(lags, 0.99),
+        'lag_max': lags[-1] if lags else 0.0,
+        'round_mean': sum(durations) / len(durations),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='tool-loop-bench-')
+    original_dir = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    try:
+        from multi_tool_agent import agent
+        from storage import get_storage
+
+        storage = get_storage()
+        storage.save(PHONE_NUMBER, {
+            'phone_number': PHONE_NUMBER,
+            'profile': {'name': 'Sam', 'age': '34', 'location': 'Leeds', 'health_concern': 'energy'},
+            'health_data': {},
+            'triage_completed': True,
+            'message_count': 0
+        })
+        for index in range(50):
+            storage.append_message(PHONE_NUMBER, {'timestamp': f'2026-01-01T00:00:{index:02d}', 'type': 'text',
+                                                  'content': f'message {index}'})
+        slow_down(storage, args.io_delay_ms / 1000)
+
+        async def main():
+            # Every tool call in a round works on the same user, as in one agent turn
+            turn = await asyncio.to_thread(agent.AgentTurn, PHONE_NUMBER)
+            with agent.agent_turn(turn):
+                return {
+                    'blocking': await measure(blocking_round, agent, args),
+                    'async': await measure(async_round, agent, args),
+                }
+        return asyncio.run(main())
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event loop latency while agent tools run')
+    parser.add_argument('--calls', type=int, default=4, help='Concurrent tool calls per round (default 4)')
+    parser.add_argument('--rounds', type=int, default=20, help='Rounds of tool calls (default 20)')
+    parser.add_argument('--io-delay-ms', type=float, default=50, help='Added latency of each storage read (default 50)')
+    parser.add_argument('--tick-ms', type=float, default=5, help='Heartbeat interval (default 5)')
+    parser.add_argument('--max-lag-ms', type=float, default=25,
+                        help='Fail if the async p99 heartbeat lag is above this (default 25)')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(f"{args.calls} concurrent tool calls per round, {args.io_delay_ms:.0f} ms per storage read\n")
+    print(f"{'tools':<10}{'lag p50 ms':>12}{'lag p99 ms':>12}{'lag max ms':>12}{'round ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['lag_p50'] * 1000:>12.2f}{result['lag_p99'] * 1000:>12.2f}"
+              f"{result['lag_max'] * 1000:>12.2f}{result['round_mean'] * 1000:>10.1f}")
+
+    if results['async']['lag_p99'] * 1000 > args.max_lag_ms:
+        print(f"\nAsync tools let loop lag reach {results['async']['lag_p99'] * 1000:.1f} ms "
+              f"(limit {args.max_lag_ms:.0f} ms)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Load generator and benchmark for the /message webhook.
+
+Runs the app in-process on a local port with the agent call stubbed out by
+a configurable latency distribution, serves test photos from a local
+HTTP server, and drives /message with simulated users. Each user goes
+through triage and then sends a mix of text and image messages; users
+run in parallel up to --concurrency, each user's messages in order.
+
+Reports throughput and p50/p95/p99 latency per message type, plus the
+mean time spent in each stage from the app's own metrics. Results can
+be saved with --save and checked against a saved run with --compare.
+
+Examples:
+    python benchmarks/webhook_bench.py --users 50 --concurrency 10
+    python benchmarks/webhook_bench.py --storage sqlite --agent-latency lognormal:400,0.6
+    python benchmarks/webhook_bench.py --save baseline.json
+    python benchmarks/webhook_bench.py --compare baseline.json --max-regression 0.2
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRIAGE_ANSWERS = ['Sam', '34', 'Leeds', 'I get tired after lunch']
+TEXT_MESSAGES = [
+    'What should I eat for breakfast?',
+    'I had pasta for lunch and felt sleepy after',
+    'Is coffee in the afternoon a bad idea?',
+    'I slept badly last night',
+    'Any ideas for a quick high-protein dinner?',
+]
+
+
+def parse_latency(spec):
+    """Turn 'fixed:MS', 'uniform:LOW,HIGH' or 'lognormal:MEDIAN,SIGMA' into a sampler in seconds."""
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',')] if args else []
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median / 1000
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution: {spec}")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def make_images(count, width, height):
+    """Generate distinct JPEG photos to serve as media."""
+    from PIL import Image
+    images = []
+    for index in range(count):
+        image = Image.effect_noise((width, height), 40 + index).convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            index = int(self.path.rsplit('/', 1)[-1].split('.')[0])
+            payload = self.server.images[index]
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Serves the generated photos at /media/<n>.jpg."""
+
+    daemon_threads = True
+
+    def __init__(self, images):
+        super().__init__(('127.0.0.1', 0), MediaHandler)
+        self.images = images
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, index):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/media/{index}.jpg'
+
+
+def user_script(user_index, messages, image_ratio, image_count, rng):
+    """The (type, form) requests one simulated user sends, in order."""
+    sender = f'whatsapp:+4470{user_index:08d}'
+    script = [('triage', {'From': sender, 'Body': 'Hi'})]
+    script += [('triage', {'From': sender, 'Body': answer}) for answer in TRIAGE_ANSWERS]
+    for _ in range(messages):
+        if rng.random() < image_ratio:
+            form = {
+                'From': sender,
+                'Body': rng.choice(['my lunch', 'dinner', '']),
+                'MediaUrl0': rng.randrange(image_count),
+                'MediaContentType0': 'image/jpeg'
+            }
+            script.append(('image', form))
+        else:
+            script.append(('text', {'From': sender, 'Body': rng.choice(TEXT_MESSAGES)}))
+    # Every delivery has its own MessageSid, as it would from Twilio
+    for index, (_, form) in enumerate(script):
+        form['MessageSid'] = f'SM{user_index:08d}{index:06d}'
+    return script
+
+
+def start_app(args, workdir):
+    """Import the app inside workdir with a stubbed agent and serve it on a local port."""
+    from werkzeug.serving import make_server
+
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    os.environ['USER_STORAGE'] = args.storage
+    if not args.verbose:
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACbenchmark')
+    os.environ.setdefault('TWILIO_AUTH_TOKEN', 'benchmark')
+    os.environ.setdefault('TWILIO_WHATSAPP_NUMBER', '+10000000000')
+    os.environ.setdefault('WEATHER_PROVIDER', 'stub')
+
+    fake_twilio = None
+    if args.async_replies:
+        from fake_twilio import FakeTwilioServer
+        fake_twilio = FakeTwilioServer()
+        os.environ['ASYNC_REPLIES'] = '1'
+        os.environ['TWILIO_API_URL'] = fake_twilio.start()
+
+    import app as webhook
+    from multi_tool_agent import agent
+
+    sample_latency = parse_latency(args.agent_latency)
+
+    async def chat(conv_id, user_id, message, attachments):
+        await asyncio.sleep(sample_latency())
+        if random.random() < args.tool_write_ratio:
+            await agent.update_json('benchmark_note', message[:40])
+        return f'Stub reply to: {message}'
+
+    webhook.chat_with_agent = chat
+    # As gunicorn.conf.py does, so first-use imports don't show up in the percentiles
+    webhook.warm_up()
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, webhook.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return webhook, server, fake_twilio
+
+
+def run(args):
+    original_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='webhook-bench-')
+    print(f"Working directory: {workdir}")
+    try:
+        media_server = MediaServer(make_images(args.distinct_images, args.image_width, args.image_height))
+        webhook, server, fake_twilio = start_app(args, workdir)
+        base_url = f'http://127.0.0.1:{server.server_port}/message'
+
+        rng = random.Random(args.seed)
+        scripts = [user_script(index, args.messages, args.image_ratio, args.distinct_images, rng)
+                   for index in range(args.users)]
+
+        results = {}
+        results_lock = threading.Lock()
+        local = threading.local()
+
+        def run_user(script):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            for kind, form in script:
+                if 'MediaUrl0' in form:
+                    form = dict(form, MediaUrl0=media_server.url(form['MediaUrl0']))
+                started = time.perf_counter()
+                try:
+                    response = local.session.post(base_url, data=form, timeout=args.timeout)
+                    ok = response.status_code == 200
+                except requests.RequestException:
+                    ok = False
+                elapsed = time.perf_counter() - started
+                with results_lock:
+                    entry = results.setdefault(kind, {'latencies': [], 'errors': 0})
+                    entry['latencies'].append(elapsed)
+                    entry['errors'] += 0 if ok else 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(run_user, scripts))
+        wall_seconds = time.perf_counter() - started
+
+        drain_seconds = None
+        if fake_twilio is not None:
+            expected = sum(len(results.get(kind, {}).get('latencies', [])) for kind in ('text', 'image'))
+            fake_twilio.wait_for_messages(expected, timeout=args.timeout * 10)
+            drain_seconds = time.perf_counter() - started
+
+        _, _, histograms = webhook.metrics.collect()
+        stages = {dict(labels).get('stage') or dict(labels).get('tool'): value['sum'] / value['count']
+                  for (name, labels), value in histograms.items() if value['count']}
+
+        server.shutdown()
+        media_server.shutdown()
+        if fake_twilio is not None:
+            fake_twilio.stop()
+    finally:
+        os.chdir(original_dir)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'config': vars(args), 'wall_seconds': wall_seconds, 'drain_seconds': drain_seconds,
+              'types': {}, 'stages': stages}
+    total = 0
+    for kind, entry in sorted(results.items()):
+        latencies = sorted(entry['latencies'])
+        total += len(latencies)
+        report['types'][kind] = {
+            'count': len(latencies),
+            'errors': entry['errors'],
+            'throughput': len(latencies) / wall_seconds,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0
+        }
+    report['throughput'] = total / wall_seconds
+    return report
+
+
+def print_report(report):
+    print(f"\n{'type':<8} {'count':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, stats in report['types'].items():
+        print(f"{kind:<8} {stats['count']:>6} {stats['errors']:>6} {stats['throughput']:>8.1f} "
+              f"{stats['p50'] * 1000:>8.1f} {stats['p95'] * 1000:>8.1f} {stats['p99'] * 1000:>8.1f} "
+              f"{stats['max'] * 1000:>8.1f}")
+    print(f"\nTotal: {report['throughput']:.1f} req/s over {report['wall_seconds']:.2f}s")
+    if report['drain_seconds'] is not None:
+        print(f"All async replies delivered after {report['drain_seconds']:.2f}s")
+
+    print("\nMean time per stage:")
+    for stage, seconds in sorted(report['stages'].items(), key=lambda item: -item[1]):
+        print(f"  {stage:<20} {seconds * 1000:>8.2f} ms")
+
+
+def compare(report, baseline_path, max_regression):
+    """Return the list of percentiles that got worse than the baseline by more than max_regression."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for kind, stats in report['types'].items():
+        previous = baseline['types'].get(kind)
+        if previous is None:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            if previous[key] and stats[key] > previous[key] * (1 + max_regression):
+                regressions.append(f"{kind} {key}: {previous[key] * 1000:.1f} ms -> {stats[key] * 1000:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /message webhook')
+    parser.add_argument('--users', type=int, default=20, help='Simulated users (default 20)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Users sending at the same time (default 8)')
+    parser.add_argument('--messages', type=int, default=10, help='Messages per user after triage (default 10)')
+    parser.add_argument('--image-ratio', type=float, default=0.3, help='Share of messages that are images (default 0.3)')
+    parser.add_argument('--distinct-images', type=int, default=8, help='Different photos served (default 8)')
+    parser.add_argument('--image-width', type=int, default=1600)
+    parser.add_argument('--image-height', type=int, default=1200)
+    parser.add_argument('--agent-latency', default='lognormal:200,0.5',
+                        help="Stub agent latency: fixed:MS, uniform:LOW,HIGH or lognormal:MEDIAN_MS,SIGMA "
+                             "(default lognormal:200,0.5)")
+    parser.add_argument('--tool-write-ratio', type=float, default=0.3,
+                        help='Share of agent turns that write to the profile (default 0.3)')
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--async-replies', action='store_true', help='Run with ASYNC_REPLIES against a fake Twilio API')
+    parser.add_argument('--timeout', type=float, default=60, help='Per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='Write the results as JSON to this path')
+    parser.add_argument('--compare', help='Baseline JSON from an earlier --save to check against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed slowdown of any percentile against --compare (default 0.2 = 20%%)')
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory with the run's data")
+    parser.add_argument('--verbose', action='store_true', help="Show the app's logs and the server's request log")
+    args = parser.parse_args()
+    parse_latency(args.agent_latency)
+
+    report = run(args)
+    print_report(report)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    if args.compare:
+        regressions = compare(report, args.compare, args.max_regression)
+        if regressions:
+            print(f"\nRegressions beyond {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.max_regression:.0%} against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+A process-wide asyncio event loop for running agent calls from Flask.
+
+Flask handlers are synchronous, so each agent call used to spin up and
+tear down its own loop with asyncio.run(). That threw away the model
+client's pooled connections every time. Instead, one loop runs forever
+in a daemon thread and handlers submit coroutines to it, so calls from
+several requests share connections and run concurrently.
+"""
+
+import os
+import asyncio
+import threading
+import concurrent.futures
+
+
+class BackgroundLoop:
+    """An event loop running in its own daemon thread."""
+
+    def __init__(self, name='agent-loop'):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The running loop, started on first use (and again after a fork)."""
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    self._start()
+        return self._loop
+
+    def _start(self):
+        """Start a fresh loop in a new thread and wait until it runs."""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, name=self.name, daemon=True)
+        thread.start()
+        ready.wait()
+        self._loop = loop
+        self._thread = thread
+        self._pid = os.getpid()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the loop and block the calling thread for its result."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("BackgroundLoop.run() called from the loop's own thread")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        """Stop the loop and wait for its thread to finish."""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+
+# Shared by every request handler and background worker in this process
+agent_loop = BackgroundLoop()
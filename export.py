@@ -0,0 +1,279 @@
+"""
+Bulk export of user profiles and messages for analytics.
+
+Writes users.<format> and messages.<format> (JSONL or CSV, optionally
+compressed) into an output directory. For the json backend the user
+documents and message logs are parsed by a pool of worker processes,
+each handling a chunk of users and handing back finished lines, and at
+most a few chunks are in flight at once so memory use stays flat
+however many users there are. Other backends are streamed from the
+storage interface in this process.
+
+Messages compacted into the archive are included; archive segments
+that end before the watermark aren't opened.
+
+Incremental runs pass a watermark: only messages newer than it, and
+users whose record has been saved since (updated_at, or created_at and
+last_message_at for records saved before updated_at existed), are
+exported. Each run
+exports messages up to a cutoff a few seconds in the past, so messages
+still being written can't be skipped, and returns that cutoff as the
+next run's watermark.
+"""
+
+import io
+import os
+import csv
+import bz2
+import json
+import gzip
+import lzma
+import tempfile
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import DATA_DIR, JsonFileStorage, MessageArchive, clean_phone_number, timestamp_key
+
+# Messages younger than this are left for the next run
+EXPORT_SETTLE_SECONDS = 5
+
+# Where incremental exports keep their watermark
+EXPORT_STATE_PATH = os.path.join(DATA_DIR, 'export_state.json')
+
+USER_FIELDS = ('user_key', 'phone_number', 'created_at', 'name', 'age', 'location', 'health_concern',
+               'triage_completed', 'message_count', 'last_message_at', 'updated_at', 'profile', 'health_data')
+MESSAGE_FIELDS = ('user_key', 'timestamp', 'type', 'content', 'media_type', 'saved_filename', 'media_sha256')
+
+COMPRESSORS = {
+    'none': ('', open),
+    'gzip': ('.gz', gzip.open),
+    'bz2': ('.bz2', bz2.open),
+    'xz': ('.xz', lzma.open),
+}
+
+# Chunks of users handed to each worker at a time
+CHUNK_SIZE = 200
+
+
+def user_row(user_key, user_data):
+    """Flatten a user record into an export row."""
+    profile = user_data.get('profile', {})
+    return {
+        'user_key': user_key,
+        'phone_number': user_data.get('phone_number'),
+        'created_at': user_data.get('created_at'),
+        'name': profile.get('name', ''),
+        'age': profile.get('age', ''),
+        'location': profile.get('location', ''),
+        'health_concern': profile.get('health_concern', ''),
+        'triage_completed': bool(user_data.get('triage_completed')),
+        'message_count': user_data.get('message_count', 0),
+        'last_message_at': user_data.get('last_message_at'),
+        'updated_at': user_data.get('updated_at'),
+        'profile': profile,
+        'health_data': user_data.get('health_data', {}),
+    }
+
+
+def message_row(user_key, message_entry):
+    """Flatten a message into an export row."""
+    return {
+        'user_key': user_key,
+        'timestamp': message_entry.get('timestamp'),
+        'type': message_entry.get('type'),
+        'content': message_entry.get('content'),
+        'media_type': message_entry.get('media_type'),
+        'saved_filename': message_entry.get('saved_filename'),
+        'media_sha256': message_entry.get('media_sha256'),
+    }
+
+
+def user_changed(user_data, since):
+    """Whether a user should be in an incremental export after since."""
+    if since is None:
+        return True
+    return any((user_data.get(key) or '') > since for key in ('updated_at', 'created_at', 'last_message_at'))
+
+
+def message_in_window(message_entry, since, cutoff):
+    timestamp = message_entry.get('timestamp') or ''
+    return (since is None or timestamp > since) and timestamp <= cutoff
+
+
+def render(rows, fields, fmt):
+    """Serialise rows as JSONL or CSV text."""
+    if fmt == 'jsonl':
+        return ''.join(json.dumps(row) + '\n' for row in rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([json.dumps(row[field]) if isinstance(row[field], dict) else row[field]
+                         for field in fields])
+    return buffer.getvalue()
+
+
+def _archived_messages(archive_root, user_key, since):
+    """Yield archived messages, skipping segments that end before since."""
+    since_key = timestamp_key(since) if since else None
+    for path, _, last_key, _ in MessageArchive(archive_root).segments(user_key):
+        if since_key is None or last_key > since_key:
+            yield from MessageArchive.read_segment(path)
+
+
+def export_user_files(paths, since, cutoff, fmt, archive_root):
+    """Parse a chunk of user documents and their logs; runs in a worker process.
+
+    Returns (users text, messages text, user count, message count).
+    """
+    users = []
+    messages = []
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                user_data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        user_key = os.path.basename(path)[len('user_'):-len('.json')]
+        if user_changed(user_data, since):
+            users.append(user_row(user_key, user_data))
+
+        # Records from before the message log still embed their history
+        if 'messages' in user_data:
+            entries = user_data['messages']
+        else:
+            entries = _read_log(path[:-len('.json')] + '.messages.jsonl')
+
+        # Compacted messages come first; skip any still left in the live log
+        newest_archived = MessageArchive(archive_root).newest_key(user_key)
+        for message_entry in _archived_messages(archive_root, user_key, since):
+            if message_in_window(message_entry, since, cutoff):
+                messages.append(message_row(user_key, message_entry))
+        for message_entry in entries:
+            if newest_archived is not None and timestamp_key(message_entry.get('timestamp')) <= newest_archived:
+                continue
+            if message_in_window(message_entry, since, cutoff):
+                messages.append(message_row(user_key, message_entry))
+
+    return (render(users, USER_FIELDS, fmt), render(messages, MESSAGE_FIELDS, fmt),
+            len(users), len(messages))
+
+
+def _read_log(log_path):
+    """Yield the messages in a log file, one line at a time."""
+    try:
+        with open(log_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    except FileNotFoundError:
+        return
+
+
+def _iter_chunks_from_files(data_dir, archive_root, since, cutoff, fmt, workers):
+    """Yield export_user_files results for every user file, in parallel with bounded look-ahead."""
+    paths = sorted(
+        entry.path for entry in os.scandir(data_dir)
+        if entry.name.startswith('user_') and entry.name.endswith('.json')
+    )
+    chunks = [paths[i:i + CHUNK_SIZE] for i in range(0, len(paths), CHUNK_SIZE)]
+    if workers == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield export_user_files(chunk, since, cutoff, fmt, archive_root)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(export_user_files, chunk, since, cutoff, fmt, archive_root))
+            # Keep only a couple of chunks per worker waiting to be written
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def _iter_chunks_from_storage(storage, since, cutoff, fmt):
+    """Yield export chunks by streaming any storage backend in this process."""
+    users = []
+    messages = []
+    for user_data in storage.iter_users():
+        user_key = clean_phone_number(user_data['phone_number'])
+        if user_changed(user_data, since):
+            users.append(user_row(user_key, user_data))
+        for message_entry in storage.read_messages(user_data['phone_number']):
+            if message_in_window(message_entry, since, cutoff):
+                messages.append(message_row(user_key, message_entry))
+        if len(users) + len(messages) >= CHUNK_SIZE * 10:
+            yield render(users, USER_FIELDS, fmt), render(messages, MESSAGE_FIELDS, fmt), len(users), len(messages)
+            users, messages = [], []
+    yield render(users, USER_FIELDS, fmt), render(messages, MESSAGE_FIELDS, fmt), len(users), len(messages)
+
+
+def export(storage, output_dir, fmt='jsonl', compression='none', since=None, workers=None):
+    """Export users and messages into output_dir.
+
+    Returns a dict with the paths written, the number of users and
+    messages exported, and the watermark to pass as since next time.
+    """
+    if fmt not in ('jsonl', 'csv'):
+        raise ValueError(f"Unknown export format: {fmt}")
+    suffix, opener = COMPRESSORS[compression]
+    cutoff = (datetime.now() - timedelta(seconds=EXPORT_SETTLE_SECONDS)).isoformat()
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = {name: os.path.join(output_dir, f'{name}.{fmt}{suffix}') for name in ('users', 'messages')}
+    tmp_paths = {}
+    files = {}
+    try:
+        for name, path in paths.items():
+            fd, tmp_paths[name] = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=output_dir)
+            os.close(fd)
+            files[name] = opener(tmp_paths[name], 'wt', newline='')
+        if fmt == 'csv':
+            csv.writer(files['users']).writerow(USER_FIELDS)
+            csv.writer(files['messages']).writerow(MESSAGE_FIELDS)
+
+        if isinstance(storage, JsonFileStorage):
+            chunks = _iter_chunks_from_files(storage.data_dir, storage.archive.root, since, cutoff, fmt,
+                                             workers or os.cpu_count() or 1)
+        else:
+            chunks = _iter_chunks_from_storage(storage, since, cutoff, fmt)
+
+        user_count = 0
+        message_count = 0
+        for users_text, messages_text, users, messages in chunks:
+            files['users'].write(users_text)
+            files['messages'].write(messages_text)
+            user_count += users
+            message_count += messages
+
+        for name in paths:
+            files[name].close()
+            os.replace(tmp_paths[name], paths[name])
+    except BaseException:
+        for name, tmp_path in tmp_paths.items():
+            if name in files:
+                files[name].close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    return {'paths': paths, 'users': user_count, 'messages': message_count, 'watermark': cutoff}
+
+
+def load_watermark(state_path):
+    """Read the watermark saved by the last export, if any."""
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f).get('watermark')
+    except FileNotFoundError:
+        return None
+
+
+def save_watermark(state_path, watermark):
+    """Remember where this export stopped."""
+    directory = os.path.dirname(state_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(state_path, 'w') as f:
+        json.dump({'watermark': watermark, 'exported_at': datetime.now().isoformat()}, f)
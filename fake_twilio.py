@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Twilio Messages REST API.
+
+Accepts the same POST /2010-04-01/Accounts/<sid>/Messages.json requests as
+api.twilio.com and records them instead of sending anything. Point the
+app at it with TWILIO_API_URL=http://localhost:<port>.
+"""
+
+import json
+import time
+import uuid
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 4 or parts[1] != 'Accounts' or parts[3] != 'Messages.json':
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        message = {
+            'sid': f'SM{uuid.uuid4().hex}',
+            'account_sid': parts[2],
+            'from': form.get('From'),
+            'to': form.get('To'),
+            'body': form.get('Body'),
+            'status': 'queued'
+        }
+        self.server.record(message)
+
+        payload = json.dumps(message).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FakeTwilioServer(ThreadingHTTPServer):
+    """Fake Messages API that keeps every message it receives."""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, verbose=False):
+        super().__init__((host, port), FakeTwilioHandler)
+        self.verbose = verbose
+        self.messages = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL to use as TWILIO_API_URL."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def record(self, message):
+        """Store a received message and wake up anyone waiting for it."""
+        with self._condition:
+            self.messages.append(message)
+            self._condition.notify_all()
+        if self.verbose:
+            print(f"{message['to']} <- {message['body']}")
+
+    def wait_for_messages(self, count, timeout=10):
+        """Block until at least count messages arrived; return them."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while len(self.messages) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return list(self.messages)
+
+    def start(self):
+        """Serve in a background thread and return the base URL."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Twilio Messages API')
+    parser.add_argument('--port', type=int, default=5003, help='Port to listen on')
+    args = parser.parse_args()
+
+    server = FakeTwilioServer(port=args.port, verbose=True)
+    print(f"Fake Twilio API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
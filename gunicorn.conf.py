@@ -0,0 +1,15 @@
+"""
+gunicorn settings, read automatically when gunicorn is started from
+this directory.
+
+Each worker imports the app lazily and would otherwise pay for
+importing ADK and building the agent on its first agent message. Once
+a worker has loaded the app, and before it accepts requests, warm it up
+(see app.warm_up); set WARM_UP=false to skip this.
+"""
+
+
+def post_worker_init(worker):
+    import app
+    if app.WARM_UP:
+        app.warm_up()
@@ -0,0 +1,137 @@
+"""
+Bounded view of a user's message history for the agent.
+
+Each user record carries the last CONTEXT_RECENT_MESSAGES messages in
+'recent_messages' and a rolling 'history_summary' of everything older.
+Both are updated by fold_message() as each message arrives, so building
+the agent's context never needs the full message log. build_context()
+assembles profile, health data, recent messages and summary, and trims
+the result until it fits in CONTEXT_MAX_BYTES.
+"""
+
+import os
+import re
+import json
+from collections import Counter
+
+CONTEXT_RECENT_MESSAGES = int(os.getenv('CONTEXT_RECENT_MESSAGES', '10'))
+CONTEXT_MAX_BYTES = max(512, int(os.getenv('CONTEXT_MAX_BYTES', '8192')))
+
+# Bounds on what the rolling summary keeps
+SUMMARY_TOPICS = 25
+SUMMARY_IMAGES = 5
+SUMMARY_SNIPPETS = 5
+SNIPPET_LENGTH = 120
+
+# Words too common to say anything about a conversation
+STOPWORDS = set("""
+a about after again all am an and any are as at be because been before being but by can could did do
+does doing for from had has have having he her here hers him his how i if im in into is it its just me
+more most my no not now of off on once only or other our out over own same she should so some such than
+that the their them then there these they this those through to too under until up very was we were what
+when where which while who why will with would you your yes ok okay thanks thank hi hello
+""".split())
+
+
+def _recent_entry(message_entry):
+    """Keep only the fields of a message worth showing the agent."""
+    entry = {
+        'timestamp': message_entry.get('timestamp'),
+        'type': message_entry.get('type'),
+        'content': message_entry.get('content')
+    }
+    if message_entry.get('saved_filename'):
+        entry['saved_filename'] = message_entry['saved_filename']
+    return entry
+
+
+def _summarise(summary, message_entry):
+    """Fold one message that left the recent window into the summary."""
+    summary['message_count'] = summary.get('message_count', 0) + 1
+    summary.setdefault('first_at', message_entry.get('timestamp'))
+    summary['last_at'] = message_entry.get('timestamp')
+
+    by_type = summary.setdefault('by_type', {})
+    message_type = message_entry.get('type') or 'text'
+    by_type[message_type] = by_type.get(message_type, 0) + 1
+
+    content = message_entry.get('content') or ''
+    words = [word for word in re.findall(r"[a-z']{3,}", content.lower()) if word not in STOPWORDS]
+    topics = Counter(summary.get('topics', {}))
+    topics.update(words)
+    summary['topics'] = dict(topics.most_common(SUMMARY_TOPICS))
+
+    if message_type == 'image' and message_entry.get('saved_filename'):
+        summary['images'] = (summary.get('images', []) + [message_entry['saved_filename']])[-SUMMARY_IMAGES:]
+    elif content:
+        snippet = content[:SNIPPET_LENGTH]
+        summary['snippets'] = (summary.get('snippets', []) + [snippet])[-SUMMARY_SNIPPETS:]
+
+
+def fold_message(user_data, message_entry, window=CONTEXT_RECENT_MESSAGES):
+    """Add a new message to a record's recent window and rolling summary."""
+    recent = user_data.setdefault('recent_messages', [])
+    recent.append(_recent_entry(message_entry))
+    while len(recent) > window:
+        _summarise(user_data.setdefault('history_summary', {}), recent.pop(0))
+
+
+def _size(context):
+    """Size of a context dict once serialised for the model."""
+    return len(json.dumps(context).encode())
+
+
+def build_context(user_data, recent_messages=None, max_bytes=CONTEXT_MAX_BYTES):
+    """Build the agent's view of a user, never larger than max_bytes.
+
+    recent_messages overrides the record's own window, for records
+    created before it existed.
+    """
+    if recent_messages is None:
+        recent_messages = user_data.get('recent_messages', [])
+    context = {
+        "status": "success",
+        "profile": user_data.get('profile', {}),
+        "health_data": user_data.get('health_data', {}),
+        "triage_completed": user_data.get('triage_completed', False),
+        "message_count": user_data.get('message_count', 0),
+        "recent_messages": [dict(entry) for entry in recent_messages],
+        "history_summary": user_data.get('history_summary', {}),
+        "truncated": False
+    }
+    if _size(context) <= max_bytes:
+        return context
+
+    context['truncated'] = True
+    context['history_summary'] = dict(context['history_summary'])
+
+    # Drop the least useful detail first, re-checking the size after each cut
+    def reductions():
+        for entry in context['recent_messages']:
+            if entry.get('content') and len(entry['content']) > SNIPPET_LENGTH:
+                entry['content'] = entry['content'][:SNIPPET_LENGTH] + '...'
+                yield
+        for key in ('snippets', 'images', 'topics'):
+            if context['history_summary'].pop(key, None) is not None:
+                yield
+        while context['recent_messages']:
+            context['recent_messages'].pop(0)
+            yield
+        context['history_summary'] = {}
+        yield
+        context['health_data'] = {'omitted': len(context['health_data'])}
+        yield
+        context['profile'] = {key: str(value)[:SNIPPET_LENGTH] for key, value in context['profile'].items()}
+        yield
+
+    for _ in reductions():
+        if _size(context) <= max_bytes:
+            return context
+
+    # Nothing left to cut: return only what always fits
+    return {
+        "status": "success",
+        "triage_completed": context['triage_completed'],
+        "message_count": context['message_count'],
+        "truncated": True
+    }
@@ -0,0 +1,152 @@
+"""
+Idempotent handling of webhook deliveries, keyed on Twilio's MessageSid.
+
+Twilio retries a webhook when our reply is slow. Without this, a retry
+would append the message again, could advance triage twice and would
+pay for a second agent call. Every delivery is recorded in a small
+SQLite table shared by all worker processes:
+
+- the first delivery of a MessageSid claims it and, once handled,
+  stores the TwiML it returned;
+- a later delivery gets that stored TwiML back without doing any work;
+- a delivery that arrives while the first is still being handled waits
+  up to IDEMPOTENCY_WAIT_SECONDS for its result instead of redoing it.
+
+A claim whose handler crashed is taken over after
+IDEMPOTENCY_LEASE_SECONDS. Entries are kept for IDEMPOTENCY_TTL seconds
+and at most IDEMPOTENCY_MAX_ENTRIES of them.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from storage import DATA_DIR
+
+IDEMPOTENCY_PATH = os.getenv('IDEMPOTENCY_PATH', os.path.join(DATA_DIR, 'idempotency.sqlite3'))
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '3600'))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '100000'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '12'))
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv('IDEMPOTENCY_LEASE_SECONDS', '120'))
+
+# Seconds between sweeps of expired entries, per process
+PRUNE_INTERVAL = 60
+
+# How often a waiting retry checks whether the original has finished
+POLL_INTERVAL = 0.05
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    sid TEXT PRIMARY KEY,
+    response TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS deliveries_started ON deliveries (started_at);
+"""
+
+# Outcomes of IdempotencyStore.begin()
+NEW = 'new'
+DONE = 'done'
+IN_FLIGHT = 'in_flight'
+
+
+class IdempotencyStore:
+    """Bounded, TTL'd record of handled deliveries, shared across processes."""
+
+    def __init__(self, path=IDEMPOTENCY_PATH, ttl=IDEMPOTENCY_TTL, max_entries=IDEMPOTENCY_MAX_ENTRIES,
+                 lease=IDEMPOTENCY_LEASE_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lease = lease
+        self._local = threading.local()
+        self._last_prune = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        """Get this thread's connection to the store (a fresh one after a fork)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def begin(self, sid):
+        """Claim a delivery.
+
+        Returns (NEW, None) if this caller should handle it, (DONE, response)
+        if it was already handled, or (IN_FLIGHT, None) if another caller
+        is handling it right now.
+        """
+        now = time.time()
+        if now - self._last_prune >= PRUNE_INTERVAL:
+            self._last_prune = now
+            self.prune()
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT response, started_at, finished_at FROM deliveries WHERE sid = ?', (sid,)
+            ).fetchone()
+            if row is None:
+                connection.execute('INSERT INTO deliveries (sid, started_at) VALUES (?, ?)', (sid, now))
+                outcome = (NEW, None)
+            elif row[2] is not None:
+                outcome = (DONE, row[0])
+            elif now - row[1] >= self.lease:
+                # Whoever claimed it has probably died; take it over
+                connection.execute('UPDATE deliveries SET started_at = ? WHERE sid = ?', (now, sid))
+                outcome = (NEW, None)
+            else:
+                outcome = (IN_FLIGHT, None)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return outcome
+
+    def complete(self, sid, response):
+        """Store the response of a delivery claimed with begin()."""
+        self._connection().execute(
+            'UPDATE deliveries SET response = ?, finished_at = ? WHERE sid = ?', (response, time.time(), sid)
+        )
+
+    def abandon(self, sid):
+        """Release a claim without a response, so a retry handles the delivery again."""
+        self._connection().execute('DELETE FROM deliveries WHERE sid = ? AND finished_at IS NULL', (sid,))
+
+    def wait(self, sid, timeout=IDEMPOTENCY_WAIT_SECONDS):
+        """Wait for an in-flight delivery to finish; returns its response, or None on timeout."""
+        deadline = time.monotonic() + timeout
+        connection = self._connection()
+        while True:
+            row = connection.execute(
+                'SELECT response, finished_at FROM deliveries WHERE sid = ?', (sid,)
+            ).fetchone()
+            if row is None:
+                # The original failed and gave up its claim
+                return None
+            if row[1] is not None:
+                return row[0]
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def prune(self):
+        """Drop expired entries, then the oldest ones beyond max_entries."""
+        connection = self._connection()
+        connection.execute('DELETE FROM deliveries WHERE started_at < ?', (time.time() - self.ttl,))
+        connection.execute(
+            'DELETE FROM deliveries WHERE sid IN '
+            '(SELECT sid FROM deliveries ORDER BY started_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
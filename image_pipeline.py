@@ -0,0 +1,136 @@
+"""
+Preprocessing of uploaded photos before they are sent to the agent.
+
+Phone photos are several megabytes and thousands of pixels wide, which
+makes model calls slow and expensive. Each image is rotated upright,
+shrunk to IMAGE_MAX_EDGE pixels on its longest side and re-encoded as
+IMAGE_FORMAT in a separate process, so the work doesn't compete with
+request threads for the GIL. The result is cached next to the original
+blob and reused for every later request of the same image.
+"""
+
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1024'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '80'))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+
+FORMAT_INFO = {
+    'JPEG': ('jpg', 'image/jpeg'),
+    'WEBP': ('webp', 'image/webp'),
+    'PNG': ('png', 'image/png'),
+}
+
+
+def variant_path(source_path, max_edge=IMAGE_MAX_EDGE, image_format=IMAGE_FORMAT):
+    """Get the path of the cached variant of source_path."""
+    extension = FORMAT_INFO[image_format][0]
+    return f'{source_path}.{max_edge}.{extension}'
+
+
+def preprocess_image(source_path, dest_path, max_edge, image_format, quality):
+    """Normalise orientation, downsize and re-encode one image.
+
+    Runs in a worker process. Returns the size of the derived file.
+    """
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge))
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        directory = os.path.dirname(dest_path) or '.'
+        fd, tmp_path = tempfile.mkstemp(prefix='.variant.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=image_format, quality=quality, optimize=True)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return os.path.getsize(dest_path)
+
+
+class PreparedImage:
+    """A preprocessed image ready to be attached to an agent call."""
+
+    def __init__(self, path, mime_type, original_bytes, derived_bytes, seconds, cached):
+        self.path = path
+        self.mime_type = mime_type
+        self.original_bytes = original_bytes
+        self.derived_bytes = derived_bytes
+        self.seconds = seconds
+        self.cached = cached
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - self.derived_bytes
+
+    def read(self):
+        """Read the preprocessed image's bytes."""
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class ImagePreprocessor:
+    """Prepares images in a process pool and caches the results on disk."""
+
+    def __init__(self, workers=IMAGE_WORKERS, max_edge=IMAGE_MAX_EDGE, image_format=IMAGE_FORMAT,
+                 quality=IMAGE_QUALITY):
+        if image_format not in FORMAT_INFO:
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.workers = workers
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        """The worker pool, created on first use (and again after a fork)."""
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # forkserver children don't inherit the request threads' locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver')
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def prepare(self, source_path):
+        """Return a PreparedImage for source_path, preprocessing it if needed."""
+        # Worker processes may not share our working directory
+        source_path = os.path.abspath(source_path)
+        dest_path = variant_path(source_path, self.max_edge, self.image_format)
+        mime_type = FORMAT_INFO[self.image_format][1]
+        original_bytes = os.path.getsize(source_path)
+
+        started = time.perf_counter()
+        if os.path.exists(dest_path):
+            derived_bytes = os.path.getsize(dest_path)
+            cached = True
+        else:
+            future = self.executor.submit(
+                preprocess_image, source_path, dest_path, self.max_edge, self.image_format, self.quality
+            )
+            derived_bytes = future.result()
+            cached = False
+
+        return PreparedImage(dest_path, mime_type, original_bytes, derived_bytes,
+                             time.perf_counter() - started, cached)
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
@@ -0,0 +1,88 @@
+"""
+Streaming downloads of WhatsApp media from Twilio.
+
+Media is streamed in chunks straight into a temporary file next to its
+final location, hashed on the way, and aborted as soon as it exceeds the
+configured size limit, so memory use per download stays constant.
+"""
+
+import os
+import hashlib
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(16 * 1024 * 1024)))
+MEDIA_CONNECT_TIMEOUT = float(os.getenv('MEDIA_CONNECT_TIMEOUT', '5'))
+MEDIA_READ_TIMEOUT = float(os.getenv('MEDIA_READ_TIMEOUT', '30'))
+MEDIA_POOL_SIZE = int(os.getenv('MEDIA_POOL_SIZE', '10'))
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLarge(Exception):
+    """Raised when a download exceeds the size limit."""
+
+
+class DownloadedMedia:
+    """A media file streamed to a temporary path."""
+
+    def __init__(self, path, size, sha256, content_type):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.content_type = content_type
+
+    def discard(self):
+        """Remove the temporary file."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class MediaDownloader:
+    """Downloads media over a shared, connection-pooled session."""
+
+    def __init__(self, auth=None, max_bytes=MEDIA_MAX_BYTES,
+                 timeout=(MEDIA_CONNECT_TIMEOUT, MEDIA_READ_TIMEOUT), pool_size=MEDIA_POOL_SIZE):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, dest_dir):
+        """Stream url into a temporary file in dest_dir.
+
+        Raises requests exceptions for HTTP and network errors, and
+        MediaTooLarge if the body is bigger than max_bytes.
+        """
+        os.makedirs(dest_dir, exist_ok=True)
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+
+            # Refuse early when the server tells us the size up front
+            content_length = r.headers.get('Content-Length')
+            if content_length and int(content_length) > self.max_bytes:
+                raise MediaTooLarge(f"Media is {content_length} bytes, limit is {self.max_bytes}")
+
+            fd, tmp_path = tempfile.mkstemp(prefix='.download.', suffix='.tmp', dir=dest_dir)
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise MediaTooLarge(f"Media exceeds the {self.max_bytes} byte limit")
+                        digest.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+            content_type = r.headers.get('Content-Type', '').split(';')[0].strip() or None
+
+        return DownloadedMedia(tmp_path, size, digest.hexdigest(), content_type)
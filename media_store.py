@@ -0,0 +1,187 @@
+"""
+Content-addressed storage for uploaded media.
+
+Every distinct file is stored once as a blob named by its SHA-256 under
+uploads/.blobs/. The files users see in uploads/<phone>/ are hard links
+to those blobs, so resending the same photo costs no extra space and the
+blob's link count doubles as its reference count: a blob whose only
+link is the one under .blobs/ is unreferenced and can be removed.
+Derived variants (see image_pipeline.py) sit next to their blob as
+<sha256>.<suffix> and are removed with it.
+"""
+
+import os
+import re
+import glob
+import shutil
+import hashlib
+
+UPLOADS_DIR = 'uploads'
+
+# Longest user-visible filename stem kept from a caption
+MAX_FILENAME_STEM = 80
+
+
+def safe_filename_stem(text):
+    """Turn a caption into a filename stem that can't escape the user's directory."""
+    stem = re.sub(r'[^A-Za-z0-9 ._-]+', '_', text).strip(' ._')
+    return stem[:MAX_FILENAME_STEM] or 'image'
+
+
+class MediaStore:
+    """Deduplicating media store with per-user names linked to shared blobs."""
+
+    def __init__(self, root=UPLOADS_DIR):
+        self.root = root
+        self.blobs_dir = os.path.join(root, '.blobs')
+        self.tmp_dir = os.path.join(root, '.tmp')
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def user_dir(self, phone_number):
+        """Get the directory holding a user's named uploads."""
+        return os.path.join(self.root, phone_number.replace('whatsapp:', ''))
+
+    def blob_path(self, sha256):
+        """Get the path of the blob with the given hash."""
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def _add_blob(self, path, sha256):
+        """Make sure a blob with the contents of path exists; return its path."""
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            pass
+        return blob_path
+
+    def _link_name(self, blob_path, user_dir, filename):
+        """Link a blob into user_dir under filename, or a free variant of it.
+
+        Returns the name used. An existing entry that already points at
+        the same blob is reused instead of creating a second name.
+        """
+        stem, ext = os.path.splitext(filename)
+        blob_stat = os.stat(blob_path)
+        counter = 1
+        while True:
+            name = filename if counter == 1 else f'{stem}_{counter}{ext}'
+            path = os.path.join(user_dir, name)
+            try:
+                os.link(blob_path, path)
+                return name
+            except FileExistsError:
+                if os.path.samestat(os.stat(path), blob_stat):
+                    return name
+                counter += 1
+
+    def store(self, phone_number, download, filename):
+        """Store a downloaded file for a user under a name derived from filename.
+
+        download is a media.DownloadedMedia whose temporary file lives in
+        tmp_dir. Returns the name the file was stored under.
+        """
+        user_dir = self.user_dir(phone_number)
+        os.makedirs(user_dir, exist_ok=True)
+        try:
+            for attempt in range(2):
+                blob_path = self._add_blob(download.path, download.sha256)
+                try:
+                    return self._link_name(blob_path, user_dir, filename)
+                except FileNotFoundError:
+                    # The blob was garbage-collected between the two links
+                    if attempt:
+                        raise
+        finally:
+            download.discard()
+
+    def iter_blobs(self):
+        """Yield the path of every blob."""
+        if not os.path.exists(self.blobs_dir):
+            return
+        for prefix in os.listdir(self.blobs_dir):
+            prefix_dir = os.path.join(self.blobs_dir, prefix)
+            for name in os.listdir(prefix_dir):
+                # Skip derived variants and temp files
+                if '.' not in name:
+                    yield os.path.join(prefix_dir, name)
+
+    def _remove_blob(self, blob_path):
+        """Remove a blob and its derived variants; return bytes freed."""
+        freed = 0
+        for path in [blob_path] + glob.glob(f'{glob.escape(blob_path)}.*'):
+            freed += os.path.getsize(path)
+            os.remove(path)
+        return freed
+
+    def collect_garbage(self):
+        """Remove blobs no user links to; return (blobs removed, bytes freed)."""
+        removed = 0
+        freed = 0
+        for blob_path in self.iter_blobs():
+            if os.stat(blob_path).st_nlink == 1:
+                freed += self._remove_blob(blob_path)
+                removed += 1
+        return removed, freed
+
+    def remove_user(self, phone_number):
+        """Delete a user's uploads and any blobs only they referenced.
+
+        Returns the number of bytes freed.
+        """
+        user_dir = self.user_dir(phone_number)
+        if not os.path.exists(user_dir):
+            return 0
+
+        candidates = set()
+        for name in os.listdir(user_dir):
+            stat = os.stat(os.path.join(user_dir, name))
+            if stat.st_nlink > 1:
+                candidates.add((stat.st_dev, stat.st_ino))
+        shutil.rmtree(user_dir)
+
+        freed = 0
+        for blob_path in self.iter_blobs():
+            stat = os.stat(blob_path)
+            if (stat.st_dev, stat.st_ino) in candidates and stat.st_nlink == 1:
+                freed += self._remove_blob(blob_path)
+        return freed
+
+    def deduplicate(self):
+        """Move every plain file under the user directories into the blob store.
+
+        Files with identical contents end up sharing one blob. Returns a
+        dict with the number of files scanned, files that were already
+        linked, duplicates found, and bytes reclaimed.
+        """
+        report = {'files': 0, 'already_linked': 0, 'duplicates': 0, 'bytes_reclaimed': 0}
+        for entry in sorted(os.listdir(self.root)):
+            user_dir = os.path.join(self.root, entry)
+            if entry.startswith('.') or not os.path.isdir(user_dir):
+                continue
+            for name in sorted(os.listdir(user_dir)):
+                path = os.path.join(user_dir, name)
+                if not os.path.isfile(path):
+                    continue
+                report['files'] += 1
+                stat = os.stat(path)
+                if stat.st_nlink > 1:
+                    report['already_linked'] += 1
+                    continue
+
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        digest.update(chunk)
+                blob_path = self.blob_path(digest.hexdigest())
+                if os.path.exists(blob_path):
+                    # Same contents as an existing blob: swap the copy for a link
+                    tmp_path = os.path.join(user_dir, f'.{name}.link')
+                    os.link(blob_path, tmp_path)
+                    os.replace(tmp_path, path)
+                    report['duplicates'] += 1
+                    report['bytes_reclaimed'] += stat.st_size
+                else:
+                    self._add_blob(path, digest.hexdigest())
+        return report
@@ -0,0 +1,367 @@
+"""
+Latency histograms and counters, exported in Prometheus text format.
+
+Each process records into its own in-memory registry and periodically
+writes a snapshot to METRICS_DIR/metrics.<pid>.<start time>.json. The
+/metrics endpoint merges the snapshots of every worker, so the numbers
+are the same whichever gunicorn worker answers the scrape. Snapshots of
+workers that have exited are folded into METRICS_DIR/exited.json and
+deleted, so their counters and histograms stay in the totals, which
+never go backwards, without the directory growing as workers come and
+go; gauges only count live workers.
+"""
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import inspect
+import tempfile
+import functools
+import threading
+from contextlib import contextmanager
+
+from structured_logging import get_logger, note_stage
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join('data', '.metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_PREFIX = 'nutrimate_'
+
+# Upper bounds in seconds, from a cache hit to a slow model call
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Counters and histograms of exited workers, kept in METRICS_DIR
+EXITED_FILE = 'exited.json'
+
+logger = get_logger('metrics')
+
+HELP = {
+    'stage_duration_seconds': 'Time spent in each stage of handling a message',
+    'tool_duration_seconds': 'Time spent in each agent tool call',
+    'messages_total': 'Incoming messages by kind',
+    'errors_total': 'Errors by stage',
+    'response_cache_hits_total': 'Replies served from the response cache',
+    'response_cache_misses_total': 'Response cache lookups that missed',
+    'response_cache_skipped_total': 'Replies not cached because the agent updated the profile',
+    'response_cache_saved_seconds_total': 'Agent time saved by response cache hits',
+    'response_cache_entries': 'Replies currently held in the response cache',
+    'session_cache_hits_total': 'Agent sessions served from the in-memory cache',
+    'session_cache_misses_total': 'Agent sessions rehydrated from the session database',
+    'session_cache_entries': 'Agent sessions currently cached in memory',
+    'weather_cache_hits_total': 'Weather lookups answered from the cache',
+    'weather_cache_misses_total': 'Weather lookups that called the provider',
+    'weather_lookups_coalesced_total': 'Weather lookups that waited on an identical call already in flight',
+    'log_records_dropped_total': 'Log records dropped because the log queue was full',
+    'reply_queue_depth': 'Replies waiting for a worker, across all shards',
+    'reply_queue_depth_max': 'Replies waiting on the most backed-up shard',
+    'reply_workers_busy': 'Shard workers currently producing a reply',
+    'reply_queue_rejected_total': 'Messages turned away because their shard queue was full',
+    'duplicate_deliveries_total': 'Webhook retries answered with the response to the first delivery',
+    'messages_coalesced_total': 'Text messages answered as part of a later message in the same burst',
+    'bursts_waiting': 'Text messages held back for more of the same burst',
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """Per-process counters, gauges and histograms."""
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._reset()
+
+    def _reset(self):
+        """Start empty; also used in a forked child so it doesn't re-report the parent's data."""
+        self._pid = os.getpid()
+        # Tells this process's snapshot apart from an exited one's whose pid it reused
+        self._started = time.time_ns()
+        self._counters = {}
+        self._histograms = {}
+        self._flusher = None
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Record one observation in a latency histogram."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Time the block into histogram name; failures also count in errors_total."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc('errors_total', stage=labels.get('stage') or labels.get('tool') or name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collector):
+        """Register a function returning {metric name: value} read at every flush.
+
+        Names ending in _total are exported as counters, others as gauges.
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        """This process's metrics as a JSON-serialisable dict."""
+        with self._lock:
+            self._check_fork()
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), h['buckets'], h['sum'], h['count']]
+                          for (name, labels), h in self._histograms.items()]
+        gauges = []
+        for collector in self._collectors:
+            for name, value in collector().items():
+                if name.endswith('_total'):
+                    counters.append([name, {}, value])
+                else:
+                    gauges.append([name, {}, value])
+        return {'pid': self._pid, 'started': self._started, 'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def flush(self):
+        """Write this process's snapshot where other workers can read it."""
+        snapshot = self.snapshot()
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.metrics.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, os.path.join(self.directory, f"metrics.{snapshot['pid']}.{snapshot['started']}.json"))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        try:
+            self.fold_exited()
+        except OSError:
+            logger.exception("Error folding metrics of exited workers")
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Error writing metrics")
+
+    def _read_snapshots(self):
+        """Return {file name: snapshot} for every worker snapshot in the directory."""
+        snapshots = {}
+        for name in os.listdir(self.directory):
+            if not (name.startswith('metrics.') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots[name] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def _read_exited(self):
+        """The accumulated counters and histograms of exited workers."""
+        try:
+            with open(os.path.join(self.directory, EXITED_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'counters': [], 'histograms': [], 'folded': []}
+
+    def fold_exited(self):
+        """Merge the snapshots of exited workers into EXITED_FILE and delete them.
+
+        A snapshot belongs to an exited worker if its pid is gone, or if a
+        later process has reused the pid. Returns the accumulated data of
+        exited workers and {file name: snapshot} of the live ones, read
+        together so that a concurrent fold can't count a worker twice or
+        not at all.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.fold.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            exited = self._read_exited()
+            snapshots = self._read_snapshots()
+            newest = {}
+            for snapshot in snapshots.values():
+                newest[snapshot['pid']] = max(newest.get(snapshot['pid'], 0), snapshot.get('started', 0))
+
+            # Snapshots folded by a run that died before deleting them are only deleted
+            already_folded = set(exited['folded'])
+            folding = [name for name, snapshot in snapshots.items()
+                       if name not in already_folded
+                       and (snapshot.get('started', 0) < newest[snapshot['pid']] or not _pid_alive(snapshot['pid']))]
+            if folding:
+                counters, histograms = {}, {}
+                _merge(exited, counters, histograms)
+                for name in folding:
+                    _merge(snapshots[name], counters, histograms)
+                exited = {
+                    'counters': [[metric, dict(labels), value] for (metric, labels), value in counters.items()],
+                    'histograms': [[metric, dict(labels), h['buckets'], h['sum'], h['count']]
+                                   for (metric, labels), h in histograms.items()],
+                    'folded': sorted(already_folded.intersection(snapshots) | set(folding)),
+                }
+                fd, tmp_path = tempfile.mkstemp(prefix='.exited.', suffix='.tmp', dir=self.directory)
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(exited, f)
+                    os.replace(tmp_path, os.path.join(self.directory, EXITED_FILE))
+                except BaseException:
+                    os.remove(tmp_path)
+                    raise
+            for name in exited['folded']:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+        live = {name: snapshot for name, snapshot in snapshots.items() if name not in exited['folded']}
+        return exited, live
+
+    def collect(self):
+        """Merge the snapshots of every worker process, live or exited."""
+        self.flush()
+        counters = {}
+        gauges = {}
+        histograms = {}
+        exited, live = self.fold_exited()
+        _merge(exited, counters, histograms)
+        for snapshot in live.values():
+            _merge(snapshot, counters, histograms)
+            if _pid_alive(snapshot['pid']):
+                for metric, labels, value in snapshot['gauges']:
+                    key = (metric, _label_key(labels))
+                    gauges[key] = gauges.get(key, 0) + value
+        return counters, gauges, histograms
+
+    def render(self):
+        """Render the merged metrics in Prometheus text exposition format."""
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges), ('histogram', histograms)):
+            for metric in sorted({name for name, _ in series}):
+                full_name = METRICS_PREFIX + metric
+                if metric in HELP:
+                    lines.append(f'# HELP {full_name} {HELP[metric]}')
+                lines.append(f'# TYPE {full_name} {kind}')
+                for (name, labels), value in sorted(series.items()):
+                    if name != metric:
+                        continue
+                    if kind != 'histogram':
+                        lines.append(f'{full_name}{_format_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, value['buckets']):
+                        cumulative += count
+                        lines.append(f'{full_name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{full_name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+                    lines.append(f'{full_name}_sum{_format_labels(labels)} {value["sum"]}')
+                    lines.append(f'{full_name}_count{_format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _merge(snapshot, counters, histograms):
+    """Add a snapshot's counters and histograms to the merged dicts."""
+    for metric, labels, value in snapshot['counters']:
+        key = (metric, _label_key(labels))
+        counters[key] = counters.get(key, 0) + value
+    for metric, labels, buckets, total, count in snapshot['histograms']:
+        key = (metric, _label_key(labels))
+        merged = histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], buckets)]
+        merged['sum'] += total
+        merged['count'] += count
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+metrics = MetricsRegistry()
+
+
+@atexit.register
+def _flush_at_exit():
+    if metrics._pid == os.getpid() and (metrics._counters or metrics._histograms):
+        try:
+            metrics.flush()
+        except OSError:
+            pass
+
+
+@contextmanager
+def timed_stage(stage):
+    """Time a block as one stage of handling a message, for /metrics and the request's log line."""
+    started = time.perf_counter()
+    try:
+        with metrics.timed('stage_duration_seconds', stage=stage):
+            yield
+    finally:
+        note_stage(stage, time.perf_counter() - started)
+
+
+def timed_tool(func):
+    """Time every call of an agent tool, sync or async."""
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with metrics.timed('tool_duration_seconds', tool=func.__name__):
+                    return await func(*args, **kwargs)
+            finally:
+                note_stage(f'tool.{func.__name__}', time.perf_counter() - started)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with metrics.timed('tool_duration_seconds', tool=func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            note_stage(f'tool.{func.__name__}', time.perf_counter() - started)
+    return wrapper
@@ -1,64 +1,234 @@
 import datetime
 import os
 import json
+import asyncio
+import threading
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
 from zoneinfo import ZoneInfo
-from google.adk.agents import Agent
+from storage import get_storage, user_lock
+from history import CONTEXT_RECENT_MESSAGES, build_context
+from timezones import resolve_timezone
+from weather import WeatherUnavailable, get_weather_service
+from metrics import timed_tool
+from structured_logging import get_logger
+
+# User the profile tools operate on when called outside an agent turn, for development with
+# `adk web`; unset, tools called outside a turn return an error instead
+AGENT_DEV_USER = os.getenv('AGENT_DEV_USER', '')
+
+logger = get_logger('agent')
+
+# The AgentTurn the tools in the current context work against
+_current_turn = contextvars.ContextVar('current_turn', default=None)
+
+
+def apply_update(user_data, field, value):
+    """Set one field on a user record the way update_json always has."""
+    if field in user_data['profile']:
+        # Update profile field
+        user_data['profile'][field] = value
+    elif field.startswith('health_'):
+        # Initialize health_data section if it doesn't exist
+        if 'health_data' not in user_data:
+            user_data['health_data'] = {}
+    
+        # Update health data field
+        user_data['health_data'][field] = value
+        user_data['health_data']['last_updated'] = datetime.datetime.now().isoformat()
+    else:
+        # Update custom field in profile
+        user_data['profile'][field] = value
+
+
+class AgentTurn:
+    """One agent turn's view of the calling user's record.
+
+    The record is loaded once when the turn starts. Tools read from and
+    write to that in-memory snapshot, and writes are buffered until
+    flush(), which applies them to a fresh copy of the record under the
+    user's lock and saves it once. The names of the tools that read the
+    user's data are kept in reads, and of those that wrote it in writes.
+    """
+
+    def __init__(self, phone_number):
+        self.phone_number = phone_number
+        self.storage = get_storage()
+        self.user_data = self.storage.load(phone_number)
+        self.pending = []
+        self.reads = []
+        self.writes = []
+
+    def read(self, tool_name):
+        """Note that a tool used the user's data, so its answer is personal."""
+        self.reads.append(tool_name)
+
+    def update(self, tool_name, fields):
+        """Apply field updates to the snapshot and queue them for flush()."""
+        logger.debug("Tool update", extra={'tool': tool_name, 'fields': sorted(fields)})
+        self.writes.append(tool_name)
+        for field, value in fields.items():
+            apply_update(self.user_data, field, value)
+            self.pending.append((field, value))
+
+    def flush(self):
+        """Save the buffered updates; returns the number of fields written."""
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, []
+        # Merge into the latest record so changes made during the turn survive
+        with user_lock(self.phone_number):
+            user_data = self.storage.load_for_update(self.phone_number)
+            if user_data is None:
+                return 0
+            for field, value in pending:
+                apply_update(user_data, field, value)
+            self.storage.save(self.phone_number, user_data)
+        logger.debug("Flushed tool updates", extra={'fields': len(pending), 'tools': self.writes})
+        return len(pending)
+
+
+@contextmanager
+def agent_turn(turn):
+    """Bind the profile tools to turn for the duration of the block."""
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        _current_turn.reset(token)
 
 
-def get_weather(city: str) -> dict:
+class NoAgentTurn(Exception):
+    """Raised when a tool runs outside an agent turn and no AGENT_DEV_USER is set."""
+    pass
+
+
+@asynccontextmanager
+async def _tool_turn():
+    """Get the active turn, or a one-call turn for AGENT_DEV_USER that flushes at once.
+
+    Without a bound turn the tools can't know whose data to use, so
+    unless AGENT_DEV_USER is set this raises NoAgentTurn rather than
+    guess. Loading and flushing a one-call turn read and write storage,
+    so they run in a worker thread instead of blocking the event loop.
+    """
+    turn = _current_turn.get()
+    if turn is not None:
+        yield turn
+        return
+    if not AGENT_DEV_USER:
+        logger.error("Agent tool called outside an agent turn")
+        raise NoAgentTurn()
+    turn = await asyncio.to_thread(AgentTurn, AGENT_DEV_USER)
+    yield turn
+    await asyncio.to_thread(turn.flush)
+
+
+def _no_agent_turn():
+    return {
+        "status": "error",
+        "error_message": "No user is bound to this tool call, so user data can't be used."
+    }
+
+
+def _user_not_found(turn):
+    return {
+        "status": "error",
+        "error_message": f"User not found: {turn.phone_number}"
+    }
+
+
+async def _profile_location(tool_name):
+    """The location from the current user's profile, if there is one."""
+    try:
+        async with _tool_turn() as turn:
+            turn.read(tool_name)
+            user_data = turn.user_data
+    except NoAgentTurn:
+        return ''
+    return ((user_data or {}).get('profile') or {}).get('location', '')
+
+
+@timed_tool
+async def get_weather(city: str = "") -> dict:
     """Retrieves the current weather report for a specified city.
 
     Args:
         city (str): The name of the city for which to retrieve the weather report.
+            Leave empty to use the location in the user's profile.
 
     Returns:
         dict: status and result or error msg.
     """
-    if city.lower() == "new york":
+    city = city or await _profile_location('get_weather')
+    if not city:
         return {
-            "status": "success",
-            "report": (
-                "The weather in New York is sunny with a temperature of 25 degrees"
-                " Celsius (77 degrees Fahrenheit)."
-            ),
+            "status": "error",
+            "error_message": "No city given and the user's location isn't known.",
         }
-    else:
+
+    try:
+        # Provider calls go over the network, so keep them off the event loop
+        weather = await asyncio.to_thread(get_weather_service().current, city)
+    except WeatherUnavailable as e:
+        logger.info("Weather unavailable", extra={'error': str(e)})
         return {
             "status": "error",
             "error_message": f"Weather information for '{city}' is not available.",
         }
 
+    fahrenheit = weather.temperature_c * 9 / 5 + 32
+    return {
+        "status": "success",
+        "report": (
+            f"The weather in {weather.city} is {weather.conditions} with a temperature of"
+            f" {weather.temperature_c:.0f} degrees Celsius ({fahrenheit:.0f} degrees Fahrenheit)."
+        ),
+    }
+
 
-def get_current_time(city: str) -> dict:
+@timed_tool
+async def get_current_time(city: str = "") -> dict:
     """Returns the current time in a specified city.
 
     Args:
         city (str): The name of the city for which to retrieve the current time.
+            Leave empty to use the location in the user's profile.
 
     Returns:
         dict: status and result or error msg.
     """
+    city = city or await _profile_location('get_current_time')
+    match = resolve_timezone(city) if city else None
+    if match is None:
+        return {
+            "status": "error",
+            "error_message": (
+                f"Sorry, I don't have timezone information for {city or 'the user'}."
+            ),
+        }
 
-    if city.lower() == "new york":
-        tz_identifier = "America/New_York"
-    else:
+    if match.zone is None:
         return {
             "status": "error",
             "error_message": (
-                f"Sorry, I don't have timezone information for {city}."
+                f"{match.name} spans several timezones. Ask the user which city they mean."
             ),
         }
 
-    tz = ZoneInfo(tz_identifier)
-    now = datetime.datetime.now(tz)
+    now = datetime.datetime.now(ZoneInfo(match.zone))
+    # A fuzzy match may be a different place altogether ("Portland" -> Poland), so say which
+    place = city if match.exact else f"{city} (closest match: {match.name})"
     report = (
-        f'The current time in {city} is {now.strftime("%Y-%m-%d %H:%M:%S %Z%z")}'
+        f'The current time in {place} is {now.strftime("%Y-%m-%d %H:%M:%S %Z%z")}'
     )
-    return {"status": "success", "report": report}
+    return {"status": "success", "report": report, "timezone": match.zone, "matched_place": match.name,
+            "exact_match": match.exact}
 
 
-def update_json(field: str, value: str) -> dict:
-    """Updates user health data in JSON file based on user responses.
+@timed_tool
+async def update_json(field: str, value: str) -> dict:
+    """Updates user health data based on user responses.
 
     Args:
         field (str): Field to update (profile field or custom health data)
@@ -68,39 +238,13 @@ def update_json(field: str, value: str) -> dict:
         dict: Status and result or error message
     """
     try:
-        # Use the existing JSON file for testing
-        file_path = os.path.join('data', 'user_447480556916.json')
-        
-        # Check if file exists
-        if not os.path.exists(file_path):
-            return {
-                "status": "error",
-                "error_message": f"User file not found: {file_path}"
-            }
-        
-        # Load existing user data
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
-        
-        # Update the specified field
-        if field in user_data['profile']:
-            # Update profile field
-            user_data['profile'][field] = value
-        elif field.startswith('health_'):
-            # Initialize health_data section if it doesn't exist
-            if 'health_data' not in user_data:
-                user_data['health_data'] = {}
+        async with _tool_turn() as turn:
+            # Check if user exists
+            if turn.user_data is None:
+                return _user_not_found(turn)
             
-            # Update health data field
-            user_data['health_data'][field] = value
-            user_data['health_data']['last_updated'] = datetime.datetime.now().isoformat()
-        else:
-            # Update custom field in profile
-            user_data['profile'][field] = value
-        
-        # Save updated data
-        with open(file_path, 'w') as f:
-            json.dump(user_data, f, indent=2)
+            # Saved once at the end of the turn
+            turn.update('update_json', {field: value})
         
         return {
             "status": "success",
@@ -109,6 +253,54 @@ def update_json(field: str, value: str) -> dict:
             "new_value": value
         }
         
+    except NoAgentTurn:
+        return _no_agent_turn()
+    except json.JSONDecodeError as e:
+        return {
+            "status": "error",
+            "error_message": f"Invalid JSON in user file: {str(e)}"
+        }
+    except PermissionError as e:
+        return {
+            "status": "error",
+            "error_message": f"Permission denied accessing user file: {str(e)}"
+        }
+    except Exception as e:
+        logger.exception("Agent tool failed")
+        return {
+            "status": "error",
+            "error_message": f"Unexpected error updating user data: {str(e)}"
+        }
+
+
+@timed_tool
+async def update_fields(fields: dict) -> dict:
+    """Updates several fields of user health data at once.
+
+    Args:
+        fields (dict): Mapping of field name to new value, using the same
+            field names as update_json
+
+    Returns:
+        dict: Status and result or error message
+    """
+    try:
+        async with _tool_turn() as turn:
+            # Check if user exists
+            if turn.user_data is None:
+                return _user_not_found(turn)
+            
+            values = {field: str(value) for field, value in fields.items()}
+            turn.update('update_fields', values)
+        
+        return {
+            "status": "success",
+            "message": f"Successfully updated {len(values)} fields",
+            "updated_fields": values
+        }
+        
+    except NoAgentTurn:
+        return _no_agent_turn()
     except json.JSONDecodeError as e:
         return {
             "status": "error",
@@ -120,14 +312,16 @@ def update_json(field: str, value: str) -> dict:
             "error_message": f"Permission denied accessing user file: {str(e)}"
         }
     except Exception as e:
+        logger.exception("Agent tool failed")
         return {
             "status": "error",
             "error_message": f"Unexpected error updating user data: {str(e)}"
         }
 
 
-def read_json(field: str) -> dict:
-    """Reads a specific field from user health data JSON file.
+@timed_tool
+async def read_json(field: str) -> dict:
+    """Reads a specific field from user health data.
 
     Args:
         field (str): Specific field to read from profile or health_data
@@ -136,19 +330,13 @@ def read_json(field: str) -> dict:
         dict: Status and result or error message with field value
     """
     try:
-        # Use the existing JSON file for testing
-        file_path = os.path.join('data', 'user_447480556916.json')
-        
-        # Check if file exists
-        if not os.path.exists(file_path):
-            return {
-                "status": "error",
-                "error_message": f"User file not found: {file_path}"
-            }
+        async with _tool_turn() as turn:
+            turn.read('read_json')
+            user_data = turn.user_data
         
-        # Load user data
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
+        # Check if user exists
+        if user_data is None:
+            return _user_not_found(turn)
         
         # Return specific field
         if field in user_data['profile']:
@@ -171,6 +359,8 @@ def read_json(field: str) -> dict:
                 "error_message": f"Field '{field}' not found in user data"
             }
         
+    except NoAgentTurn:
+        return _no_agent_turn()
     except json.JSONDecodeError as e:
         return {
             "status": "error",
@@ -182,43 +372,44 @@ def read_json(field: str) -> dict:
             "error_message": f"Permission denied accessing user file: {str(e)}"
         }
     except Exception as e:
+        logger.exception("Agent tool failed")
         return {
             "status": "error",
             "error_message": f"Unexpected error reading user data: {str(e)}"
         }
 
 
-def read_all_json() -> dict:
-    """Reads all user health data from JSON file.
+@timed_tool
+async def read_all_json() -> dict:
+    """Reads the user's profile, health data and a bounded view of their history.
+
+    The most recent messages are returned in full; older ones are
+    condensed into a summary, and the whole result is size-limited.
 
     Returns:
-        dict: Status and result or error message with all user data
+        dict: Status and result or error message with the user's data
     """
     try:
-        # Use the existing JSON file for testing
-        file_path = os.path.join('data', 'user_447480556916.json')
+        async with _tool_turn() as turn:
+            turn.read('read_all_json')
+            user_data = turn.user_data
         
-        # Check if file exists
-        if not os.path.exists(file_path):
-            return {
-                "status": "error",
-                "error_message": f"User file not found: {file_path}"
-            }
+        # Check if user exists
+        if user_data is None:
+            return _user_not_found(turn)
         
-        # Load user data
-        with open(file_path, 'r') as f:
-            user_data = json.load(f)
+        # Records from before the recent-message window fall back to the log's tail
+        recent_messages = None
+        if 'recent_messages' not in user_data:
+            recent_messages = await asyncio.to_thread(turn.storage.read_messages, turn.phone_number,
+                                                      CONTEXT_RECENT_MESSAGES)
         
-        # Return all user data
-        return {
-            "status": "success",
-            "user_data": user_data,
-            "profile": user_data.get('profile', {}),
-            "health_data": user_data.get('health_data', {}),
-            "triage_completed": user_data.get('triage_completed', False),
-            "message_count": len(user_data.get('messages', []))
-        }
+        # Profile, health data, recent messages and a summary of the rest,
+        # trimmed to a fixed size however long the history gets
+        return build_context(user_data, recent_messages)
         
+    except NoAgentTurn:
+        return _no_agent_turn()
     except json.JSONDecodeError as e:
         return {
             "status": "error",
@@ -230,20 +421,60 @@ def read_all_json() -> dict:
             "error_message": f"Permission denied accessing user file: {str(e)}"
         }
     except Exception as e:
+        logger.exception("Agent tool failed")
         return {
             "status": "error",
             "error_message": f"Unexpected error reading user data: {str(e)}"
         }
 
 
-root_agent = Agent(
-    name="nutri_mate_agent",
-    model="gemini-2.0-flash",
-    description=(
-        "Agent to prompt the user for health information."
-    ),
-    instruction=(
-        """
+@timed_tool
+async def read_message_history(count: int, skip: int = 0) -> dict:
+    """Reads older messages from the user's full history, newest last.
+
+    Use this when the summary in read_all_json isn't enough, e.g. to
+    look back at a meal from weeks ago.
+
+    Args:
+        count (int): Number of messages to return (at most 50).
+        skip (int): Number of most recent messages to skip first.
+
+    Returns:
+        dict: Status and the messages or error message
+    """
+    try:
+        count = max(1, min(int(count), 50))
+        skip = max(0, int(skip))
+        async with _tool_turn() as turn:
+            turn.read('read_message_history')
+            if turn.user_data is None:
+                return _user_not_found(turn)
+        
+        # Reads through to the archive once the live history runs out
+        messages = await asyncio.to_thread(turn.storage.read_messages, turn.phone_number, skip + count)
+        return {
+            "status": "success",
+            "messages": messages[:max(0, len(messages) - skip)],
+            "more_available": len(messages) == skip + count
+        }
+        
+    except NoAgentTurn:
+        return _no_agent_turn()
+    except (TypeError, ValueError) as e:
+        return {
+            "status": "error",
+            "error_message": f"Invalid count or skip: {str(e)}"
+        }
+    except Exception as e:
+        logger.exception("Agent tool failed")
+        return {
+            "status": "error",
+            "error_message": f"Unexpected error reading message history: {str(e)}"
+        }
+
+
+AGENT_INSTRUCTION = (
+    """
 When engaging with a new user, NutriMate conducts a thoughtful discovery process to understand their unique health landscape. Rather than overwhelming users with forms, you engage in natural conversation to uncover:
 
 HEALTH FOUNDATION DISCOVERY:
@@ -336,8 +567,36 @@ Start with these questions:
   - What's your location/city?
   - What brings you here today? Please describe your main health concern.
   
-  After that, ask them for a photo of their recent meal, and analyze it. Immediately update the user profile JSON with the information you gather. Then, give some contextualized education on the meal.
+  After that, ask them for a photo of their recent meal, and analyze it. Immediately update the user profile JSON with the information you gather, using update_fields when you have several values to record. Then, give some contextualized education on the meal.
         """
-    ),
-    tools=[get_weather, get_current_time, update_json, read_json, read_all_json],
-)
\ No newline at end of file
+)
+
+_root_agent = None
+_root_agent_lock = threading.Lock()
+
+
+def get_root_agent():
+    """The NutriMate agent, built on first use; importing ADK's Agent takes over a second."""
+    global _root_agent
+    if _root_agent is None:
+        with _root_agent_lock:
+            if _root_agent is None:
+                from google.adk.agents import Agent
+                _root_agent = Agent(
+                    name="nutri_mate_agent",
+                    model="gemini-2.0-flash",
+                    description=(
+                        "Agent to prompt the user for health information."
+                    ),
+                    instruction=AGENT_INSTRUCTION,
+                    tools=[get_weather, get_current_time, update_json, update_fields, read_json, read_all_json,
+                           read_message_history],
+                )
+    return _root_agent
+
+
+def __getattr__(name):
+    # `adk web` and `adk run` look for a module-level root_agent
+    if name == 'root_agent':
+        return get_root_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
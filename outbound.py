@@ -0,0 +1,44 @@
+"""
+Outbound WhatsApp messages through the Twilio Messages REST API.
+
+Used when replies are sent after the webhook has already been
+acknowledged. TWILIO_API_URL can point at a local fake (see
+fake_twilio.py) instead of api.twilio.com.
+"""
+
+import os
+import requests
+from requests.auth import HTTPBasicAuth
+
+TWILIO_API_URL = os.getenv('TWILIO_API_URL', 'https://api.twilio.com')
+
+# Connect and read timeouts for calls to the Messages API, in seconds
+TWILIO_API_TIMEOUT = (5, 15)
+
+_session = requests.Session()
+
+
+def whatsapp_address(number):
+    """Add the whatsapp: prefix Twilio expects on WhatsApp numbers."""
+    return number if number.startswith('whatsapp:') else f'whatsapp:{number}'
+
+
+def send_whatsapp_message(to, body, account_sid=None, auth_token=None, from_number=None):
+    """Send a WhatsApp message and return its Twilio message SID."""
+    account_sid = account_sid or os.getenv('TWILIO_ACCOUNT_SID')
+    auth_token = auth_token or os.getenv('TWILIO_AUTH_TOKEN')
+    from_number = from_number or os.getenv('TWILIO_WHATSAPP_NUMBER')
+
+    url = f'{TWILIO_API_URL}/2010-04-01/Accounts/{account_sid}/Messages.json'
+    r = _session.post(
+        url,
+        data={
+            'From': whatsapp_address(from_number),
+            'To': whatsapp_address(to),
+            'Body': body
+        },
+        auth=HTTPBasicAuth(account_sid, auth_token),
+        timeout=TWILIO_API_TIMEOUT
+    )
+    r.raise_for_status()
+    return r.json().get('sid')
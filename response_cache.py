@@ -0,0 +1,132 @@
+"""
+Opt-in cache of agent replies to repeated questions.
+
+Many users ask the same thing ("what should I eat for breakfast"), and
+for users with similar profiles the agent's answer is the same. Replies
+are keyed on the normalised message plus a hash of the profile fields
+that shape the answer, kept for RESPONSE_CACHE_TTL seconds and evicted
+least-recently-used beyond RESPONSE_CACHE_SIZE entries.
+
+Only self-contained questions are looked up or stored: short messages
+and ones that refer back to the conversation ("yes", "what about
+lunch?") always reach the agent. A reply is stored only if it came from
+the user's first agent turn, with no earlier conversation in the
+session, and the agent called no tool that reads or writes the user's
+data: a reply built from someone's profile or history is never served
+to anyone else, and a message whose answer needs the profile updated
+always reaches the agent. A reply served from the cache is still added
+to the user's agent session.
+"""
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes')
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1024'))
+
+# Messages shorter than this, in words, depend on what was said before
+MIN_CACHEABLE_WORDS = 3
+
+# Words that make a message lean on the earlier conversation
+REFERRING_WORDS = {
+    'yes', 'no', 'ok', 'okay', 'sure', 'thanks', 'it', "it's", 'its', 'that', "that's", 'this', 'these',
+    'those', 'they', 'them', 'he', 'she', 'him', 'her', 'there', 'then', 'same', 'else', 'also', 'too',
+    'again', 'instead', 'above', 'another', 'more', 'one',
+}
+REFERRING_OPENINGS = ('and ', 'but ', 'so ', 'or ', 'what about ', 'how about ')
+
+
+def normalise_message(message):
+    """Lowercase a message and strip punctuation and extra whitespace."""
+    words = re.sub(r"[^\w\s']", ' ', message.lower()).split()
+    return ' '.join(words)
+
+
+def is_cacheable(message):
+    """Whether a message makes sense on its own, without the conversation before it."""
+    normalised = normalise_message(message)
+    words = normalised.split()
+    if len(words) < MIN_CACHEABLE_WORDS or normalised.startswith(REFERRING_OPENINGS):
+        return False
+    return not REFERRING_WORDS.intersection(words)
+
+
+def age_band(age):
+    """Bucket a free-text age into a decade, e.g. '34' -> '30s'."""
+    match = re.search(r'\d+', str(age or ''))
+    if not match:
+        return 'unknown'
+    return f'{int(match.group()) // 10 * 10}s'
+
+
+def profile_fingerprint(profile):
+    """Hash the profile fields that change what the agent would answer."""
+    relevant = '|'.join([
+        normalise_message(profile.get('health_concern', '')),
+        age_band(profile.get('age')),
+    ])
+    return hashlib.sha256(relevant.encode()).hexdigest()[:16]
+
+
+class ResponseCache:
+    """TTL + LRU cache of agent replies, with hit and latency statistics."""
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, maxsize=RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+
+    def make_key(self, message, profile):
+        """Build the cache key for a message from a user with this profile."""
+        return (normalise_message(message), profile_fingerprint(profile))
+
+    def get(self, key):
+        """Return the cached reply for key, or None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[2]
+            return entry[1]
+
+    def put(self, key, reply, latency):
+        """Cache a reply that took latency seconds to produce."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, reply, latency)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def skip(self):
+        """Record a reply that wasn't cached because it depended on the user's data or conversation."""
+        with self._lock:
+            self.skipped += 1
+
+    def stats(self):
+        """Return hit/miss counts, hit ratio and total latency saved."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'skipped': self.skipped,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'saved_seconds': self.saved_seconds
+            }
@@ -0,0 +1,181 @@
+"""
+Per-user ordered, cross-user parallel execution of reply work.
+
+Each user is mapped by a stable hash of their phone number to one of
+REPLY_WORKERS shards. A shard is a single worker thread with its own
+bounded queue, so a user's messages are handled strictly in the order
+they arrived, while users on different shards run in parallel. When a
+shard's queue is full new work is rejected with SchedulerBusy rather
+than queued without limit.
+
+Ordering is per process: with several gunicorn workers, the per-user
+lock in storage still keeps writes consistent, but two workers may
+handle the same user's messages at once.
+
+A Debouncer holds work back for a while before it is scheduled, on
+timer threads rather than the shard workers, and lets newer work for
+the same user replace work that is still waiting.
+"""
+
+import os
+import time
+import queue
+import zlib
+import threading
+import contextvars
+from concurrent.futures import Future
+
+from storage import clean_phone_number
+from metrics import metrics
+from structured_logging import get_logger, note_stage
+
+REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', '8'))
+REPLY_QUEUE_SIZE = int(os.getenv('REPLY_QUEUE_SIZE', '100'))
+
+# Result of a Debouncer call that newer work for the same key replaced
+SUPERSEDED = 'superseded'
+
+logger = get_logger('scheduler')
+
+
+class SchedulerBusy(Exception):
+    """Raised when a user's shard has no room for more work."""
+    pass
+
+
+class ShardedScheduler:
+    """Run callables one at a time per shard, with users hashed onto shards."""
+
+    def __init__(self, workers=REPLY_WORKERS, queue_size=REPLY_QUEUE_SIZE, name='reply'):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.name = name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queues = []
+        self._busy = []
+        self.rejected = 0
+
+    def _start(self):
+        """Start the shard threads on first use, and again after a fork."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._busy = [False] * self.workers
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(index,), name=f'{self.name}-{index}', daemon=True)
+                thread.start()
+            self._pid = os.getpid()
+
+    def shard_for(self, key):
+        """Get the shard a phone number's work runs on."""
+        return zlib.crc32(clean_phone_number(key).encode()) % self.workers
+
+    def submit(self, key, fn, *args):
+        """Queue fn(*args) behind everything already queued for key; returns a Future.
+
+        fn runs in a copy of the caller's context, so its log records keep
+        the request id and phone hash.
+        """
+        self._start()
+        shard = self.shard_for(key)
+        future = Future()
+        item = (future, time.perf_counter(), contextvars.copy_context(), fn, args)
+        try:
+            self._queues[shard].put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise SchedulerBusy(f"Shard {shard} has {self.queue_size} items queued")
+        return future
+
+    def run(self, key, fn, *args):
+        """Run fn(*args) in order with key's other work and wait for the result."""
+        return self.submit(key, fn, *args).result()
+
+    def _run(self, index):
+        work = self._queues[index]
+        while True:
+            future, queued_at, context, fn, args = work.get()
+            waited = time.perf_counter() - queued_at
+            metrics.observe('stage_duration_seconds', waited, stage='queue_wait')
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._busy[index] = True
+            try:
+                future.set_result(context.run(_call, waited, fn, args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._busy[index] = False
+
+    def stats(self):
+        """Queue depths and busy workers, for /metrics."""
+        depths = [work.qsize() for work in self._queues]
+        return {
+            'reply_queue_depth': sum(depths),
+            'reply_queue_depth_max': max(depths, default=0),
+            'reply_workers_busy': sum(self._busy),
+            'reply_queue_rejected_total': self.rejected,
+        }
+
+
+def _call(waited, fn, args):
+    note_stage('queue_wait', waited)
+    return fn(*args)
+
+
+class Debouncer:
+    """Delay calls per key, letting a newer call for the key replace a waiting one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def debounce(self, key, delay, max_delay, fn, *args):
+        """Call fn(*args) on a timer thread after delay seconds; returns a Future of its result.
+
+        If debounce() is called again for key before then, the Future
+        resolves to SUPERSEDED straight away and the new call waits in
+        its place. A run of calls for one key is never held back more
+        than max_delay after its first call.
+        """
+        key = clean_phone_number(key)
+        future = Future()
+        context = contextvars.copy_context()
+        now = time.monotonic()
+        with self._lock:
+            first_at = now
+            previous = self._pending.pop(key, None)
+            if previous is not None:
+                timer, previous_future, first_at = previous
+                timer.cancel()
+                previous_future.set_result(SUPERSEDED)
+            deadline = min(now + delay, first_at + max_delay)
+            timer = threading.Timer(max(0.0, deadline - now), self._fire, (key, future, context, fn, args))
+            timer.daemon = True
+            self._pending[key] = (timer, future, first_at)
+            timer.start()
+        return future
+
+    def _fire(self, key, future, context, fn, args):
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or pending[1] is not future:
+                # Replaced while the timer was going off
+                return
+            del self._pending[key]
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def stats(self):
+        """Calls waiting out their delay, for /metrics."""
+        with self._lock:
+            return {'bursts_waiting': len(self._pending)}
@@ -0,0 +1,337 @@
+"""
+Persistent session service for the ADK agent.
+
+ADK's InMemorySessionService keeps every conversation in the memory of
+the process that started it: a restart, or another gunicorn worker,
+loses it, and conversations of idle users are never freed.
+
+PersistentSessionService writes every session, event and app/user state
+change through to a SQLite database in WAL mode shared by all workers,
+and keeps only the SESSION_CACHE_SIZE most recently used sessions
+parsed in memory. A session evicted from the cache, or changed by
+another worker since it was cached, is rehydrated from the database on
+its next use. Only the newest SESSION_MAX_EVENTS events of a session
+are kept, so neither the cache nor the database grows without limit.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from google.adk.errors.already_exists_error import AlreadyExistsError
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session, State
+from google.adk.sessions.base_session_service import ListSessionsResponse
+
+from storage import DATA_DIR
+
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', os.path.join(DATA_DIR, 'sessions.sqlite3'))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '256'))
+SESSION_MAX_EVENTS = int(os.getenv('SESSION_MAX_EVENTS', '200'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    last_update_time REAL NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (app_name, user_id, id)
+);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (app_name, user_id, session_id, seq);
+CREATE TABLE IF NOT EXISTS app_state (
+    app_name TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_state (
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (app_name, user_id)
+);
+"""
+
+
+def split_state(state):
+    """Split a state dict into app-, user- and session-scoped parts; temp: keys are dropped."""
+    app_state, user_state, session_state = {}, {}, {}
+    for key, value in (state or {}).items():
+        if key.startswith(State.APP_PREFIX):
+            app_state[key[len(State.APP_PREFIX):]] = value
+        elif key.startswith(State.USER_PREFIX):
+            user_state[key[len(State.USER_PREFIX):]] = value
+        elif not key.startswith(State.TEMP_PREFIX):
+            session_state[key] = value
+    return app_state, user_state, session_state
+
+
+class PersistentSessionService(BaseSessionService):
+    """Sessions in SQLite, with the most recently used ones cached in memory."""
+
+    def __init__(self, path=SESSION_DB_PATH, cache_size=SESSION_CACHE_SIZE, max_events=SESSION_MAX_EVENTS):
+        self.path = path
+        self.cache_size = cache_size
+        self.max_events = max_events
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        """Get this thread's connection to the database (a fresh one after a fork)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    # Cache of parsed sessions, keyed by (app_name, user_id, session_id)
+
+    def _cached(self, key, revision):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[0] != revision:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _remember(self, key, revision, session):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = (revision, session)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                # Everything is already on disk, so eviction just frees the memory
+                self._cache.popitem(last=False)
+
+    def _forget(self, key):
+        with self._cache_lock:
+            self._cache.pop(key, None)
+
+    # Blocking database work, run in a worker thread by the async methods
+
+    def _merge_state(self, connection, session):
+        """Copy a session with app and user state merged into its state."""
+        merged = session.model_copy(deep=True)
+        row = connection.execute('SELECT state FROM app_state WHERE app_name = ?', (session.app_name,)).fetchone()
+        if row is not None:
+            for key, value in json.loads(row[0]).items():
+                merged.state[State.APP_PREFIX + key] = value
+        row = connection.execute(
+            'SELECT state FROM user_state WHERE app_name = ? AND user_id = ?', (session.app_name, session.user_id)
+        ).fetchone()
+        if row is not None:
+            for key, value in json.loads(row[0]).items():
+                merged.state[State.USER_PREFIX + key] = value
+        return merged
+
+    @staticmethod
+    def _update_scoped_state(connection, app_name, user_id, app_delta, user_delta):
+        if app_delta:
+            row = connection.execute('SELECT state FROM app_state WHERE app_name = ?', (app_name,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            state.update(app_delta)
+            connection.execute('INSERT OR REPLACE INTO app_state (app_name, state) VALUES (?, ?)',
+                               (app_name, json.dumps(state)))
+        if user_delta:
+            row = connection.execute(
+                'SELECT state FROM user_state WHERE app_name = ? AND user_id = ?', (app_name, user_id)
+            ).fetchone()
+            state = json.loads(row[0]) if row else {}
+            state.update(user_delta)
+            connection.execute('INSERT OR REPLACE INTO user_state (app_name, user_id, state) VALUES (?, ?, ?)',
+                               (app_name, user_id, json.dumps(state)))
+
+    def _create(self, app_name, user_id, state, session_id):
+        session_id = (session_id or '').strip() or uuid.uuid4().hex
+        app_delta, user_delta, session_state = split_state(state)
+        session = Session(app_name=app_name, user_id=user_id, id=session_id, state=session_state,
+                          last_update_time=time.time())
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT INTO sessions (app_name, user_id, id, state, last_update_time) VALUES (?, ?, ?, ?, ?)',
+                (app_name, user_id, session_id, json.dumps(session_state), session.last_update_time)
+            )
+            self._update_scoped_state(connection, app_name, user_id, app_delta, user_delta)
+            connection.execute('COMMIT')
+        except sqlite3.IntegrityError:
+            connection.execute('ROLLBACK')
+            raise AlreadyExistsError(f"Session with id {session_id} already exists.")
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._remember((app_name, user_id, session_id), 0, session)
+        return self._merge_state(connection, session)
+
+    def _load(self, app_name, user_id, session_id):
+        """Get a session from the cache, or rehydrate it from the database."""
+        key = (app_name, user_id, session_id)
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT state, last_update_time, revision FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?',
+            key
+        ).fetchone()
+        if row is None:
+            self._forget(key)
+            return None
+
+        session = self._cached(key, row[2])
+        if session is None:
+            events = connection.execute(
+                'SELECT event FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? '
+                'ORDER BY seq DESC LIMIT ?', key + (self.max_events,)
+            ).fetchall()
+            session = Session(
+                app_name=app_name, user_id=user_id, id=session_id, state=json.loads(row[0]),
+                events=[Event.model_validate_json(event) for (event,) in reversed(events)],
+                last_update_time=row[1]
+            )
+            self._remember(key, row[2], session)
+        return self._merge_state(connection, session)
+
+    def _get(self, app_name, user_id, session_id, config):
+        session = self._load(app_name, user_id, session_id)
+        if session is None or config is None:
+            return session
+        if config.num_recent_events is not None:
+            session.events = session.events[-config.num_recent_events:] if config.num_recent_events else []
+        if config.after_timestamp:
+            session.events = [event for event in session.events if event.timestamp >= config.after_timestamp]
+        return session
+
+    def _list(self, app_name, user_id):
+        connection = self._connection()
+        if user_id is None:
+            rows = connection.execute(
+                'SELECT user_id, id, state, last_update_time FROM sessions WHERE app_name = ?', (app_name,)
+            ).fetchall()
+        else:
+            rows = connection.execute(
+                'SELECT user_id, id, state, last_update_time FROM sessions WHERE app_name = ? AND user_id = ?',
+                (app_name, user_id)
+            ).fetchall()
+        sessions = [
+            self._merge_state(connection, Session(app_name=app_name, user_id=row[0], id=row[1],
+                                                  state=json.loads(row[2]), last_update_time=row[3]))
+            for row in rows
+        ]
+        sessions.sort(key=lambda session: (session.last_update_time, session.user_id, session.id))
+        return ListSessionsResponse(sessions=sessions)
+
+    def _delete(self, app_name, user_id, session_id):
+        key = (app_name, user_id, session_id)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?', key)
+            connection.execute('DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ?', key)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._forget(key)
+
+    def _user_state(self, app_name, user_id):
+        row = self._connection().execute(
+            'SELECT state FROM user_state WHERE app_name = ? AND user_id = ?', (app_name, user_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _persist_event(self, session, event):
+        """Write an event that was just applied to session."""
+        key = (session.app_name, session.user_id, session.id)
+        delta = event.actions.state_delta if event.actions and event.actions.state_delta else {}
+        app_delta, user_delta, _ = split_state(delta)
+        _, _, session_state = split_state(session.state)
+        session.last_update_time = event.timestamp
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'UPDATE sessions SET state = ?, last_update_time = ?, revision = revision + 1 '
+                'WHERE app_name = ? AND user_id = ? AND id = ?',
+                (json.dumps(session_state), session.last_update_time) + key
+            )
+            connection.execute(
+                'INSERT INTO events (app_name, user_id, session_id, event) VALUES (?, ?, ?, ?)',
+                key + (event.model_dump_json(exclude_none=True),)
+            )
+            connection.execute(
+                'DELETE FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? AND seq <= '
+                '(SELECT seq FROM events WHERE app_name = ? AND user_id = ? AND session_id = ? '
+                'ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                key + key + (self.max_events,)
+            )
+            self._update_scoped_state(connection, session.app_name, session.user_id, app_delta, user_delta)
+            revision = connection.execute(
+                'SELECT revision FROM sessions WHERE app_name = ? AND user_id = ? AND id = ?', key
+            ).fetchone()
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        if revision is not None:
+            cached = Session(app_name=session.app_name, user_id=session.user_id, id=session.id,
+                             state=session_state, events=list(session.events[-self.max_events:]),
+                             last_update_time=session.last_update_time)
+            self._remember(key, revision[0], cached)
+
+    def stats(self):
+        """Cache statistics, for /metrics."""
+        with self._cache_lock:
+            return {
+                'session_cache_hits_total': self.hits,
+                'session_cache_misses_total': self.misses,
+                'session_cache_entries': len(self._cache),
+            }
+
+    # BaseSessionService
+
+    async def create_session(self, *, app_name, user_id, state=None, session_id=None):
+        return await asyncio.to_thread(self._create, app_name, user_id, state, session_id)
+
+    async def get_session(self, *, app_name, user_id, session_id, config=None):
+        return await asyncio.to_thread(self._get, app_name, user_id, session_id, config)
+
+    async def list_sessions(self, *, app_name, user_id=None):
+        return await asyncio.to_thread(self._list, app_name, user_id)
+
+    async def delete_session(self, *, app_name, user_id, session_id):
+        await asyncio.to_thread(self._delete, app_name, user_id, session_id)
+
+    async def get_user_state(self, *, app_name, user_id):
+        return await asyncio.to_thread(self._user_state, app_name, user_id)
+
+    async def append_event(self, session, event):
+        event = await super().append_event(session, event)
+        if not event.partial:
+            await asyncio.to_thread(self._persist_event, session, event)
+        return event
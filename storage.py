@@ -0,0 +1,1134 @@
+"""
+Storage backends for UM-GemiFish user data.
+
+The default 'json' backend keeps each user in a small JSON document with
+their profile and triage state (data/user_<number>.json) plus an
+append-only message log with one JSON object per line
+(data/user_<number>.messages.jsonl). The 'sqlite' backend keeps the same
+records in a single SQLite database in WAL mode. USER_STORAGE selects the
+backend used by get_storage().
+"""
+
+import os
+import json
+import gzip
+import time
+import shutil
+import fcntl
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from history import fold_message
+
+DATA_DIR = 'data'
+
+# Storage backend: 'json' or 'sqlite'
+USER_STORAGE = os.getenv('USER_STORAGE', 'json')
+SQLITE_PATH = os.getenv('USER_STORAGE_PATH', os.path.join(DATA_DIR, 'users.sqlite3'))
+
+# Summary index that 'admin.py list' reads for the json backend
+USER_INDEX_PATH = os.getenv('USER_INDEX_PATH', os.path.join(DATA_DIR, 'user_index.sqlite3'))
+
+# Compressed segments of messages moved out of the live history by compaction
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', os.path.join(DATA_DIR, 'archive'))
+
+# Default compaction policy: keep this many messages live, plus optionally nothing older than N days
+COMPACT_KEEP_MESSAGES = int(os.getenv('COMPACT_KEEP_MESSAGES', '200'))
+COMPACT_OLDER_THAN_DAYS = os.getenv('COMPACT_OLDER_THAN_DAYS')
+
+# Directory holding the per-user lock files shared by every worker process
+LOCK_DIR = os.getenv('USER_LOCK_DIR', os.path.join(DATA_DIR, '.locks'))
+
+# When to fsync the message log after an append: 'always', 'interval' or 'never'
+MESSAGE_LOG_FSYNC = os.getenv('MESSAGE_LOG_FSYNC', 'interval')
+MESSAGE_LOG_FSYNC_INTERVAL = float(os.getenv('MESSAGE_LOG_FSYNC_INTERVAL', '1.0'))
+
+# Block size used when reading a message log backwards
+TAIL_BLOCK_SIZE = 64 * 1024
+
+
+def clean_phone_number(phone_number):
+    """Strip the whatsapp: prefix and punctuation from a phone number."""
+    return phone_number.replace('+', '').replace(':', '').replace('whatsapp', '')
+
+
+def user_file_path(phone_number, data_dir=DATA_DIR):
+    """Get the path of a user's profile document."""
+    return os.path.join(data_dir, f'user_{clean_phone_number(phone_number)}.json')
+
+
+def message_log_path(phone_number, data_dir=DATA_DIR):
+    """Get the path of a user's message log."""
+    return os.path.join(data_dir, f'user_{clean_phone_number(phone_number)}.messages.jsonl')
+
+
+def atomic_write_json(path, data):
+    """Write JSON to a temporary file and rename it over path.
+
+    Readers see either the old or the new document, never a partial one.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class UserLock:
+    """Exclusive lock on one user's data, held across threads and processes.
+
+    Threads in the same process queue on an in-process RLock; the first
+    acquisition on a thread also takes an fcntl lock on a per-user lock
+    file, so gunicorn workers exclude each other too. The lock is
+    re-entrant on the thread that holds it.
+    """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+    _held = threading.local()
+
+    def __init__(self, phone_number, lock_dir=LOCK_DIR):
+        self.key = clean_phone_number(phone_number)
+        self.lock_dir = lock_dir
+
+    def _thread_lock(self, delta):
+        """Get the in-process lock for this user, tracking how many UserLocks use it."""
+        with self._registry_lock:
+            entry = self._registry.setdefault(self.key, [threading.RLock(), 0])
+            entry[1] += delta
+            if entry[1] == 0:
+                del self._registry[self.key]
+            return entry[0]
+
+    def acquire(self):
+        """Block until this thread holds the user's lock."""
+        held = self._held.__dict__.setdefault('locks', {})
+        if self.key in held:
+            held[self.key][1] += 1
+            return
+
+        thread_lock = self._thread_lock(1)
+        thread_lock.acquire()
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            fd = os.open(os.path.join(self.lock_dir, f'user_{self.key}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            thread_lock.release()
+            self._thread_lock(-1)
+            raise
+        held[self.key] = [fd, 1]
+
+    def release(self):
+        """Release one level of this thread's hold on the user's lock."""
+        held = self._held.__dict__.setdefault('locks', {})
+        entry = held[self.key]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+
+        del held[self.key]
+        try:
+            fcntl.flock(entry[0], fcntl.LOCK_UN)
+        finally:
+            os.close(entry[0])
+            self._thread_lock(-1).release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def user_lock(phone_number):
+    """Lock a user's data for a read-modify-write."""
+    return UserLock(phone_number)
+
+
+class MessageLog:
+    """Append-only per-user message history."""
+
+    def __init__(self, data_dir=DATA_DIR, fsync_policy=MESSAGE_LOG_FSYNC,
+                 fsync_interval=MESSAGE_LOG_FSYNC_INTERVAL):
+        if fsync_policy not in ('always', 'interval', 'never'):
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.data_dir = data_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._last_fsync = {}
+        self._lock = threading.Lock()
+
+    def get_log_path(self, phone_number):
+        """Get the path of a user's message log."""
+        return message_log_path(phone_number, self.data_dir)
+
+    def _should_fsync(self, log_path):
+        """Apply the fsync policy for an append to log_path."""
+        if self.fsync_policy == 'always':
+            return True
+        if self.fsync_policy == 'never':
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_fsync.get(log_path, 0.0) < self.fsync_interval:
+                return False
+            self._last_fsync[log_path] = now
+        return True
+
+    def append(self, phone_number, message_entry):
+        """Append one message to the user's log."""
+        log_path = self.get_log_path(phone_number)
+        line = json.dumps(message_entry) + '\n'
+        with open(log_path, 'a') as f:
+            f.write(line)
+            f.flush()
+            if self._should_fsync(log_path):
+                os.fsync(f.fileno())
+
+    def read(self, phone_number):
+        """Read a user's whole message history, oldest first."""
+        log_path = self.get_log_path(phone_number)
+        if not os.path.exists(log_path):
+            return []
+
+        messages = []
+        with open(log_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    messages.append(json.loads(line))
+        return messages
+
+    def tail(self, phone_number, count):
+        """Read the last count messages without parsing the rest of the log."""
+        log_path = self.get_log_path(phone_number)
+        if count <= 0 or not os.path.exists(log_path):
+            return []
+
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            buffer = b''
+            # One extra newline so the oldest wanted line is complete
+            while position > 0 and buffer.count(b'\n') <= count:
+                read_size = min(TAIL_BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                buffer = f.read(read_size) + buffer
+
+        lines = [line for line in buffer.split(b'\n') if line.strip()]
+        if position > 0:
+            # The first line may have been cut in half by the block boundary
+            lines = lines[1:]
+        return [json.loads(line) for line in lines[-count:]]
+
+    def write_all(self, phone_number, messages):
+        """Replace a user's log with the given messages."""
+        log_path = self.get_log_path(phone_number)
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(log_path)}.', suffix='.tmp',
+                                        dir=self.data_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for message_entry in messages:
+                    f.write(json.dumps(message_entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, log_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, phone_number):
+        """Remove a user's log."""
+        log_path = self.get_log_path(phone_number)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+
+def timestamp_key(timestamp):
+    """Form of an ISO timestamp that sorts the same way and is safe in a filename."""
+    return (timestamp or '').replace(':', '')
+
+
+class MessageArchive:
+    """Per-user gzip segments of messages compacted out of the live history.
+
+    Segments are named <first>_<last>_<count>.jsonl.gz after the
+    timestamp keys of their first and last messages, so their order and
+    the newest archived timestamp are known without opening them.
+    """
+
+    SUFFIX = '.jsonl.gz'
+
+    def __init__(self, root=MESSAGE_ARCHIVE_DIR):
+        self.root = root
+
+    def user_dir(self, phone_number):
+        return os.path.join(self.root, clean_phone_number(phone_number))
+
+    def segments(self, phone_number):
+        """List (path, first key, last key, count) for a user's segments, oldest first."""
+        user_dir = self.user_dir(phone_number)
+        try:
+            names = os.listdir(user_dir)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in sorted(names):
+            if name.endswith(self.SUFFIX) and not name.startswith('.'):
+                first, last, count = name[:-len(self.SUFFIX)].split('_')
+                segments.append((os.path.join(user_dir, name), first, last, int(count)))
+        return segments
+
+    def newest_key(self, phone_number):
+        """Timestamp key of the newest archived message, or None."""
+        segments = self.segments(phone_number)
+        return segments[-1][2] if segments else None
+
+    @staticmethod
+    def read_segment(path):
+        with gzip.open(path, 'rt') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def read(self, phone_number):
+        """Read every archived message, oldest first."""
+        messages = []
+        for path, _, _, _ in self.segments(phone_number):
+            messages.extend(self.read_segment(path))
+        return messages
+
+    def tail(self, phone_number, count):
+        """Read the newest count archived messages, opening only the segments needed."""
+        messages = []
+        for path, _, _, _ in reversed(self.segments(phone_number)):
+            if len(messages) >= count:
+                break
+            messages = self.read_segment(path) + messages
+        return messages[-count:] if count > 0 else []
+
+    def write_segment(self, phone_number, messages):
+        """Write messages, oldest first, as a new segment; returns its path."""
+        user_dir = self.user_dir(phone_number)
+        os.makedirs(user_dir, exist_ok=True)
+        name = (f"{timestamp_key(messages[0]['timestamp'])}_{timestamp_key(messages[-1]['timestamp'])}"
+                f"_{len(messages)}{self.SUFFIX}")
+        path = os.path.join(user_dir, name)
+        fd, tmp_path = tempfile.mkstemp(prefix='.segment.', suffix='.tmp', dir=user_dir)
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                for message_entry in messages:
+                    f.write((json.dumps(message_entry) + '\n').encode())
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def delete(self, phone_number):
+        shutil.rmtree(self.user_dir(phone_number), ignore_errors=True)
+
+
+def split_legacy_record(user_data, message_log):
+    """Move an embedded 'messages' list out of a user record into its log.
+
+    Returns True if the record was changed and needs to be saved.
+    """
+    if 'messages' not in user_data:
+        return False
+
+    messages = user_data.pop('messages')
+    message_log.write_all(user_data['phone_number'], messages)
+    user_data['message_count'] = len(messages)
+    user_data['last_message_at'] = messages[-1]['timestamp'] if messages else None
+    for message_entry in messages:
+        fold_message(user_data, message_entry)
+    return True
+
+
+class UserStorage:
+    """Interface implemented by every user storage backend.
+
+    Records are plain dicts shaped like the ones UserManager creates,
+    without the message history, which is kept separately.
+    """
+
+    def load(self, phone_number):
+        """Load a user's record, or None if the user doesn't exist."""
+        raise NotImplementedError
+
+    def load_for_update(self, phone_number):
+        """Load a user's record in order to change it; the caller holds the user's lock.
+
+        Unlike load(), this may upgrade the stored record first.
+        """
+        return self.load(phone_number)
+
+    def save(self, phone_number, user_data):
+        """Create or replace a user's record, setting its updated_at to now."""
+        raise NotImplementedError
+
+    def exists(self, phone_number):
+        """Check if a user's record exists."""
+        return self.load(phone_number) is not None
+
+    def delete(self, phone_number):
+        """Delete a user's record and message history."""
+        raise NotImplementedError
+
+    def version(self, phone_number):
+        """Return a token that changes whenever the user's record changes."""
+        raise NotImplementedError
+
+    def append_message(self, phone_number, message_entry):
+        """Append one message to a user's history."""
+        raise NotImplementedError
+
+    def read_messages(self, phone_number, last=None):
+        """Read a user's message history, oldest first, or only the last N.
+
+        Reads through to the archive when the live history doesn't hold
+        enough messages.
+        """
+        live = self._read_live_messages(phone_number, last)
+        newest_archived = self.archive.newest_key(phone_number)
+        if newest_archived is None:
+            return live
+
+        # Skip anything an interrupted compaction already archived
+        live = [message for message in live if timestamp_key(message.get('timestamp')) > newest_archived]
+        if last is None:
+            return self.archive.read(phone_number) + live
+        if len(live) >= last:
+            return live
+        return self.archive.tail(phone_number, last - len(live)) + live
+
+    def _read_live_messages(self, phone_number, last=None):
+        """Read messages from the live history only."""
+        raise NotImplementedError
+
+    def update_message(self, phone_number, timestamp, fields):
+        """Add fields to the live message with the given timestamp; the caller holds the user's lock.
+
+        Returns False if there is no such message.
+        """
+        live = self._read_live_messages(phone_number)
+        for message_entry in reversed(live):
+            if message_entry.get('timestamp') == timestamp:
+                message_entry.update(fields)
+                self.replace_messages(phone_number, live)
+                return True
+        return False
+
+    def compact_messages(self, phone_number, keep_last, older_than=None):
+        """Move old messages from the live history into a compressed archive segment.
+
+        Everything but the newest keep_last messages is archived, as is
+        anything with a timestamp before older_than (an ISO timestamp).
+        Returns the number of messages archived.
+        """
+        with user_lock(phone_number):
+            self.load_for_update(phone_number)
+            live = self._read_live_messages(phone_number)
+            newest_archived = self.archive.newest_key(phone_number)
+            repaired = False
+            if newest_archived is not None:
+                kept = [message for message in live if timestamp_key(message.get('timestamp')) > newest_archived]
+                repaired = len(kept) != len(live)
+                live = kept
+
+            split = max(0, len(live) - keep_last)
+            if older_than is not None:
+                while split < len(live) and (live[split].get('timestamp') or '') < older_than:
+                    split += 1
+            cold, hot = live[:split], live[split:]
+
+            if cold:
+                # The segment is durable before the live history loses anything
+                self.archive.write_segment(phone_number, cold)
+            if cold or repaired:
+                self.replace_messages(phone_number, hot)
+            return len(cold)
+
+    def replace_messages(self, phone_number, messages):
+        """Replace a user's whole message history."""
+        raise NotImplementedError
+
+    def iter_users(self, triage_completed=None, location=None):
+        """Yield user records, optionally filtered by triage state or location."""
+        raise NotImplementedError
+
+    def list_users(self, triage_completed=None, location=None, inactive_since=None, offset=0, limit=None):
+        """Return (summaries, total) for one page of users matching the filters.
+
+        Summaries are dicts with the fields of SUMMARY_COLUMNS. inactive_since
+        is an ISO timestamp; users whose last message is older, or who have
+        never sent one, match.
+        """
+        raise NotImplementedError
+
+
+def _matches(user_data, triage_completed, location):
+    """Check a record against the iter_users filters."""
+    if triage_completed is not None and bool(user_data.get('triage_completed')) != triage_completed:
+        return False
+    if location is not None and user_data['profile'].get('location', '').lower() != location.lower():
+        return False
+    return True
+
+
+# Fields of a user summary, as returned by list_users()
+SUMMARY_COLUMNS = ('user_key', 'phone_number', 'name', 'age', 'location', 'triage_completed',
+                   'message_count', 'created_at', 'last_message_at')
+
+USER_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_summaries (
+    user_key TEXT PRIMARY KEY,
+    phone_number TEXT NOT NULL,
+    name TEXT,
+    age TEXT,
+    location TEXT,
+    triage_completed INTEGER NOT NULL DEFAULT 0,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    last_message_at TEXT,
+    source_mtime_ns INTEGER,
+    source_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS summaries_by_triage ON user_summaries (triage_completed);
+CREATE INDEX IF NOT EXISTS summaries_by_location ON user_summaries (location COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS summaries_by_last_message ON user_summaries (last_message_at);
+
+CREATE TABLE IF NOT EXISTS index_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def summary_row(user_key, user_data, version):
+    """Build a user_summaries row from a record and the (mtime_ns, size) it was read at."""
+    profile = user_data.get('profile', {})
+    if 'messages' in user_data:
+        message_count = len(user_data['messages'])
+        last_message_at = user_data['messages'][-1]['timestamp'] if user_data['messages'] else None
+    else:
+        message_count = user_data.get('message_count', 0)
+        last_message_at = user_data.get('last_message_at')
+    mtime_ns, size = version or (None, None)
+    return (
+        user_key, user_data['phone_number'], profile.get('name', ''), profile.get('age', ''),
+        profile.get('location', ''), int(bool(user_data.get('triage_completed'))),
+        message_count, user_data.get('created_at'), last_message_at, mtime_ns, size
+    )
+
+
+def summarise_user_files(paths):
+    """Read user documents and return their summary rows; runs in rebuild worker processes."""
+    rows = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            with open(path, 'r') as f:
+                user_data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        user_key = os.path.basename(path)[len('user_'):-len('.json')]
+        rows.append(summary_row(user_key, user_data, (stat.st_mtime_ns, stat.st_size)))
+    return rows
+
+
+def _filter_clause(triage_completed, location, inactive_since):
+    """Build the WHERE clause and parameters for the list_users filters."""
+    conditions = []
+    params = []
+    if triage_completed is not None:
+        conditions.append('triage_completed = ?')
+        params.append(int(triage_completed))
+    if location is not None:
+        conditions.append('location = ? COLLATE NOCASE')
+        params.append(location)
+    if inactive_since is not None:
+        conditions.append('(last_message_at IS NULL OR last_message_at < ?)')
+        params.append(inactive_since)
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+class UserIndex:
+    """SQLite table of per-user summaries kept next to the JSON documents.
+
+    Each row records the (mtime_ns, size) of the document it was built
+    from, so rows that no longer match their document can be found and
+    refreshed without reading every file.
+    """
+
+    def __init__(self, path=USER_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(USER_INDEX_SCHEMA)
+
+    def _connection(self):
+        """Get this thread's connection to the index (a fresh one after a fork)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def update(self, user_key, user_data, version):
+        """Insert or refresh one user's summary."""
+        self._connection().execute(
+            'INSERT OR REPLACE INTO user_summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            summary_row(user_key, user_data, version)
+        )
+
+    def remove(self, user_key):
+        self._connection().execute('DELETE FROM user_summaries WHERE user_key = ?', (user_key,))
+
+    def versions(self):
+        """Map each indexed user_key to the (mtime_ns, size) its row was built from."""
+        rows = self._connection().execute(
+            'SELECT user_key, source_mtime_ns, source_size FROM user_summaries'
+        ).fetchall()
+        return {row['user_key']: (row['source_mtime_ns'], row['source_size']) for row in rows}
+
+    def apply(self, rows, removed_keys):
+        """Write a batch of summary rows and removals in one transaction, and mark the index built."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR REPLACE INTO user_summaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.executemany('DELETE FROM user_summaries WHERE user_key = ?', [(key,) for key in removed_keys])
+            connection.execute("INSERT OR REPLACE INTO index_meta VALUES ('built_at', ?)", (time.time(),))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def is_built(self):
+        """Whether a full rebuild has ever been written to this index."""
+        row = self._connection().execute("SELECT value FROM index_meta WHERE key = 'built_at'").fetchone()
+        return row is not None
+
+    def query(self, triage_completed=None, location=None, inactive_since=None, offset=0, limit=None):
+        """Return (summaries, total) for one page of matching users, ordered by user_key."""
+        where, params = _filter_clause(triage_completed, location, inactive_since)
+        connection = self._connection()
+        total = connection.execute(f'SELECT COUNT(*) FROM user_summaries{where}', params).fetchone()[0]
+        rows = connection.execute(
+            f'SELECT {", ".join(SUMMARY_COLUMNS)} FROM user_summaries{where} ORDER BY user_key LIMIT ? OFFSET ?',
+            params + [limit if limit is not None else -1, offset]
+        ).fetchall()
+        return [_summary_dict(row) for row in rows], total
+
+
+def _summary_dict(row):
+    summary = dict(row)
+    summary['triage_completed'] = bool(summary['triage_completed'])
+    return summary
+
+
+class JsonFileStorage(UserStorage):
+    """One JSON document plus one message log per user under data_dir."""
+
+    def __init__(self, data_dir=DATA_DIR, index_path=USER_INDEX_PATH, archive_dir=MESSAGE_ARCHIVE_DIR):
+        self.data_dir = data_dir
+        self.message_log = MessageLog(data_dir)
+        self.archive = MessageArchive(archive_dir)
+        os.makedirs(data_dir, exist_ok=True)
+        self.index = UserIndex(index_path)
+
+    def get_user_file_path(self, phone_number):
+        """Get the path of a user's profile document."""
+        return user_file_path(phone_number, self.data_dir)
+
+    def load(self, phone_number):
+        file_path = self.get_user_file_path(phone_number)
+        if not os.path.exists(file_path):
+            return None
+
+        with open(file_path, 'r') as f:
+            return json.load(f)
+
+    def load_for_update(self, phone_number):
+        user_data = self.load(phone_number)
+        # Records from before the message log still embed their history; it
+        # moves to the log on the record's first write
+        if user_data is not None and split_legacy_record(user_data, self.message_log):
+            self.save(phone_number, user_data)
+        return user_data
+
+    def save(self, phone_number, user_data):
+        user_data['updated_at'] = datetime.now().isoformat()
+        atomic_write_json(self.get_user_file_path(phone_number), user_data)
+        try:
+            # The index tracks documents by (mtime_ns, size), as rebuild_index() stats them
+            version = self.version(phone_number)
+            self.index.update(clean_phone_number(phone_number), user_data, version and version[:2])
+        except sqlite3.Error:
+            # The document is saved; rebuild_index() repairs rows that fall behind
+            pass
+
+    def exists(self, phone_number):
+        return os.path.exists(self.get_user_file_path(phone_number))
+
+    def delete(self, phone_number):
+        file_path = self.get_user_file_path(phone_number)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        self.message_log.delete(phone_number)
+        self.archive.delete(phone_number)
+        self.index.remove(clean_phone_number(phone_number))
+
+    def version(self, phone_number):
+        try:
+            stat = os.stat(self.get_user_file_path(phone_number))
+        except FileNotFoundError:
+            return None
+        # Every save writes a new file, so the inode changes even when the mtime and size don't
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def append_message(self, phone_number, message_entry):
+        self.message_log.append(phone_number, message_entry)
+
+    def _read_live_messages(self, phone_number, last=None):
+        if not os.path.exists(self.message_log.get_log_path(phone_number)):
+            # A record from before the message log that hasn't been written since
+            messages = (self.load(phone_number) or {}).get('messages', [])
+            if last is None:
+                return messages
+            return messages[-last:] if last > 0 else []
+        if last is None:
+            return self.message_log.read(phone_number)
+        return self.message_log.tail(phone_number, last)
+
+    def replace_messages(self, phone_number, messages):
+        self.message_log.write_all(phone_number, messages)
+
+    def iter_users(self, triage_completed=None, location=None):
+        if not os.path.exists(self.data_dir):
+            return
+        for filename in sorted(os.listdir(self.data_dir)):
+            if filename.startswith('user_') and filename.endswith('.json'):
+                user_data = self.load(filename[len('user_'):-len('.json')])
+                if user_data and _matches(user_data, triage_completed, location):
+                    yield user_data
+
+    def list_users(self, triage_completed=None, location=None, inactive_since=None, offset=0, limit=None):
+        if not self.index.is_built():
+            self.rebuild_index()
+        return self.index.query(triage_completed, location, inactive_since, offset, limit)
+
+    def rebuild_index(self, workers=None, full=False):
+        """Bring the summary index up to date with the documents in data_dir.
+
+        Only documents whose mtime or size differ from their row are read,
+        unless full is set. They are read in parallel by worker processes.
+        Returns a dict with the number of documents scanned, rows
+        refreshed and rows removed.
+        """
+        indexed = self.index.versions()
+        current = {}
+        for entry in os.scandir(self.data_dir):
+            name = entry.name
+            if name.startswith('user_') and name.endswith('.json'):
+                stat = entry.stat()
+                current[name[len('user_'):-len('.json')]] = (entry.path, (stat.st_mtime_ns, stat.st_size))
+
+        stale = [path for user_key, (path, version) in current.items()
+                 if full or indexed.get(user_key) != tuple(version)]
+        removed = [user_key for user_key in indexed if user_key not in current]
+
+        rows = []
+        if stale:
+            workers = workers or os.cpu_count() or 1
+            chunk_size = max(1, min(500, len(stale) // (workers * 4) or 1))
+            chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+            if workers == 1 or len(chunks) == 1:
+                for chunk in chunks:
+                    rows.extend(summarise_user_files(chunk))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for chunk_rows in executor.map(summarise_user_files, chunks):
+                        rows.extend(chunk_rows)
+
+        self.index.apply(rows, removed)
+        return {'scanned': len(current), 'updated': len(rows), 'removed': len(removed)}
+
+
+# Profile fields that get their own column in the SQLite users table
+PROFILE_COLUMNS = ('name', 'age', 'location', 'health_concern')
+
+# Message fields that get their own column in the SQLite messages table
+MESSAGE_COLUMNS = ('type', 'content', 'media_url', 'media_type', 'saved_filename')
+
+# Rows fetched at a time when streaming users out of SQLite
+ITER_BATCH_SIZE = 500
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_key TEXT PRIMARY KEY,
+    phone_number TEXT NOT NULL,
+    created_at TEXT,
+    name TEXT,
+    age TEXT,
+    location TEXT,
+    health_concern TEXT,
+    profile_extra TEXT NOT NULL DEFAULT '{}',
+    triage_completed INTEGER NOT NULL DEFAULT 0,
+    current_triage_step INTEGER NOT NULL DEFAULT 0,
+    adk_conversation_id TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_message_at TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_by_triage ON users (triage_completed);
+CREATE INDEX IF NOT EXISTS users_by_location ON users (location COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_by_last_message ON users (last_message_at);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_key TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    type TEXT,
+    content TEXT,
+    media_url TEXT,
+    media_type TEXT,
+    saved_filename TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_key, timestamp);
+
+CREATE TABLE IF NOT EXISTS health_data (
+    user_key TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (user_key, key)
+) WITHOUT ROWID;
+"""
+
+
+class SqliteStorage(UserStorage):
+    """All users in one SQLite database in WAL mode."""
+
+    def __init__(self, path=SQLITE_PATH, archive_dir=MESSAGE_ARCHIVE_DIR):
+        self.path = path
+        self.archive = MessageArchive(archive_dir)
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        """Get this thread's connection to the database (a fresh one after a fork)."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _transaction(self):
+        """Start a write transaction on this thread's connection."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def _row_to_user(self, row):
+        """Rebuild a user record from a users row and its health data."""
+        connection = self._connection()
+        profile = {column: row[column] or '' for column in PROFILE_COLUMNS}
+        profile.update(json.loads(row['profile_extra']))
+
+        user_data = {
+            'phone_number': row['phone_number'],
+            'created_at': row['created_at'],
+            'profile': profile,
+            'triage_completed': bool(row['triage_completed']),
+            'current_triage_step': row['current_triage_step'],
+            'message_count': row['message_count'],
+            'last_message_at': row['last_message_at'],
+        }
+        if row['adk_conversation_id'] is not None:
+            user_data['adk_conversation_id'] = row['adk_conversation_id']
+        user_data.update(json.loads(row['extra']))
+
+        health_rows = connection.execute(
+            'SELECT key, value FROM health_data WHERE user_key = ?', (row['user_key'],)
+        ).fetchall()
+        if health_rows:
+            user_data['health_data'] = {key: json.loads(value) for key, value in health_rows}
+        return user_data
+
+    def load(self, phone_number):
+        row = self._connection().execute(
+            'SELECT * FROM users WHERE user_key = ?', (clean_phone_number(phone_number),)
+        ).fetchone()
+        return self._row_to_user(row) if row else None
+
+    def save(self, phone_number, user_data):
+        user_data['updated_at'] = datetime.now().isoformat()
+        user_key = clean_phone_number(phone_number)
+        profile = user_data.get('profile', {})
+        known = {'phone_number', 'created_at', 'profile', 'triage_completed', 'current_triage_step',
+                 'adk_conversation_id', 'message_count', 'last_message_at', 'health_data', 'messages'}
+        extra = {key: value for key, value in user_data.items() if key not in known}
+        profile_extra = {key: value for key, value in profile.items() if key not in PROFILE_COLUMNS}
+
+        connection = self._transaction()
+        try:
+            connection.execute(
+                """
+                INSERT INTO users (user_key, phone_number, created_at, name, age, location, health_concern,
+                                   profile_extra, triage_completed, current_triage_step, adk_conversation_id,
+                                   message_count, last_message_at, extra, version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (user_key) DO UPDATE SET
+                    phone_number = excluded.phone_number,
+                    created_at = excluded.created_at,
+                    name = excluded.name,
+                    age = excluded.age,
+                    location = excluded.location,
+                    health_concern = excluded.health_concern,
+                    profile_extra = excluded.profile_extra,
+                    triage_completed = excluded.triage_completed,
+                    current_triage_step = excluded.current_triage_step,
+                    adk_conversation_id = excluded.adk_conversation_id,
+                    message_count = excluded.message_count,
+                    last_message_at = excluded.last_message_at,
+                    extra = excluded.extra,
+                    version = users.version + 1
+                """,
+                (
+                    user_key, user_data['phone_number'], user_data.get('created_at'),
+                    *(profile.get(column, '') for column in PROFILE_COLUMNS),
+                    json.dumps(profile_extra),
+                    int(bool(user_data.get('triage_completed'))),
+                    user_data.get('current_triage_step', 0),
+                    user_data.get('adk_conversation_id'),
+                    user_data.get('message_count', 0),
+                    user_data.get('last_message_at'),
+                    json.dumps(extra),
+                )
+            )
+            connection.execute('DELETE FROM health_data WHERE user_key = ?', (user_key,))
+            connection.executemany(
+                'INSERT INTO health_data (user_key, key, value) VALUES (?, ?, ?)',
+                [(user_key, key, json.dumps(value)) for key, value in user_data.get('health_data', {}).items()]
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def exists(self, phone_number):
+        row = self._connection().execute(
+            'SELECT 1 FROM users WHERE user_key = ?', (clean_phone_number(phone_number),)
+        ).fetchone()
+        return row is not None
+
+    def delete(self, phone_number):
+        user_key = clean_phone_number(phone_number)
+        connection = self._transaction()
+        try:
+            for table in ('users', 'messages', 'health_data'):
+                connection.execute(f'DELETE FROM {table} WHERE user_key = ?', (user_key,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self.archive.delete(phone_number)
+
+    def version(self, phone_number):
+        row = self._connection().execute(
+            'SELECT version FROM users WHERE user_key = ?', (clean_phone_number(phone_number),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _insert_messages(self, connection, user_key, messages):
+        """Insert message entries for a user within an open transaction."""
+        rows = []
+        for message_entry in messages:
+            extra = {key: value for key, value in message_entry.items()
+                     if key != 'timestamp' and key not in MESSAGE_COLUMNS}
+            rows.append((
+                user_key, message_entry['timestamp'],
+                *(message_entry.get(column) for column in MESSAGE_COLUMNS),
+                json.dumps(extra)
+            ))
+        connection.executemany(
+            """
+            INSERT INTO messages (user_key, timestamp, type, content, media_url, media_type, saved_filename, extra)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+
+    def append_message(self, phone_number, message_entry):
+        connection = self._transaction()
+        try:
+            self._insert_messages(connection, clean_phone_number(phone_number), [message_entry])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _row_to_message(row):
+        """Rebuild a message entry from a messages row."""
+        message_entry = {'timestamp': row['timestamp']}
+        message_entry.update({column: row[column] for column in MESSAGE_COLUMNS})
+        message_entry.update(json.loads(row['extra']))
+        return message_entry
+
+    def _read_live_messages(self, phone_number, last=None):
+        user_key = clean_phone_number(phone_number)
+        connection = self._connection()
+        if last is None:
+            rows = connection.execute(
+                'SELECT * FROM messages WHERE user_key = ? ORDER BY timestamp, id', (user_key,)
+            ).fetchall()
+        else:
+            rows = connection.execute(
+                'SELECT * FROM messages WHERE user_key = ? ORDER BY timestamp DESC, id DESC LIMIT ?',
+                (user_key, last)
+            ).fetchall()
+            rows.reverse()
+        return [self._row_to_message(row) for row in rows]
+
+    def update_message(self, phone_number, timestamp, fields):
+        connection = self._transaction()
+        try:
+            row = connection.execute(
+                'SELECT * FROM messages WHERE user_key = ? AND timestamp = ? ORDER BY id DESC LIMIT 1',
+                (clean_phone_number(phone_number), timestamp)
+            ).fetchone()
+            if row is None:
+                connection.execute('ROLLBACK')
+                return False
+            message_entry = self._row_to_message(row)
+            message_entry.update(fields)
+            extra = {key: value for key, value in message_entry.items()
+                     if key != 'timestamp' and key not in MESSAGE_COLUMNS}
+            connection.execute(
+                f"UPDATE messages SET {', '.join(f'{column} = ?' for column in MESSAGE_COLUMNS)}, extra = ? "
+                f"WHERE id = ?",
+                (*(message_entry.get(column) for column in MESSAGE_COLUMNS), json.dumps(extra), row['id'])
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return True
+
+    def replace_messages(self, phone_number, messages):
+        user_key = clean_phone_number(phone_number)
+        connection = self._transaction()
+        try:
+            connection.execute('DELETE FROM messages WHERE user_key = ?', (user_key,))
+            self._insert_messages(connection, user_key, messages)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def iter_users(self, triage_completed=None, location=None):
+        query = 'SELECT * FROM users'
+        conditions = []
+        params = []
+        if triage_completed is not None:
+            conditions.append('triage_completed = ?')
+            params.append(int(triage_completed))
+        if location is not None:
+            conditions.append('location = ? COLLATE NOCASE')
+            params.append(location)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY user_key'
+        cursor = self._connection().execute(query, params)
+        while True:
+            rows = cursor.fetchmany(ITER_BATCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield self._row_to_user(row)
+
+    def list_users(self, triage_completed=None, location=None, inactive_since=None, offset=0, limit=None):
+        # The users table already has the summary columns and their indexes
+        where, params = _filter_clause(triage_completed, location, inactive_since)
+        connection = self._connection()
+        total = connection.execute(f'SELECT COUNT(*) FROM users{where}', params).fetchone()[0]
+        rows = connection.execute(
+            f'SELECT {", ".join(SUMMARY_COLUMNS)} FROM users{where} ORDER BY user_key LIMIT ? OFFSET ?',
+            params + [limit if limit is not None else -1, offset]
+        ).fetchall()
+        return [_summary_dict(row) for row in rows], total
+
+
+def create_storage(backend=None):
+    """Create a storage backend by name ('json' or 'sqlite')."""
+    backend = backend or USER_STORAGE
+    if backend == 'json':
+        return JsonFileStorage()
+    if backend == 'sqlite':
+        return SqliteStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Get the process-wide storage backend selected by USER_STORAGE."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+def copy_users(source, target):
+    """Copy every user record and message history from one backend to another.
+
+    Returns the number of users copied.
+    """
+    copied = 0
+    for user_data in source.iter_users():
+        phone_number = user_data['phone_number']
+        target.save(phone_number, user_data)
+        # Archive segments are shared by every backend, so only the live history is copied
+        target.replace_messages(phone_number, source._read_live_messages(phone_number))
+        copied += 1
+    return copied
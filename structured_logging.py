@@ -0,0 +1,211 @@
+"""
+Structured, non-blocking logging for the webhook and the agent tools.
+
+Records are rendered as one JSON object per line carrying the current
+request id, a hash of the caller's phone number and any stage timings
+collected so far. Rendering happens on the calling thread, but writing
+is left to a QueueListener thread: a request never waits on stdout, and
+if the queue is full the record is dropped and counted instead.
+
+Phone numbers are never logged in the clear. The 'phone' field is a
+salted hash, and phone numbers in a message (written with a + or the
+whatsapp: prefix, or in a user_<number> storage key) and in fields that
+hold one (From, user_id, ...) are replaced by the same hash. Other
+numbers, like byte counts and timestamps, are left alone. DEBUG records are sampled at
+LOG_DEBUG_SAMPLE_RATE so they can stay enabled under load.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0.01'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_PHONE_SALT = os.getenv('LOG_PHONE_SALT', '')
+
+ROOT_LOGGER = 'nutrimate'
+
+# Phone numbers written with the whatsapp: prefix or a leading +, and the numbers in user_<number> keys
+PHONE_PATTERN = re.compile(r'whatsapp:\+?\d[\d ]{6,16}\d|\+\d[\d ]{6,16}\d|(?<=user_)\d{7,15}\b')
+
+# Record fields whose whole value is a phone number
+PHONE_FIELDS = {'From', 'To', 'sender', 'phone_number', 'user_id'}
+
+# Attributes every LogRecord has; anything else came in through extra=
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+# Request id, phone hash and stage timings of the request being handled
+_request = contextvars.ContextVar('log_request', default=None)
+
+
+def phone_hash(phone_number):
+    """Stable, non-reversible identifier for a phone number."""
+    digits = re.sub(r'\D', '', str(phone_number))
+    return hashlib.sha256(f'{LOG_PHONE_SALT}{digits}'.encode()).hexdigest()[:12]
+
+
+def redact(text):
+    """Replace phone numbers in text with their hashes."""
+    return PHONE_PATTERN.sub(lambda match: f'<phone:{phone_hash(match.group())}>', text)
+
+
+@contextmanager
+def request_context(request_id, phone_number=None):
+    """Attach a request id and phone hash to every record logged in the block."""
+    token = _request.set({
+        'request_id': request_id,
+        'phone': phone_hash(phone_number) if phone_number else None,
+        'stages': {}
+    })
+    try:
+        yield
+    finally:
+        _request.reset(token)
+
+
+def note_stage(stage, seconds):
+    """Add a stage's duration to the current request's timings."""
+    context = _request.get()
+    if context is not None:
+        stages = context['stages']
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+def stage_timings():
+    """Stage durations recorded so far in this request, in milliseconds."""
+    context = _request.get()
+    if context is None:
+        return {}
+    return {stage: round(seconds * 1000, 2) for stage, seconds in context['stages'].items()}
+
+
+class ContextFilter(logging.Filter):
+    """Copy the request context onto the record while still on the request's thread."""
+
+    def filter(self, record):
+        context = _request.get()
+        if context is not None:
+            record.request_id = context['request_id']
+            if context['phone'] and not hasattr(record, 'phone'):
+                record.phone = context['phone']
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Let through only a sample of DEBUG records."""
+
+    def __init__(self, rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Render a record as a single line of JSON with phone numbers redacted."""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key in STANDARD_ATTRIBUTES:
+                continue
+            if key in PHONE_FIELDS and value:
+                value = f'<phone:{phone_hash(value)}>'
+            elif isinstance(value, str) and key not in ('phone', 'request_id'):
+                value = redact(value)
+            entry[key] = value
+        if record.exc_info:
+            entry['exc'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of waiting when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Render here so the listener only has to write a finished line
+        line = self.format(record)
+        return logging.makeLogRecord({'msg': line, 'levelno': record.levelno, 'levelname': record.levelname})
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_pid = None
+
+
+def setup_logging(stream=None):
+    """Send the 'nutrimate' loggers through the queue; safe to call again after a fork."""
+    global _handler, _listener, _pid
+    if _pid == os.getpid():
+        return _handler
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(DebugSampler())
+    handler.addFilter(ContextFilter())
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, output)
+    listener.start()
+
+    if _handler is None:
+        atexit.register(shutdown_logging)
+        # A forked worker has no listener thread, so give it its own
+        os.register_at_fork(after_in_child=setup_logging)
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    if _handler is not None:
+        logger.removeHandler(_handler)
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+    _handler, _listener, _pid = handler, listener, os.getpid()
+    return handler
+
+
+def dropped_records():
+    """Records this process's handler dropped because its queue was full."""
+    return _handler.dropped if _handler is not None else 0
+
+
+def shutdown_logging():
+    """Write out everything still queued."""
+    global _listener
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    """Get a logger under the 'nutrimate' hierarchy."""
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
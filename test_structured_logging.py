@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Test that log lines hide phone numbers but keep other numbers readable.
+"""
+
+import json
+import logging
+
+from structured_logging import JsonFormatter, phone_hash, redact
+
+
+def test_redact_phone_numbers():
+    """Phone-shaped tokens are hashed; plain large integers are not."""
+    hashed = f'<phone:{phone_hash("447700900123")}>'
+    assert redact('Reply to whatsapp:+447700900123 failed') == f'Reply to {hashed} failed'
+    assert redact('Reply to +447700900123 failed') == f'Reply to {hashed} failed'
+    assert redact('Could not read data/user_447700900123.json') == f'Could not read data/user_{hashed}.json'
+    assert redact('Media exceeds the 10485760 byte limit') == 'Media exceeds the 10485760 byte limit'
+    assert redact('Took 1234567890 ns at 1760000000') == 'Took 1234567890 ns at 1760000000'
+
+
+def test_phone_fields_redacted():
+    """Fields that hold a phone number are hashed whatever their format."""
+    record = logging.makeLogRecord({'msg': 'Sent %d bytes', 'args': (20971520,), 'levelno': logging.INFO,
+                                    'levelname': 'INFO', 'user_id': '447700900123', 'size': '20971520'})
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['msg'] == 'Sent 20971520 bytes'
+    assert entry['user_id'] == f'<phone:{phone_hash("447700900123")}>'
+    assert entry['size'] == '20971520'
+
+
+if __name__ == "__main__":
+    test_redact_phone_numbers()
+    test_phone_fields_redacted()
+    print("✅ Phone numbers redacted, other numbers kept")
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Test the city and country to timezone lookup on inputs users send.
+"""
+
+from timezones import resolve_timezone
+
+
+def test_cities_and_qualifiers():
+    """Cities resolve exactly, with or without a country after them."""
+    assert resolve_timezone('Leeds, UK').zone == 'Europe/London'
+    assert resolve_timezone('Tokyo Japan').zone == 'Asia/Tokyo'
+    assert resolve_timezone('San Francisco, CA').zone == 'America/Los_Angeles'
+    assert resolve_timezone('Birmingham, AL') is None
+
+
+def test_countries():
+    """Single-zone countries resolve; countries with several zones don't pick one."""
+    assert resolve_timezone('Japan').zone == 'Asia/Tokyo'
+    assert resolve_timezone('USA').zone is None
+    for country in ('Australia', 'Brazil', 'Canada', 'CA', 'Russia'):
+        match = resolve_timezone(country)
+        assert match.kind == 'country' and match.zone is None, match
+    assert resolve_timezone('me') is None
+
+
+def test_fuzzy_matches_are_not_exact():
+    """Misspellings still resolve, but say they were a guess."""
+    assert resolve_timezone('New Yrok') == ('America/New_York', 'New York', 'city', False)
+    assert resolve_timezone('Portland').exact is False
+
+
+if __name__ == "__main__":
+    test_cities_and_qualifiers()
+    test_countries()
+    test_fuzzy_matches_are_not_exact()
+    print("✅ Timezone lookups resolved as expected")
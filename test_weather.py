@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Test the Open-Meteo weather provider against canned API responses.
+"""
+
+from unittest import mock
+
+import pytest
+import requests
+
+from weather import OpenMeteoProvider, StubWeatherProvider, WeatherReport, WeatherUnavailable, load_provider
+
+GEOCODING = {'results': [{'name': 'Leeds', 'latitude': 53.8, 'longitude': -1.55}]}
+FORECAST = {'current': {'temperature_2m': 11.5, 'weather_code': 61}}
+
+
+def fake_response(payload):
+    response = mock.Mock()
+    response.json.return_value = payload
+    response.raise_for_status.return_value = None
+    return response
+
+
+def test_default_provider_makes_no_network_calls():
+    """Weather lookups stay local unless a real provider is chosen."""
+    assert isinstance(load_provider(), StubWeatherProvider)
+
+
+def test_open_meteo_report():
+    """The city is geocoded, then its current conditions fetched."""
+    provider = OpenMeteoProvider()
+    with mock.patch.object(provider.session, 'get',
+                           side_effect=[fake_response(GEOCODING), fake_response(FORECAST)]) as get:
+        report = provider.current('leeds')
+    assert report == WeatherReport('Leeds', 11.5, 'light rain')
+    assert get.call_args_list[0].kwargs['params'] == {'name': 'leeds', 'count': 1}
+    assert get.call_args_list[1].kwargs['params']['latitude'] == 53.8
+
+
+def test_open_meteo_errors():
+    """Unknown cities and API failures raise WeatherUnavailable."""
+    provider = OpenMeteoProvider()
+    with mock.patch.object(provider.session, 'get', return_value=fake_response({'results': []})):
+        with pytest.raises(WeatherUnavailable):
+            provider.current('Nowhere')
+    with mock.patch.object(provider.session, 'get', side_effect=requests.ConnectionError('down')):
+        with pytest.raises(WeatherUnavailable):
+            provider.current('Leeds')
@@ -27,7 +27,14 @@ def test_webhook():
         'MediaUrl0': '',
     }
     
-    # Test 3: Message with health image
+    # Test 3: Text message
+    test_data_text = {
+        'From': 'whatsapp:+1234567890',
+        'Body': 'What should I eat for breakfast?',
+        'MediaUrl0': '',
+    }
+    
+    # Test 4: Message with health image
     test_data_image = {
         'From': 'whatsapp:+1234567890',
         'Body': 'skin-rash',
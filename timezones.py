@@ -0,0 +1,288 @@
+"""
+City-to-timezone lookup for the agent's time tools.
+
+The index is built once per process from the IANA tz database, either
+the system's copy or the tzdata package: every zone contributes its
+city ("America/Argentina/Buenos_Aires" -> "buenos aires"), and every
+country in iso3166.tab contributes its name ("Britain (UK)" ->
+"britain uk", "britain"). A short list of large cities that share
+another city's zone (Mumbai, Leeds, ...) and of common country names
+missing from iso3166.tab (USA, England, ...) is added on top. Lookups
+are normalised (case, accents, punctuation), try each part of a
+location like "Leeds, UK" and then the words within it ("Tokyo
+Japan"), and fall back to a fuzzy match for misspellings.
+
+A country only resolves to a zone if it has just one in zone.tab;
+"Australia" or "Canada" match with no zone, so the caller can ask for
+a city. A city is passed over when the rest of the location names a
+different country or a US state ("Birmingham, AL").
+
+Country codes ("GB", and abbreviations like "UK") are kept apart and
+only matched when the location writes them upper-case or in
+parentheses, so ordinary words like "me" or "us" don't resolve to
+Montenegro or the United States.
+"""
+
+import os
+import re
+import difflib
+import functools
+import threading
+import unicodedata
+import zoneinfo
+from collections import namedtuple
+from importlib import resources
+
+# How close a fuzzy match must be, from 0 to 1
+FUZZY_CUTOFF = 0.8
+
+# Zone groups named after places; legacy groups like US/ and Canada/ name regions instead
+AREAS = {'Africa', 'America', 'Antarctica', 'Arctic', 'Asia', 'Atlantic', 'Australia', 'Europe', 'Indian', 'Pacific'}
+
+# Large cities that share a zone named after another city
+CITY_ALIASES = {
+    'Mumbai': 'Asia/Kolkata',
+    'Delhi': 'Asia/Kolkata',
+    'New Delhi': 'Asia/Kolkata',
+    'Bangalore': 'Asia/Kolkata',
+    'Bengaluru': 'Asia/Kolkata',
+    'Chennai': 'Asia/Kolkata',
+    'Beijing': 'Asia/Shanghai',
+    'Washington': 'America/New_York',
+    'Boston': 'America/New_York',
+    'Miami': 'America/New_York',
+    'Atlanta': 'America/New_York',
+    'Houston': 'America/Chicago',
+    'Dallas': 'America/Chicago',
+    'San Francisco': 'America/Los_Angeles',
+    'Seattle': 'America/Los_Angeles',
+    'Manchester': 'Europe/London',
+    'Birmingham': 'Europe/London',
+    'Leeds': 'Europe/London',
+    'Glasgow': 'Europe/London',
+    'Edinburgh': 'Europe/London',
+    'Munich': 'Europe/Berlin',
+    'Barcelona': 'Europe/Madrid',
+    'Milan': 'Europe/Rome',
+    'Osaka': 'Asia/Tokyo',
+    'Abuja': 'Africa/Lagos',
+    'Cape Town': 'Africa/Johannesburg',
+}
+
+# Country names people use that iso3166.tab doesn't, by country code
+COUNTRY_ALIASES = {
+    'USA': 'US',
+    'United States of America': 'US',
+    'United Kingdom': 'GB',
+    'Great Britain': 'GB',
+    'England': 'GB',
+    'Scotland': 'GB',
+    'Wales': 'GB',
+    'Northern Ireland': 'GB',
+    'South Korea': 'KR',
+    'North Korea': 'KP',
+    'Holland': 'NL',
+    'UAE': 'AE',
+    'Czech Republic': 'CZ',
+}
+
+# US states, which qualify a city ("Birmingham, AL") rather than name a zone
+US_STATES = {
+    'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California',
+    'CO': 'Colorado', 'CT': 'Connecticut', 'DE': 'Delaware', 'DC': 'District of Columbia',
+    'FL': 'Florida', 'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana',
+    'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland',
+    'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri',
+    'MT': 'Montana', 'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey',
+    'NM': 'New Mexico', 'NY': 'New York', 'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio',
+    'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina',
+    'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 'VA': 'Virginia',
+    'WA': 'Washington', 'WV': 'West Virginia', 'WI': 'Wisconsin', 'WY': 'Wyoming',
+}
+
+# zone is None for a country with several zones
+TimezoneMatch = namedtuple('TimezoneMatch', ['zone', 'name', 'kind', 'exact'])
+TimezoneIndex = namedtuple('TimezoneIndex', ['places', 'codes', 'states'])
+Place = namedtuple('Place', ['zone', 'name', 'kind', 'countries'])
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def normalise_place(name):
+    """Lowercase a place name and strip accents, punctuation and extra whitespace."""
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode()
+    return ' '.join(re.sub(r"[^a-z0-9]+", ' ', name.lower()).split())
+
+
+def _read_tab(filename):
+    """Read a tab file of the tz database, from the system copy or the tzdata package."""
+    for directory in zoneinfo.TZPATH:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+    try:
+        return resources.files('tzdata').joinpath('zoneinfo', filename).read_text(encoding='utf-8')
+    except (ModuleNotFoundError, FileNotFoundError):
+        return ''
+
+
+def _tab_rows(filename):
+    for line in _read_tab(filename).splitlines():
+        if line and not line.startswith('#'):
+            yield line.split('\t')
+
+
+def build_index():
+    """Map normalised place names, country codes and US states to Places."""
+    # zone.tab lists each zone under one country; countries can have several
+    zone_country = {}
+    country_zones = {}
+    for row in _tab_rows('zone.tab'):
+        if len(row) >= 3:
+            zone_country[row[2]] = row[0]
+            country_zones.setdefault(row[0], []).append(row[2])
+
+    def city(zone, name):
+        country = zone_country.get(zone)
+        return Place(zone, name, 'city', frozenset([country] if country else []))
+
+    index = {}
+    codes = {}
+    for zone in sorted(zoneinfo.available_timezones()):
+        if zone.split('/', 1)[0] not in AREAS or '/' not in zone:
+            continue
+        name = zone.rsplit('/', 1)[1].replace('_', ' ')
+        index.setdefault(normalise_place(name), city(zone, name))
+    for name, zone in CITY_ALIASES.items():
+        index.setdefault(normalise_place(name), city(zone, name))
+
+    countries = {}
+    for row in _tab_rows('iso3166.tab'):
+        if len(row) < 2 or row[0] not in country_zones:
+            continue
+        code, name = row[0], row[1]
+        zones = country_zones[code]
+        entry = countries[code] = Place(zones[0] if len(zones) == 1 else None, name, 'country', frozenset([code]))
+        codes.setdefault(code.lower(), entry)
+        names = [name]
+        match = re.match(r'(.*?)\s*\((.*)\)$', name)
+        if match:
+            names.append(match.group(1))
+            # "UK" in "Britain (UK)" is a code; "Burma" in "Myanmar (Burma)" is a name
+            if match.group(2).isupper():
+                codes.setdefault(normalise_place(match.group(2)), entry)
+            else:
+                names.append(match.group(2))
+        for alias in names:
+            index.setdefault(normalise_place(alias), entry)
+    for alias, code in COUNTRY_ALIASES.items():
+        if code in countries:
+            index.setdefault(normalise_place(alias), countries[code])
+
+    states = {}
+    for code, name in US_STATES.items():
+        state = Place(None, name, 'state', frozenset(['US']))
+        states[code.lower()] = states[normalise_place(name)] = state
+    return TimezoneIndex(index, codes, states)
+
+
+def get_index():
+    """The process-wide index, built on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build_index()
+    return _index
+
+
+def _phrases(location):
+    """The phrases of a location to look up, most specific first.
+
+    Yields (phrase, whether it may be a code, whether it is a whole part).
+    The whole location comes first, then each part between commas,
+    slashes, semicolons or parentheses, then the runs of words within
+    each part, longest first ("Tokyo Japan" -> "Tokyo", "Japan").
+    """
+    parts = [part.strip() for part in re.split(r'[,/;]|(\([^)]*\))', location) if part and part.strip()]
+    phrases = [(location, False, True)]
+    phrases += [(part, part.startswith('('), True) for part in parts]
+    for part in parts:
+        words = part.strip('() ').split()
+        for size in range(len(words) - 1, 0, -1):
+            for start in range(len(words) - size + 1):
+                phrases.append((' '.join(words[start:start + size]), part.startswith('('), False))
+
+    seen = set()
+    for raw, bracketed, whole in phrases:
+        phrase = normalise_place(raw)
+        if phrase and phrase not in seen:
+            seen.add(phrase)
+            yield phrase, bracketed or raw.isupper(), whole
+
+
+def _lookup(index, phrase, maybe_code):
+    """Every place a phrase could name: a city or country, a country code, a US state."""
+    places = []
+    if phrase in index.places:
+        places.append(index.places[phrase])
+    if maybe_code and phrase in index.codes:
+        places.append(index.codes[phrase])
+    if phrase in index.states and (maybe_code or len(phrase) > 2):
+        places.append(index.states[phrase])
+    return places
+
+
+def _contradicted(place, phrase, qualifiers):
+    """Whether another part of the location puts the place in a different country."""
+    if not place.countries:
+        return False
+    words = set(phrase.split())
+    for other, countries in qualifiers:
+        if countries and not words & set(other.split()) and not place.countries & countries:
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_timezone(location):
+    """Find the timezone of a city or country, e.g. 'Leeds, UK', 'Tokyo Japan' or 'New Yrok'.
+
+    Returns a TimezoneMatch, or None if nothing matches or every city
+    that matches is in a different country from the one the location
+    names. A country with several zones, or a US state, matches with
+    zone=None.
+    Country codes only match when written upper-case ("Leeds, UK") or in
+    parentheses ("Leeds (uk)"); fuzzy matches have exact=False.
+    """
+    index = get_index()
+    if not normalise_place(location or ''):
+        return None
+    phrases = list(_phrases(location))
+    found = [(phrase, _lookup(index, phrase, maybe_code)) for phrase, maybe_code, _ in phrases]
+    qualifiers = [(phrase, frozenset().union(*(place.countries for place in places if place.kind != 'city')))
+                  for phrase, places in found]
+
+    # Exact matches first: the most specific city that fits the rest of the location, then a country or state
+    cities = [(phrase, place) for phrase, places in found for place in places if place.kind == 'city']
+    for phrase, place in cities:
+        if not _contradicted(place, phrase, qualifiers):
+            return TimezoneMatch(place.zone, place.name, place.kind, True)
+    if cities:
+        return None
+    for phrase, places in found:
+        if places:
+            return TimezoneMatch(places[0].zone, places[0].name, places[0].kind, True)
+
+    # Fuzzy matching only tries the whole location and its parts, not single words
+    for phrase, _, whole in phrases:
+        if not whole:
+            continue
+        close = difflib.get_close_matches(phrase, index.places, n=1, cutoff=FUZZY_CUTOFF)
+        if close:
+            place = index.places[close[0]]
+            if not _contradicted(place, phrase, qualifiers):
+                return TimezoneMatch(place.zone, place.name, place.kind, False)
+    return None
@@ -0,0 +1,195 @@
+"""
+Weather lookups for the agent's get_weather tool.
+
+A provider turns a city name into a WeatherReport. WEATHER_PROVIDER
+picks one: 'stub' (default; made-up but stable weather, with no
+network calls), 'open-meteo' (the free Open-Meteo API, which is sent
+each city asked about, including locations from user profiles) or any
+provider class as 'package.module:ClassName'.
+
+Reports are cached per city for WEATHER_CACHE_TTL seconds, and
+concurrent lookups of the same city share a single provider call.
+"""
+
+import os
+import time
+import zlib
+import importlib
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+import requests
+
+from timezones import normalise_place
+
+WEATHER_PROVIDER = os.getenv('WEATHER_PROVIDER', 'stub')
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '900'))
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', '1024'))
+
+# Connect and read timeouts for weather API calls, in seconds
+WEATHER_API_TIMEOUT = (3, 5)
+
+WeatherReport = namedtuple('WeatherReport', ['city', 'temperature_c', 'conditions'])
+
+# WMO weather interpretation codes, as used by Open-Meteo
+WMO_CONDITIONS = {
+    0: 'clear', 1: 'mostly clear', 2: 'partly cloudy', 3: 'overcast', 45: 'foggy', 48: 'foggy',
+    51: 'light drizzle', 53: 'drizzle', 55: 'heavy drizzle', 56: 'freezing drizzle', 57: 'freezing drizzle',
+    61: 'light rain', 63: 'rain', 65: 'heavy rain', 66: 'freezing rain', 67: 'freezing rain',
+    71: 'light snow', 73: 'snow', 75: 'heavy snow', 77: 'snow grains',
+    80: 'light showers', 81: 'showers', 82: 'heavy showers', 85: 'snow showers', 86: 'heavy snow showers',
+    95: 'thunderstorms', 96: 'thunderstorms with hail', 99: 'thunderstorms with hail',
+}
+
+
+class WeatherUnavailable(Exception):
+    """Raised when a provider has no weather for a city."""
+    pass
+
+
+class WeatherProvider:
+    """Interface for weather sources."""
+
+    def current(self, city):
+        """Return the current WeatherReport for city, or raise WeatherUnavailable."""
+        raise NotImplementedError
+
+
+class StubWeatherProvider(WeatherProvider):
+    """Made-up weather that stays the same for each city; makes no network calls."""
+
+    CONDITIONS = ('clear', 'partly cloudy', 'overcast', 'light rain', 'showers')
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def current(self, city):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        seed = zlib.crc32(normalise_place(city).encode())
+        return WeatherReport(city, float(seed % 30), self.CONDITIONS[seed % len(self.CONDITIONS)])
+
+
+class OpenMeteoProvider(WeatherProvider):
+    """Current conditions from the free Open-Meteo geocoding and forecast APIs."""
+
+    GEOCODING_URL = 'https://geocoding-api.open-meteo.com/v1/search'
+    FORECAST_URL = 'https://api.open-meteo.com/v1/forecast'
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def current(self, city):
+        try:
+            r = self.session.get(self.GEOCODING_URL, params={'name': city, 'count': 1},
+                                 timeout=WEATHER_API_TIMEOUT)
+            r.raise_for_status()
+            places = r.json().get('results') or []
+            if not places:
+                raise WeatherUnavailable(f"Unknown city: {city}")
+            place = places[0]
+
+            r = self.session.get(self.FORECAST_URL, params={
+                'latitude': place['latitude'],
+                'longitude': place['longitude'],
+                'current': 'temperature_2m,weather_code'
+            }, timeout=WEATHER_API_TIMEOUT)
+            r.raise_for_status()
+            current = r.json()['current']
+        except (requests.RequestException, KeyError, ValueError) as e:
+            raise WeatherUnavailable(f"Weather service error: {e}")
+        return WeatherReport(place.get('name', city), current['temperature_2m'],
+                             WMO_CONDITIONS.get(current.get('weather_code'), 'unknown conditions'))
+
+
+PROVIDERS = {
+    'open-meteo': OpenMeteoProvider,
+    'stub': StubWeatherProvider,
+}
+
+
+def load_provider(name=WEATHER_PROVIDER):
+    """Create a provider from a PROVIDERS name or a 'package.module:ClassName' path."""
+    if name in PROVIDERS:
+        return PROVIDERS[name]()
+    module_name, _, class_name = name.partition(':')
+    if not class_name:
+        raise ValueError(f"Unknown weather provider: {name}")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class WeatherService:
+    """TTL + LRU cache in front of a provider, coalescing concurrent lookups of a city."""
+
+    def __init__(self, provider, ttl=WEATHER_CACHE_TTL, maxsize=WEATHER_CACHE_SIZE):
+        self.provider = provider
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def current(self, city):
+        """Return the current WeatherReport for city, or raise WeatherUnavailable."""
+        key = normalise_place(city)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            waiting_on = self._in_flight.get(key)
+            if waiting_on is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                future = self._in_flight[key] = Future()
+        if waiting_on is not None:
+            # Someone else is already asking the provider for this city
+            return waiting_on.result()
+
+        try:
+            report = self.provider.current(city)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            self._entries[key] = (time.monotonic() + self.ttl, report)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        future.set_result(report)
+        return report
+
+    def stats(self):
+        """Cache statistics, for /metrics."""
+        with self._lock:
+            return {
+                'weather_cache_hits_total': self.hits,
+                'weather_cache_misses_total': self.misses,
+                'weather_lookups_coalesced_total': self.coalesced,
+            }
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_weather_service():
+    """The process-wide weather service, created on first use."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = WeatherService(load_provider())
+    return _service